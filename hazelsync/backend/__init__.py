@@ -1,11 +1,26 @@
 '''Basic backend class'''
 
+import os
+import stat
 from abc import abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
 from pathlib import Path
-from typing import ContextManager
+from typing import ContextManager, Dict, Iterator, List
 
 from filelock import FileLock
 
+class BackendError(RuntimeError):
+    '''Error of a backend operation'''
+
+@dataclass
+class Snapshot:
+    '''A snapshot of a slot'''
+    slot: str
+    path: Path
+    time: datetime
+
 class Backend:
     '''Abstract class for implementing a new hazelsync backend
     '''
@@ -26,3 +41,56 @@ class Backend:
     @abstractmethod
     def snapshot(self, slot):
         '''Perform a snapshot of a slot'''
+
+    def snapshot_many(self, slots: List[Path]):
+        '''Perform the snapshots of several slots.
+        Backends able to snapshot several slots at once should override it.
+        '''
+        for slot in slots:
+            self.snapshot(slot)
+
+    def list_snapshots(self) -> List[Snapshot]:
+        '''List the snapshots of the slots'''
+        raise NotImplementedError(f"Backend {type(self).__name__} cannot list its snapshots")
+
+    def destroy_snapshots(self, snapshots: List[Path]):
+        '''Destroy some snapshots of the slots'''
+        raise NotImplementedError(f"Backend {type(self).__name__} cannot destroy snapshots")
+
+    def snapshot_directory(self, snapshot: Snapshot) -> Path:
+        '''Return the directory where the files of a snapshot can be read'''
+        raise NotImplementedError(f"Backend {type(self).__name__} cannot read the files of its snapshots")
+
+    @contextmanager
+    def open_snapshot(self, snapshot: Snapshot) -> Iterator[Path]:
+        '''Give a directory with the files of a snapshot during the context (to restore them).
+        Backends not storing the snapshots as directories should override it.
+        '''
+        yield self.snapshot_directory(snapshot)
+
+    def snapshot_files(self, snapshot: Snapshot) -> Iterator[dict]:
+        '''Return the regular files of a snapshot, with their `path` (relative to the snapshot),
+        `size`, `mtime`, and either their `sha256` or the `source` path to read it from.
+        '''
+        root = self.snapshot_directory(snapshot)
+        for directory, _, files in os.walk(str(root)):
+            for name in files:
+                source = os.path.join(directory, name)
+                info = os.lstat(source)
+                if stat.S_ISREG(info.st_mode):
+                    yield {
+                        'path': os.path.relpath(source, str(root)),
+                        'size': info.st_size,
+                        'mtime': info.st_mtime,
+                        'source': source,
+                    }
+
+    def replicate(self, slots: List[Path]) -> Dict[Path, dict]:
+        '''Copy the last snapshots of some slots to a secondary target (if the backend supports it),
+        and return the statistics of the replication of each slot.
+        '''
+        return {}
+
+    def slot_metrics(self, slots: List[Path]) -> Dict[Path, dict]:
+        '''Return backend statistics of some slots (like the space they use), if the backend supports it'''
+        return {}
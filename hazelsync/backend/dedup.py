@@ -0,0 +1,460 @@
+'''Deduplicated chunk store backend'''
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import stat
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+from logging import getLogger
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set
+
+from filelock import FileLock
+
+from hazelsync.backend import Backend, BackendError, Snapshot
+from hazelsync.settings import SettingError
+from hazelsync.utils.chunking import chunk_file, chunk_files, MIN_SIZE, AVERAGE_SIZE, MAX_SIZE
+
+log = getLogger('hazelsync')
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+MANIFEST_NAME = re.compile(r'^(?P<slot>.+)-(?P<time>\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})\.json$')
+PACK_SIZE = 64 * 1024 * 1024
+# Number of bytes of files chunked by each task of the worker processes
+BATCH_SIZE = 16 * 1024 * 1024
+# Number of times a file changing while it is stored is chunked again, before it is skipped
+CHANGED_RETRIES = 2
+
+class FileChangedError(BackendError):
+    '''A file changed while it was stored'''
+
+class ChunkStore:
+    '''Chunks stored in append-only pack files, indexed by their sha256 in a sqlite database'''
+    def __init__(self, path: Path, pack_size: int = PACK_SIZE):
+        '''
+        :param path: The directory of the store.
+        :param pack_size: The size above which a new pack file is started.
+        '''
+        self.path = path
+        self.pack_size = pack_size
+        (self.path / 'packs').mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path / 'index.sqlite'))
+        self.db.execute('''CREATE TABLE IF NOT EXISTS chunks (
+            digest TEXT PRIMARY KEY, pack INTEGER, offset INTEGER, length INTEGER)''')
+        self.pack = None
+        self.pack_number = None
+
+    def pack_path(self, number: int) -> Path:
+        '''Return the path of a pack file'''
+        return self.path / 'packs' / f"{number:08d}.pack"
+
+    def missing(self, digests: Set[str]) -> Set[str]:
+        '''Return the digests of the chunks not in the store'''
+        present = set()
+        digests = list(digests)
+        # Stay below the maximum number of variables of sqlite
+        for i in range(0, len(digests), 500):
+            batch = digests[i:i + 500]
+            query = f"SELECT digest FROM chunks WHERE digest IN ({','.join('?' * len(batch))})"
+            present.update(row[0] for row in self.db.execute(query, batch))
+        return set(digests) - present
+
+    def add(self, digest: str, data: bytes):
+        '''Append a chunk to the current pack (the chunk is indexed at the next commit)'''
+        if self.pack is None or self.pack.tell() >= self.pack_size:
+            self.close_pack()
+            # Packs are never appended to after they are closed, even the ones of an interrupted snapshot
+            last = self.db.execute('SELECT MAX(pack) FROM chunks').fetchone()[0] or 0
+            existing = [int(path.stem) for path in (self.path / 'packs').glob('*.pack')]
+            self.pack_number = max([last, *existing]) + 1
+            self.pack = open(self.pack_path(self.pack_number), 'xb')  # pylint: disable=consider-using-with
+        offset = self.pack.tell()
+        self.pack.write(data)
+        self.db.execute('INSERT OR IGNORE INTO chunks VALUES (?, ?, ?, ?)', (digest, self.pack_number, offset, len(data)))
+
+    def close_pack(self):
+        '''Write the current pack to the disk'''
+        if self.pack is not None:
+            self.pack.flush()
+            os.fsync(self.pack.fileno())
+            self.pack.close()
+            self.pack = None
+
+    def commit(self):
+        '''Make the chunks added durable'''
+        self.close_pack()
+        self.db.commit()
+
+    def read(self, digest: str) -> bytes:
+        '''Return the data of a chunk'''
+        row = self.db.execute('SELECT pack, offset, length FROM chunks WHERE digest = ?', (digest,)).fetchone()
+        if row is None:
+            raise KeyError(f"Chunk {digest} is missing from {self.path}")
+        pack, offset, length = row
+        with open(self.pack_path(pack), 'rb') as stream:
+            stream.seek(offset)
+            return stream.read(length)
+
+    def collect(self, referenced: Set[str]) -> int:
+        '''Remove the chunks not referenced anymore from the index, and the packs without
+        any referenced chunk
+        :return: The number of bytes freed on the disk.
+        '''
+        self.commit()
+        unused = [row[0] for row in self.db.execute('SELECT digest FROM chunks') if row[0] not in referenced]
+        for i in range(0, len(unused), 500):
+            batch = unused[i:i + 500]
+            self.db.execute(f"DELETE FROM chunks WHERE digest IN ({','.join('?' * len(batch))})", batch)
+        self.db.commit()
+        used_packs = {row[0] for row in self.db.execute('SELECT DISTINCT pack FROM chunks')}
+        freed = 0
+        for path in (self.path / 'packs').glob('*.pack'):
+            if int(path.stem) not in used_packs:
+                freed += path.stat().st_size
+                path.unlink()
+        return freed
+
+    def close(self):
+        '''Commit and close the store'''
+        self.commit()
+        self.db.close()
+
+class DedupBackend(Backend):
+    '''Backend storing the snapshots of the slots as content-defined chunks, deduplicated between
+    the snapshots and the slots of a cluster.
+    The slots are directories, and a snapshot is a manifest of the files of a slot and their chunks.
+    '''
+    def __init__(self,
+        name: str,
+        path: Optional[str] = None,
+        basedir: Optional[str] = None,
+        workers: Optional[int] = None,
+        min_chunk_size: int = MIN_SIZE,
+        average_chunk_size: int = AVERAGE_SIZE,
+        max_chunk_size: int = MAX_SIZE,
+        pack_size: int = PACK_SIZE,
+    ):
+        '''
+        :param workers: The number of processes chunking and hashing the files (one per CPU by default).
+        :param min_chunk_size: The minimum size of the chunks, in bytes.
+        :param average_chunk_size: The average size of the chunks, in bytes (rounded to a power of 2).
+        :param max_chunk_size: The maximum size of the chunks, in bytes.
+        :param pack_size: The size of the pack files storing the chunks, in bytes.
+        '''
+        if path:
+            basepath = Path(path)
+        elif basedir:
+            basepath = Path(basedir) / name
+        else:
+            raise AttributeError("dedup backend need at least one of the following argument: path or basedir")
+        if not min_chunk_size < average_chunk_size < max_chunk_size:
+            raise SettingError('average_chunk_size', "Chunk sizes should be min_chunk_size < average_chunk_size < max_chunk_size")
+        self.slotdir = basepath / 'slots'
+        self.manifestdir = basepath / 'manifests'
+        self.storedir = basepath / 'store'
+        self.stagingdir = basepath / 'staging'
+        self.workers = workers or os.cpu_count()
+        self.chunk_sizes = (min_chunk_size, average_chunk_size, max_chunk_size)
+        self.pack_size = pack_size
+        self.snapshot_stats = {}
+
+        self.slotdir.mkdir(parents=True, exist_ok=True)
+        self.manifestdir.mkdir(exist_ok=True)
+        self.storedir.mkdir(exist_ok=True)
+
+    def ensure_slot(self, name: str) -> Path:
+        '''Fetch a slot from the backend'''
+        slot = self.slotdir / name
+        if not slot.is_dir():
+            log.info("Creating missing directory %s", slot)
+            slot.mkdir()
+        return slot
+
+    def store_lock(self) -> FileLock:
+        '''Lock of the chunk store, so that chunks are not collected while a snapshot is written'''
+        return FileLock(str(self.storedir / '.lock'))
+
+    @staticmethod
+    def walk(slot: Path) -> Iterator[dict]:
+        '''Return the entries of the manifest of a slot (without the chunks of the files)'''
+        for root, dirs, files in os.walk(str(slot)):
+            dirs.sort()
+            names = [(name, True) for name in dirs] + [(name, False) for name in sorted(files)]
+            for name, is_dir in names:
+                path = os.path.join(root, name)
+                info = os.lstat(path)
+                entry = {
+                    'path': os.path.relpath(path, str(slot)),
+                    'mode': info.st_mode & 0o7777,
+                    'uid': info.st_uid,
+                    'gid': info.st_gid,
+                    'mtime': info.st_mtime,
+                }
+                if stat.S_ISLNK(info.st_mode):
+                    entry.update(type='symlink', target=os.readlink(path))
+                elif is_dir:
+                    entry.update(type='directory')
+                elif stat.S_ISREG(info.st_mode):
+                    entry.update(type='file', size=info.st_size)
+                else:
+                    log.debug("Skipping %s: not a regular file, directory or symlink", path)
+                    continue
+                yield entry
+
+    @staticmethod
+    def batches(files: List[dict]) -> Iterator[List[dict]]:
+        '''Group the files in batches of about `BATCH_SIZE` bytes, so that small files do not cost
+        a task each
+        '''
+        batch, size = [], 0
+        for entry in files:
+            batch.append(entry)
+            size += entry['size']
+            if size >= BATCH_SIZE:
+                yield batch
+                batch, size = [], 0
+        if batch:
+            yield batch
+
+    def previous_files(self, slot: Path) -> Dict[str, dict]:
+        '''Return the file entries of the last manifest of a slot, by path'''
+        manifests = [snapshot for snapshot in self.list_snapshots() if snapshot.slot == slot.name]
+        if not manifests:
+            return {}
+        last = max(manifests, key=lambda snapshot: snapshot.time)
+        data = json.loads(last.path.read_text(encoding='utf-8'))
+        return {entry['path']: entry for entry in data['entries'] if entry['type'] == 'file'}
+
+    def snapshot(self, slot: Path):
+        '''Store the files of a slot in the chunk store, and write the manifest of the snapshot.
+        The files with the same size and time as in the previous manifest of the slot are not read again.
+        '''
+        start = time.time()
+        now = datetime.now().astimezone()
+        manifest = self.manifestdir / f"{slot.name}-{now.strftime(TIME_FORMAT)}.json"
+        # The manifests are named to the second
+        if manifest.exists():
+            raise BackendError(f"Cannot snapshot {slot}: snapshot {manifest.name} already exists")
+        entries = list(self.walk(slot))
+        files = [entry for entry in entries if entry['type'] == 'file']
+        stats = {'files': len(files), 'bytes': 0, 'chunks': 0, 'new_chunks': 0, 'stored_bytes': 0,
+            'unchanged_files': 0, 'skipped_files': 0}
+        with self.store_lock():
+            # The chunks of the previous manifest cannot be collected while the store is locked
+            previous = self.previous_files(slot)
+            changed = []
+            for entry in files:
+                old = previous.get(entry['path'])
+                if old and old['size'] == entry['size'] and old['mtime'] == entry['mtime']:
+                    entry.update(sha256=old['sha256'], chunks=old['chunks'])
+                    stats['bytes'] += entry['size']
+                    stats['chunks'] += len(entry['chunks'])
+                    stats['unchanged_files'] += 1
+                else:
+                    changed.append(entry)
+            store = ChunkStore(self.storedir, self.pack_size)
+            try:
+                with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                    batches = list(self.batches(changed))
+                    results = executor.map(partial(chunk_files, min_size=self.chunk_sizes[0],
+                        average_size=self.chunk_sizes[1], max_size=self.chunk_sizes[2]),
+                        [[str(slot / entry['path']) for entry in batch] for batch in batches])
+                    # The chunks are written by this process only, while the workers chunk the next batches
+                    for batch, chunks in zip(batches, results):
+                        self.store_batch(store, slot, batch, chunks, stats)
+            finally:
+                store.close()
+            skipped = {id(entry) for entry in files if 'chunks' not in entry}
+            entries = [entry for entry in entries if id(entry) not in skipped]
+            tmp = manifest.with_suffix('.partial')
+            tmp.write_text(json.dumps({'slot': slot.name, 'time': now.isoformat(), 'entries': entries}),
+                encoding='utf-8')
+            # Unlike a rename, a link never replaces an existing manifest
+            try:
+                os.link(str(tmp), str(manifest))
+            except FileExistsError as err:
+                raise BackendError(f"Cannot snapshot {slot}: snapshot {manifest.name} already exists") from err
+            finally:
+                tmp.unlink()
+        seconds = time.time() - start
+        stats['seconds'] = seconds
+        stats['rate'] = stats['bytes'] / seconds if seconds else 0.0
+        log.info("Snapshot %s: %d bytes in %d chunks (%d new, %d bytes stored) in %.1fs",
+            manifest.name, stats['bytes'], stats['chunks'], stats['new_chunks'], stats['stored_bytes'], seconds)
+        self.snapshot_stats[slot] = {
+            **{f"ingest_{key}": value for key, value in stats.items()},
+            'dedup_ratio': 1 - stats['stored_bytes'] / stats['bytes'] if stats['bytes'] else 0.0,
+        }
+
+    def store_batch(self, store: ChunkStore, slot: Path, batch: List[dict], chunks: list, stats: dict):
+        '''Add the chunks of a batch of files missing from the store, and their digests to the entries.
+        The files that cannot be stored are left without chunks.
+        '''
+        missing = store.missing({digest for result in chunks if result for digest, _ in result[1]})
+        for entry, result in zip(batch, chunks):
+            if not self.store_file(store, slot / entry['path'], entry, result, missing, stats):
+                stats['skipped_files'] += 1
+
+    def store_file(self, store: ChunkStore, path: Path, entry: dict, result: Optional[tuple],
+        missing: Set[str], stats: dict) -> bool:
+        '''Add the chunks of a file missing from the store, and its digests to its entry.
+        A file changing while its chunks are stored is chunked again, and skipped if it keeps changing.
+        :param result: The digest and chunks of the file, or None if it was removed.
+        :param missing: The digests of the chunks missing from the store, updated with the chunks added.
+        :return: False if the file was skipped.
+        '''
+        # Size and time of the file before it was read
+        state = (entry['size'], entry['mtime'])
+        for attempt in range(CHANGED_RETRIES + 1):
+            if attempt > 0:
+                log.info("%s changed during the snapshot, reading it again", path)
+                try:
+                    state = self.file_state(path)
+                    result = chunk_file(str(path), *self.chunk_sizes)
+                except FileNotFoundError:
+                    result = None
+                else:
+                    missing.update(store.missing({digest for digest, _ in result[1]}))
+            if result is None:
+                log.warning("Skipping %s: removed during the snapshot", path)
+                return False
+            file_digest, file_chunks = result
+            try:
+                self.add_chunks(store, path, file_chunks, missing, stats)
+                # Only the chunks missing from the store are compared to the file
+                if self.file_state(path) != state or sum(length for _, length in file_chunks) != state[0]:
+                    continue
+            except FileNotFoundError:
+                log.warning("Skipping %s: removed during the snapshot", path)
+                return False
+            except FileChangedError:
+                continue
+            entry['sha256'] = file_digest
+            entry['chunks'] = [digest for digest, _ in file_chunks]
+            entry['size'], entry['mtime'] = state
+            stats['bytes'] += entry['size']
+            stats['chunks'] += len(file_chunks)
+            return True
+        log.warning("Skipping %s: changed during the snapshot %d times", path, CHANGED_RETRIES + 1)
+        return False
+
+    @staticmethod
+    def file_state(path: Path) -> tuple:
+        '''Return the size and modification time of a file, to check if it changed'''
+        info = os.stat(str(path))
+        return info.st_size, info.st_mtime
+
+    @staticmethod
+    def add_chunks(store: ChunkStore, path: Path, file_chunks: List[tuple], missing: Set[str], stats: dict):
+        '''Add the chunks of a file missing from the store
+        :raises FileChangedError: The data of the file does not match its chunks anymore.
+        '''
+        if not missing.intersection(digest for digest, _ in file_chunks):
+            return
+        with open(str(path), 'rb') as stream:
+            for digest, length in file_chunks:
+                data = stream.read(length)
+                if digest in missing:
+                    if hashlib.sha256(data).hexdigest() != digest:
+                        raise FileChangedError(f"{path} changed during the snapshot")
+                    store.add(digest, data)
+                    missing.remove(digest)
+                    stats['new_chunks'] += 1
+                    stats['stored_bytes'] += length
+
+    def slot_metrics(self, slots: List[Path]) -> Dict[Path, dict]:
+        '''Return the ingest and deduplication statistics of the last snapshot of the slots'''
+        return {slot: self.snapshot_stats[slot] for slot in slots if slot in self.snapshot_stats}
+
+    def list_snapshots(self) -> List[Snapshot]:
+        '''List the manifests of the snapshots'''
+        snapshots = []
+        for path in self.manifestdir.iterdir():
+            match = MANIFEST_NAME.match(path.name)
+            if not match:
+                log.debug("Ignoring %s: not a manifest name", path)
+                continue
+            snapshot_time = datetime.strptime(match.group('time'), TIME_FORMAT)
+            snapshots.append(Snapshot(slot=match.group('slot'), path=path, time=snapshot_time))
+        return snapshots
+
+    def snapshot_files(self, snapshot: Snapshot) -> Iterator[dict]:
+        '''Return the regular files of a snapshot, from its manifest'''
+        data = json.loads(snapshot.path.read_text(encoding='utf-8'))
+        for entry in data['entries']:
+            if entry['type'] == 'file':
+                yield {key: entry[key] for key in ['path', 'size', 'mtime', 'sha256']}
+
+    @staticmethod
+    def manifest_chunks(manifest: Path) -> Set[str]:
+        '''Return the chunks referenced by a manifest'''
+        data = json.loads(manifest.read_text(encoding='utf-8'))
+        return {digest for entry in data['entries'] for digest in entry.get('chunks', [])}
+
+    def destroy_snapshots(self, snapshots: List[Path]):
+        '''Remove some manifests, and the chunks no other manifest references'''
+        with self.store_lock():
+            for snapshot in snapshots:
+                if snapshot.parent != self.manifestdir:
+                    raise BackendError(f"Cannot destroy {snapshot}: not a snapshot of {self.manifestdir}")
+                log.info("Removing snapshot %s", snapshot)
+                snapshot.unlink()
+            referenced = set()
+            for snapshot in self.list_snapshots():
+                referenced |= self.manifest_chunks(snapshot.path)
+            store = ChunkStore(self.storedir, self.pack_size)
+            try:
+                freed = store.collect(referenced)
+            finally:
+                store.close()
+        log.info("Freed %d bytes of unreferenced packs", freed)
+
+    @contextmanager
+    def open_snapshot(self, snapshot: Snapshot) -> Iterator[Path]:
+        '''Extract the files of a snapshot in a staging directory, removed at the end of the context'''
+        self.stagingdir.mkdir(exist_ok=True)
+        staging = Path(tempfile.mkdtemp(prefix=f"{snapshot.slot}-", dir=str(self.stagingdir)))
+        try:
+            log.info("Extracting snapshot %s to %s", snapshot.path, staging)
+            self.extract(snapshot.path, staging)
+            yield staging
+        finally:
+            log.debug("Removing staging directory %s", staging)
+            shutil.rmtree(str(staging))
+
+    def extract(self, manifest: Path, destination: Path):
+        '''Write the files of a snapshot in a directory'''
+        data = json.loads(manifest.read_text(encoding='utf-8'))
+        destination.mkdir(parents=True, exist_ok=True)
+        store = ChunkStore(self.storedir, self.pack_size)
+        try:
+            for entry in data['entries']:
+                path = destination / entry['path']
+                if entry['type'] == 'directory':
+                    path.mkdir(exist_ok=True)
+                elif entry['type'] == 'symlink':
+                    os.symlink(entry['target'], str(path))
+                else:
+                    with open(str(path), 'wb') as stream:
+                        for digest in entry['chunks']:
+                            stream.write(store.read(digest))
+                try:
+                    os.chown(str(path), entry['uid'], entry['gid'], follow_symlinks=False)
+                except PermissionError:
+                    log.debug("Cannot change the owner of %s", path)
+        finally:
+            store.close()
+        # Writing in the directories changes their times (and may need their permissions), so they are set last
+        for entry in reversed(data['entries']):
+            if entry['type'] != 'symlink':
+                path = str(destination / entry['path'])
+                os.chmod(path, entry['mode'])
+                os.utime(path, (entry['mtime'], entry['mtime']))
@@ -1,14 +1,23 @@
 '''Local filesystem backend'''
 
+import re
+import shutil
 from datetime import datetime
 from logging import getLogger
-from typing import Optional
+from pathlib import Path
+from typing import Dict, List, Optional
 
-from hazelsync.backend import Backend
+from hazelsync.backend import Backend, BackendError, Snapshot
+from hazelsync.settings import SettingError
 from hazelsync.utils.rsync import rsync_run, RsyncError
+from hazelsync.utils.tree import hardlink, link_tree, reflink, reflink_supported
 
 log = getLogger('hazelsync')
 
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+SNAPSHOT_NAME = re.compile(r'^(?P<slot>.+)-(?P<time>\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})$')
+SNAPSHOT_MODES = ['hardlink', 'reflink', 'rsync']
+
 class LocalfsBackend(Backend):
     '''Local filesystem backend for backups. Mainly there for testing and demonstration
     purpose.
@@ -16,19 +25,33 @@ class LocalfsBackend(Backend):
     def __init__(self,
         name: str,
         path: Optional[str] = None,
-        basedir: Optional[str] = None
+        basedir: Optional[str] = None,
+        snapshot_mode: str = 'hardlink',
+        snapshot_workers: int = 8,
     ):
+        '''
+        :param snapshot_mode: How the snapshots are made: `hardlink` to link the files of the slot
+            with several threads, `reflink` to clone them (on btrfs, XFS...), falling back to hard
+            links when the filesystem cannot, or `rsync` to run `rsync --link-dest`.
+        :param snapshot_workers: The number of directories processed at the same time in `hardlink`
+            and `reflink` modes.
+        '''
+        if snapshot_mode not in SNAPSHOT_MODES:
+            raise SettingError('snapshot_mode', f"Unsupported snapshot mode {snapshot_mode}, should be one of {SNAPSHOT_MODES}")
+        self.snapshot_mode = snapshot_mode
+        self.snapshot_workers = snapshot_workers
+        self.snapshot_stats = {}
+        self.reflink = None
         if path:
-            self.slotdir = path / 'slots'
+            self.slotdir = Path(path) / 'slots'
         elif basedir:
-            self.slotdir = basedir / name / 'slots'
+            self.slotdir = Path(basedir) / name / 'slots'
         else:
             raise AttributeError("localfs backend need at least one of the following argument: path or basedir")
-        self.slotdir = basedir / 'slots'
-        self.snapshotdir = basedir / 'snapshots'
+        self.snapshotdir = self.slotdir.parent / 'snapshots'
 
         # Ensure directories
-        self.slotdir.mkdir(exist_ok=True)
+        self.slotdir.mkdir(parents=True, exist_ok=True)
         self.snapshotdir.mkdir(exist_ok=True)
 
     def ensure_slot(self, name):
@@ -40,17 +63,67 @@ class LocalfsBackend(Backend):
         return slot
 
     def snapshot(self, slot):
-        '''Create a snapshot. Will use rsync with hardlink mode to improve data efficiency.
+        '''Create a snapshot, made of hard links to the files of the slot to improve data efficiency.
         '''
         now = datetime.now().astimezone()
-        snapshot_name = slot.name + '-' + now.strftime('%Y-%m-%dT%H:%M:%s')
+        snapshot_name = slot.name + '-' + now.strftime(TIME_FORMAT)
         mysnapshot = self.snapshotdir / snapshot_name
+        if self.snapshot_mode == 'rsync':
+            try:
+                rsync_run(
+                    source=slot,
+                    destination=mysnapshot,
+                    options=['--link-dest', str(slot)],
+                )
+            except RsyncError as err:
+                log.error("Snapshot %s failed: %s", snapshot_name, err)
+                raise err
+            return
         try:
-            rsync_run(
-                source=slot,
-                destination=mysnapshot,
-                options=['--link-dest', str(slot)],
-            )
-        except RsyncError as err:
+            stats = link_tree(slot, mysnapshot, self.snapshot_workers, self.link_function())
+        except OSError as err:
             log.error("Snapshot %s failed: %s", snapshot_name, err)
+            shutil.rmtree(mysnapshot, ignore_errors=True)
             raise err
+        log.info("Snapshot %s: linked %d files in %.1fs (%.0f files/s)",
+            snapshot_name, stats['files'], stats['seconds'], stats['rate'])
+        self.snapshot_stats[slot] = {f"snapshot_{key}": value for key, value in stats.items()}
+
+    def link_function(self):
+        '''Return the function copying the files of a slot to a snapshot'''
+        if self.snapshot_mode == 'reflink':
+            if self.reflink is None:
+                self.reflink = reflink_supported(self.slotdir, self.snapshotdir)
+                if not self.reflink:
+                    log.warning("Filesystem of %s does not support reflinks, snapshotting with hard links", self.slotdir)
+            if self.reflink:
+                return reflink
+        return hardlink
+
+    def list_snapshots(self) -> List[Snapshot]:
+        '''List the snapshot directories of the slots'''
+        snapshots = []
+        for path in self.snapshotdir.iterdir():
+            match = SNAPSHOT_NAME.match(path.name)
+            if not match:
+                log.debug("Ignoring %s: not a snapshot name", path)
+                continue
+            time = datetime.strptime(match.group('time'), TIME_FORMAT)
+            snapshots.append(Snapshot(slot=match.group('slot'), path=path, time=time))
+        return snapshots
+
+    def snapshot_directory(self, snapshot: Snapshot) -> Path:
+        '''Return the directory of a snapshot'''
+        return snapshot.path
+
+    def destroy_snapshots(self, snapshots: List[Path]):
+        '''Remove some snapshot directories'''
+        for snapshot in snapshots:
+            if snapshot.parent != self.snapshotdir:
+                raise BackendError(f"Cannot destroy {snapshot}: not a snapshot of {self.snapshotdir}")
+            log.info("Removing snapshot %s", snapshot)
+            shutil.rmtree(snapshot)
+
+    def slot_metrics(self, slots: List[Path]) -> Dict[Path, dict]:
+        '''Return the statistics of the last snapshot of the slots'''
+        return {slot: self.snapshot_stats[slot] for slot in slots if slot in self.snapshot_stats}
@@ -3,12 +3,16 @@
 from datetime import datetime
 from logging import getLogger
 from pathlib import Path
+from typing import Dict, List, Optional
 
-from hazelsync.backend import Backend
+from hazelsync.backend import Backend, Snapshot
+from hazelsync.settings import SettingError
 from hazelsync.utils.zfs import *  # pylint: disable=wildcard-import,unused-wildcard-import
 
 log = getLogger('hazelsync')
 
+ENGINES = ['cli', 'program']
+
 class ZfsBackend(Backend):
     '''Local filesystem backend for backups. Mainly there for testing and demonstration
     purpose.
@@ -17,7 +21,27 @@ class ZfsBackend(Backend):
         name: str,
         path: str = None,
         basedir: str = None,
+        engine: str = 'cli',
+        properties: Optional[dict] = None,
+        replication: Optional[dict] = None,
     ):
+        '''
+        :param engine: `cli` to run the zfs commands, or `program` to run the bulk operations
+            in channel programs (falling back to the zfs commands if they fail).
+        :param properties: ZFS properties to set on the dataset of the cluster (inherited by the slots).
+        :param replication: Where to copy the snapshots of the slots after each backup: a `dataset`
+            (receiving the slots as children) or a `directory` (receiving stream files), and the
+            `buffer_size` between send and receive.
+        '''
+        if engine not in ENGINES:
+            raise SettingError(name, f"zfs engine should be one of {ENGINES}, got {engine}")
+        self.engine = engine
+        self.properties = properties or {}
+        # Properties of the datasets and snapshots of the cluster, by name
+        self.inventory = {}
+        self.replication = replication
+        if replication and len([key for key in ['dataset', 'directory'] if replication.get(key)]) != 1:
+            raise SettingError(name, "zfs replication needs a target dataset or directory (but not both)")
         if basedir:
             self.slotdir = Path(basedir) / name
         elif path:
@@ -25,13 +49,43 @@ class ZfsBackend(Backend):
         else:
             raise AttributeError("zfs backend need at least one of the following arguments: path or basedir")
         self.ensure_cluster()
-        self.datasets = zfs_list(self.slotdir)
+
+    def run(self, program, command, *args):
+        '''Run a ZFS operation with the channel program function when the engine is `program`,
+        and with the command function otherwise, or when the channel program failed.
+        '''
+        if self.engine == 'program':
+            try:
+                return program(*args)
+            except ZfsError as err:
+                log.warning("ZFS channel program failed, using zfs commands instead: %s", err)
+                self.engine = 'cli'
+        return command(*args)
 
     def ensure_cluster(self):
-        '''Ensure the cluster has its dataset created with the proper settings'''
+        '''Ensure the cluster has its dataset created with the proper settings, and load its inventory'''
         if not self.slotdir.is_dir():
             log.info("Creating missing dataset %s", self.slotdir)
-            zfs_create(self.slotdir)
+            zfs_create(self.slotdir, self.properties)
+        self.load_inventory()
+
+    def load_inventory(self):
+        '''Load the properties of all the datasets and snapshots of the cluster (in a single command),
+        and ensure the properties of the cluster dataset
+        '''
+        self.inventory = self.run(zfs_program_inventory, zfs_inventory, self.slotdir, list(self.properties))
+        # Channel programs can only set user properties, so the properties are set with zfs commands
+        for key, value in self.properties.items():
+            zfs_ensure(str(self.slotdir)[1:], key, str(value), self.inventory)
+
+    @property
+    def datasets(self) -> Dict[Path, dict]:
+        '''The datasets of the inventory, by mount point'''
+        return {
+            Path(values['mountpoint']): {'name': name, **values}
+            for name, values in self.inventory.items()
+            if values.get('type') == 'filesystem'
+        }
 
     def ensure_slot(self, name: str) -> Path:
         '''Ensure a given slot has its dataset created and return its path'''
@@ -39,19 +93,144 @@ class ZfsBackend(Backend):
         if slot not in self.datasets:
             log.info("Creating missing dataset %s", slot)
             zfs_create(slot)
+            self.inventory[str(slot)[1:]] = {'type': 'filesystem', 'mountpoint': str(slot)}
         return slot
 
+    def slot_metrics(self, slots: List[Path]) -> Dict[Path, dict]:
+        '''Return the space used and referenced by the dataset of each slot, and the space written
+        since the previous snapshot by its last snapshot, from a fresh inventory
+        '''
+        self.load_inventory()
+        snapshots = {}
+        for name, values in self.inventory.items():
+            if values.get('type') == 'snapshot':
+                dataset = name.split('@')[0]
+                if dataset not in snapshots or values['creation'] > snapshots[dataset]['creation']:
+                    snapshots[dataset] = values
+        metrics = {}
+        for slot in slots:
+            name = str(slot)[1:]
+            if name not in self.inventory:
+                continue
+            values = self.inventory[name]
+            metrics[slot] = {'space_used': values['used'], 'space_referenced': values['referenced']}
+            if name in snapshots:
+                metrics[slot]['space_written'] = snapshots[name]['written']
+        return metrics
+
     def snapshot(self, slot: Path):
         '''Create a ZFS snapshot.
         '''
-        if self.slotdir not in slot.parents:
-            raise Exception(f"Cannot snapshot {slot}: not a sub-directory of {self.slotdir}")
-        log.info("Running ZFS snapshot for %s", slot.name)
+        self.snapshot_many([slot])
+
+    def snapshot_many(self, slots: List[Path]):
+        '''Create the ZFS snapshots of several slots with a single command, so that they
+        are taken at the same point in time and share their name.
+        '''
+        if not slots:
+            return
+        for slot in slots:
+            if self.slotdir not in slot.parents:
+                raise Exception(f"Cannot snapshot {slot}: not a sub-directory of {self.slotdir}")
+        log.info("Running ZFS snapshot for %s", ', '.join(slot.name for slot in slots))
         now = datetime.now().astimezone()
-        snapshot_name = slot.name + '@' + now.strftime('%Y-%m-%dT%H:%M:%S')
-        mysnapshot = self.slotdir / snapshot_name
+        snapshots = [self.slotdir / (slot.name + '@' + now.strftime('%Y-%m-%dT%H:%M:%S')) for slot in slots]
         try:
-            zfs_snapshot(mysnapshot)
+            self.run(zfs_program_snapshots, zfs_snapshots, snapshots)
         except ZfsError as err:
-            log.error("Snapshot %s failed: %s", mysnapshot, err)
+            log.error("Snapshots %s failed: %s", ', '.join(map(str, snapshots)), err)
             raise err
+
+    def list_snapshots(self) -> List[Snapshot]:
+        '''List the ZFS snapshots of the slots'''
+        snapshots = self.run(zfs_program_list_snapshots, zfs_list_snapshots, self.slotdir)
+        return [
+            Snapshot(slot=path.name.split('@')[0], path=path, time=time)
+            for path, time in snapshots
+            if path.parent == self.slotdir
+        ]
+
+    def snapshot_directory(self, snapshot: Snapshot) -> Path:
+        '''Return the directory of a snapshot in the hidden `.zfs` directory of its dataset'''
+        dataset, name = snapshot.path.name.split('@')
+        return snapshot.path.parent / dataset / '.zfs' / 'snapshot' / name
+
+    def destroy_snapshots(self, snapshots: List[Path]):
+        '''Destroy some snapshots of the slots'''
+        if not snapshots:
+            return
+        log.info("Destroying ZFS snapshots %s", ', '.join(snapshot.name for snapshot in snapshots))
+        self.run(zfs_program_destroy, zfs_destroy, snapshots)
+
+    def replicate(self, slots: List[Path]) -> Dict[Path, dict]:
+        '''Send the last snapshot of each slot to the replication target, incrementally from
+        the last snapshot already there. A failed replication does not fail the backup,
+        it is only reported in the statistics.
+        '''
+        if not self.replication:
+            return {}
+        results = {}
+        for slot in slots:
+            try:
+                stats = self.replicate_slot(slot)
+            except (ZfsError, OSError) as err:
+                log.error("Replication of %s failed: %s", slot, err)
+                results[slot] = {'replication_failed': 1}
+                continue
+            results[slot] = {f"replication_{key}": value for key, value in stats.items()}
+        return results
+
+    def replicate_slot(self, slot: Path) -> dict:
+        '''Send the last snapshot of a slot to the replication target, and return the throughput'''
+        dataset = str(slot)[1:]
+        snapshots = zfs_snapshot_names(dataset)
+        if not snapshots:
+            return {}
+        latest = snapshots[-1]
+        buffer_size = self.replication.get('buffer_size', BUFFER_SIZE)
+        stats = []
+        if self.replication.get('dataset'):
+            target = f"{self.replication['dataset']}/{slot.name}"
+            receive = ['zfs', 'receive', '-s', '-u', '-F', target]
+            token = zfs_resume_token(target)
+            if token:
+                log.info("Resuming the interrupted replication of %s", slot)
+                stats.append(zfs_pipe(['zfs', 'send', '-t', token], receive, buffer_size=buffer_size))
+            replicated = zfs_snapshot_names(target)
+        else:
+            receive = None
+            directory = Path(self.replication['directory'])
+            directory.mkdir(parents=True, exist_ok=True)
+            # Stream files are named <slot>@<snapshot>.zfs, or <slot>@<base>+<snapshot>.zfs when incremental
+            replicated = [
+                path.name[len(slot.name)+1:-len('.zfs')].split('+')[-1]
+                for path in directory.glob(f"{slot.name}@*.zfs")
+            ]
+        if latest in replicated:
+            return merge_throughput(stats)
+        bases = [snapshot for snapshot in snapshots[:-1] if snapshot in replicated]
+        base = bases[-1] if bases else None
+        send = ['zfs', 'send', *(['-i', f"{dataset}@{base}"] if base else []), f"{dataset}@{latest}"]
+        log.info("Replicating %s@%s (%s)", slot, latest, f"incremental from {base}" if base else 'full')
+        if receive:
+            stats.append(zfs_pipe(send, receive, buffer_size=buffer_size))
+        else:
+            name = f"{slot.name}@{base}+{latest}.zfs" if base else f"{slot.name}@{latest}.zfs"
+            partial = directory / f".{name}.partial"
+            try:
+                stats.append(zfs_pipe(send, output=partial, buffer_size=buffer_size))
+                partial.rename(directory / name)
+            except (ZfsError, OSError):
+                # An incomplete stream cannot be received, and takes the space of the next attempt
+                if partial.exists():
+                    partial.unlink()
+                raise
+        return merge_throughput(stats)
+
+def merge_throughput(stats: List[dict]) -> dict:
+    '''Merge the throughput of several streams'''
+    if not stats:
+        return {}
+    transferred = sum(stat['bytes'] for stat in stats)
+    seconds = sum(stat['seconds'] for stat in stats)
+    return {'bytes': transferred, 'seconds': seconds, 'rate': round(transferred / seconds, 1) if seconds else 0}
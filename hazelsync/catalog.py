@@ -0,0 +1,221 @@
+'''Catalog of the files of the snapshots'''
+
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from logging import getLogger
+from pathlib import Path
+from typing import List, Optional
+
+import dateutil.parser
+
+from hazelsync.backend import Backend, Snapshot
+
+CATALOG_DIRECTORY = Path('/var/lib/hazelsync/catalogs')
+# Number of files hashed at the same time
+HASH_WORKERS = 4
+
+log = getLogger('hazelsync')
+
+TABLES = '''
+CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY AUTOINCREMENT, slot TEXT, path TEXT UNIQUE, time TEXT);
+CREATE TABLE IF NOT EXISTS files (slot TEXT, path TEXT, size INTEGER, mtime REAL, sha256 TEXT,
+    first INTEGER, until INTEGER, reversed_path TEXT);
+'''
+# The paths are also indexed reversed, for the patterns starting with a wildcard (like `*.conf`)
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS files_current ON files (slot, until);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+CREATE INDEX IF NOT EXISTS files_reversed_path ON files (reversed_path);
+'''
+WILDCARDS = '*?['
+
+def file_sha256(path: str) -> str:
+    '''Return the sha256 of a file'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as stream:
+        for block in iter(lambda: stream.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def reverse_glob(pattern: str) -> str:
+    '''Reverse a glob pattern, so that it matches the reversed strings.
+    The character classes (like `[a-z]`) are kept in one piece.
+    '''
+    tokens = []
+    i = 0
+    while i < len(pattern):
+        end = i + 1
+        if pattern[i] == '[':
+            # A `]` right after the opening `[` (or `[^`) is part of the class
+            end = pattern.find(']', i + (3 if pattern[i + 1:i + 2] == '^' else 2))
+            end = len(pattern) if end == -1 else end + 1
+        tokens.append(pattern[i:end])
+        i = end
+    return ''.join(reversed(tokens))
+
+@dataclass
+class FileVersion:
+    '''A version of a file, and the snapshots it is in'''
+    slot: str
+    path: str
+    size: int
+    mtime: float
+    sha256: str
+    snapshots: List[Snapshot]
+
+class Catalog:
+    '''A catalog of the files of the snapshots of a cluster, in a sqlite database.
+    Each version of a file is stored once, with the range of snapshots of its slot it is in
+    (from the snapshot where it appeared to the one where it changed or was removed), so adding
+    a snapshot only stores the differences with the previous snapshot of the slot.
+    '''
+    directory = CATALOG_DIRECTORY
+
+    def __init__(self, cluster: str):
+        '''
+        :param cluster: The name of the cluster.
+        '''
+        self.cluster = cluster
+        self.path = self.directory / f"{cluster}.sqlite"
+
+    def exists(self) -> bool:
+        '''Check if the catalog was built'''
+        return self.path.exists()
+
+    def connect(self) -> sqlite3.Connection:
+        '''Open the database of the catalog'''
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(str(self.path))
+        db.executescript(TABLES)
+        columns = [row[1] for row in db.execute('PRAGMA table_info(files)')]
+        if 'reversed_path' not in columns:
+            log.info("Adding the reversed paths to the catalog %s", self.path)
+            db.create_function('reverse', 1, lambda text: text[::-1])
+            db.execute('ALTER TABLE files ADD COLUMN reversed_path TEXT')
+            db.execute('UPDATE files SET reversed_path = reverse(path)')
+            db.commit()
+        db.executescript(INDEXES)
+        return db
+
+    def update(self, backend: Backend) -> int:
+        '''Add the snapshots of a backend missing from the catalog, and forget the ones
+        destroyed since the last update
+        :return: The number of snapshots added.
+        '''
+        snapshots = backend.list_snapshots()
+        db = self.connect()
+        try:
+            self.forget(db, {str(snapshot.path) for snapshot in snapshots})
+            known = {row[0] for row in db.execute('SELECT path FROM snapshots')}
+            added = 0
+            for snapshot in sorted(snapshots, key=lambda snapshot: snapshot.time):
+                if str(snapshot.path) in known:
+                    continue
+                last = db.execute('SELECT MAX(time) FROM snapshots WHERE slot = ?', (snapshot.slot,)).fetchone()[0]
+                if last is not None and snapshot.time.isoformat() <= last:
+                    log.warning("Not cataloging %s: older than the last snapshot cataloged", snapshot.path)
+                    continue
+                self.add(db, backend, snapshot)
+                added += 1
+        finally:
+            db.close()
+        return added
+
+    @staticmethod
+    def add(db: sqlite3.Connection, backend: Backend, snapshot: Snapshot):
+        '''Add a snapshot, storing the files changed since the previous snapshot of its slot'''
+        current = {
+            path: (rowid, size, mtime, sha256)
+            for rowid, path, size, mtime, sha256 in db.execute(
+                'SELECT rowid, path, size, mtime, sha256 FROM files WHERE slot = ? AND until IS NULL', (snapshot.slot,))
+        }
+        snapshot_id = db.execute('INSERT INTO snapshots (slot, path, time) VALUES (?, ?, ?)',
+            (snapshot.slot, str(snapshot.path), snapshot.time.isoformat())).lastrowid
+        changed = []
+        closed = []
+        seen = set()
+        for entry in backend.snapshot_files(snapshot):
+            seen.add(entry['path'])
+            old = current.get(entry['path'])
+            if old is not None:
+                _, size, mtime, sha256 = old
+                if size == entry['size'] and mtime == entry['mtime'] and entry.get('sha256', sha256) == sha256:
+                    continue
+                closed.append(old[0])
+            changed.append(entry)
+        removed = [old[0] for path, old in current.items() if path not in seen]
+        closed += removed
+        # Only the new and changed files are hashed
+        to_hash = [entry for entry in changed if 'sha256' not in entry]
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+            for entry, sha256 in zip(to_hash, executor.map(file_sha256, [entry['source'] for entry in to_hash])):
+                entry['sha256'] = sha256
+        for i in range(0, len(closed), 500):
+            batch = closed[i:i + 500]
+            db.execute(f"UPDATE files SET until = ? WHERE rowid IN ({','.join('?' * len(batch))})", [snapshot_id, *batch])
+        db.executemany('''INSERT INTO files (slot, path, size, mtime, sha256, first, until, reversed_path)
+            VALUES (?, ?, ?, ?, ?, ?, NULL, ?)''', [
+            (snapshot.slot, entry['path'], entry['size'], entry['mtime'], entry['sha256'], snapshot_id,
+                entry['path'][::-1])
+            for entry in changed
+        ])
+        db.commit()
+        log.info("Cataloged %s: %d files added or changed, %d removed", snapshot.path, len(changed), len(removed))
+
+    @staticmethod
+    def forget(db: sqlite3.Connection, existing: set):
+        '''Remove the snapshots not existing anymore, and the file versions in none of the
+        remaining snapshots
+        '''
+        destroyed = [(snapshot_id, slot) for snapshot_id, slot, path in db.execute('SELECT id, slot, path FROM snapshots')
+            if path not in existing]
+        if not destroyed:
+            return
+        db.executemany('DELETE FROM snapshots WHERE id = ?', [(snapshot_id,) for snapshot_id, _ in destroyed])
+        db.execute('''DELETE FROM files WHERE NOT EXISTS (SELECT 1 FROM snapshots
+            WHERE snapshots.slot = files.slot AND snapshots.id >= files.first
+            AND (files.until IS NULL OR snapshots.id < files.until))''')
+        # The files removed in a destroyed snapshot are current again if it was the last one of its slot
+        for slot in {slot for _, slot in destroyed}:
+            db.execute('''UPDATE files SET until = NULL WHERE slot = ? AND until IS NOT NULL
+                AND until > (SELECT MAX(id) FROM snapshots WHERE slot = ?)''', (slot, slot))
+        db.commit()
+        log.info("Removed %d destroyed snapshots from the catalog", len(destroyed))
+
+    def find(self, pattern: str, slot: Optional[str] = None) -> List[FileVersion]:
+        '''Return the versions of the files matching a glob pattern (on their path in the slot),
+        and the snapshots they are in.
+        The patterns starting with a wildcard are matched on the reversed paths, so that the index
+        is used when they end with a fixed string (like `*.conf` or `*/hosts`).
+        :param slot: Only search the snapshots of a slot.
+        '''
+        db = self.connect()
+        try:
+            # The unary + keeps sqlite from looking up the files by slot instead of by path
+            query = '''SELECT files.slot, files.path, size, mtime, sha256, first, snapshots.path, snapshots.time
+                FROM files JOIN snapshots ON snapshots.slot = +files.slot AND snapshots.id >= files.first
+                AND (files.until IS NULL OR snapshots.id < files.until)'''
+            if pattern and pattern[0] in WILDCARDS and pattern[-1] not in WILDCARDS + ']':
+                query += ' WHERE files.reversed_path GLOB ?'
+                args = [reverse_glob(pattern)]
+            else:
+                query += ' WHERE files.path GLOB ?'
+                args = [pattern]
+            if slot is not None:
+                # Looking up the files by slot is only faster when the index of the paths cannot be used
+                indexed = args[0][:1] not in ['', *WILDCARDS]
+                query += ' AND +files.slot = ?' if indexed else ' AND files.slot = ?'
+                args.append(slot)
+            query += ' ORDER BY files.slot, files.path, first, snapshots.time'
+            versions = {}
+            for slot_name, path, size, mtime, sha256, first, snapshot_path, snapshot_time in db.execute(query, args):
+                key = (slot_name, path, first)
+                if key not in versions:
+                    versions[key] = FileVersion(slot_name, path, size, mtime, sha256, [])
+                versions[key].snapshots.append(Snapshot(slot_name, Path(snapshot_path),
+                    dateutil.parser.isoparse(snapshot_time)))
+        finally:
+            db.close()
+        return list(versions.values())
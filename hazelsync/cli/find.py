@@ -0,0 +1,24 @@
+'''Find files in the snapshots of a cluster'''
+
+from datetime import datetime
+
+import click
+
+from hazelsync.catalog import Catalog
+
+@click.command()
+@click.argument('name')
+@click.argument('pattern')
+@click.option('--slot', '-s', help='Only search the snapshots of a slot')
+def find(name, pattern, slot):
+    '''Find the versions of the files matching a glob PATTERN in the snapshots of a cluster.
+    The pattern matches the path of the files in their slot, like `etc/*.conf` (`*` also matches `/`).
+    '''
+    catalog = Catalog(name)
+    if not catalog.exists():
+        raise click.ClickException(f"No catalog for cluster {name}, set `catalog: true` in its settings")
+    for version in catalog.find(pattern, slot):
+        mtime = datetime.fromtimestamp(version.mtime).strftime('%Y-%m-%dT%H:%M:%S')
+        first, last = version.snapshots[0], version.snapshots[-1]
+        click.echo(f"{version.slot}:{version.path}\t{version.size}\t{mtime}\t{version.sha256[:12]}"
+            f"\t{len(version.snapshots)} snapshots\t{first.path} .. {last.path}")
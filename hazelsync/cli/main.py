@@ -6,7 +6,10 @@ import logging
 import click
 
 from hazelsync.cli.backup import backup
+from hazelsync.cli.prune import prune
+from hazelsync.cli.find import find
 from hazelsync.cli.restore import restore
+from hazelsync.cli.run_all import run_all
 from hazelsync.cli.stream import stream
 from hazelsync.cli.nagios import nagios
 from hazelsync.cluster import Cluster
@@ -26,3 +29,6 @@ cli.add_command(backup)
 cli.add_command(restore)
 cli.add_command(stream)
 cli.add_command(nagios)
+cli.add_command(run_all)
+cli.add_command(prune)
+cli.add_command(find)
@@ -55,7 +55,7 @@ def nagios(clusters, clusterdir, reportdir, days):
     reports = {}
     for cluster_name in clusters:
         try:
-            report = Report.last_report(cluster_name)
+            report = Report.last_report(cluster_name, job_type='backup')
             reports[cluster_name] = report
             display.append(report.to_nagios(days))
             mystatus = STATUS_MAPPING[report.status]
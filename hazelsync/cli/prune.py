@@ -0,0 +1,20 @@
+'''Prune the expired snapshots of a cluster'''
+
+from logging import getLogger
+
+import click
+
+from hazelsync.cli import with_cluster
+
+log = getLogger('hazelsync')
+
+@click.command()
+@click.argument('name')
+@click.option('--dry-run', '-n', is_flag=True, help='Only display the snapshots that would be destroyed')
+def prune(name, dry_run):
+    '''Destroy the snapshots expired according to the retention policy of a cluster'''
+    with with_cluster(name) as cluster:
+        log.debug("Starting prune")
+        expired = cluster.prune(dry_run=dry_run)
+        for snapshot in expired:
+            click.echo(f"{'Would destroy' if dry_run else 'Destroyed'} {snapshot.path}")
@@ -10,9 +10,16 @@ log = getLogger('hazelsync')
 
 @click.command()
 @click.argument('name')
-@click.argument('snapshot')
-def restore(name, snapshot):
-    '''Restore a cluster to a given snapshot'''
+@click.argument('snapshot', default='latest')
+@click.option('--host', '-H', 'hosts', multiple=True, help='Only restore this host (can be repeated)')
+def restore(name, snapshot, hosts):
+    '''Restore the hosts of a cluster from their snapshots taken at or before a given time
+    (like `2021-01-02T03:04:05`), or from their last snapshots (`latest`)
+    '''
     with with_cluster(name) as cluster:
         log.debug("Starting restore")
-        cluster.restore(snapshot)
+        slots = cluster.restore(snapshot, list(hosts) or None)
+        for slot in slots:
+            stats = slot.get('stats', {})
+            click.echo(f"{slot['slot'].name}: {slot['status']} from {slot['snapshot']}"
+                f" ({stats.get('bytes_sent', 0)} bytes in {stats.get('transfer_seconds', 0)}s)")
@@ -0,0 +1,20 @@
+'''Run the backups of all the clusters'''
+
+import sys
+
+import click
+
+from hazelsync.scheduler import Scheduler
+from hazelsync.settings import GlobalSettings, DEFAULT_SETTINGS
+
+@click.command(name='run-all')
+@click.option('--follow', '-f', is_flag=True, help='Keep running and start the backups when they are due')
+def run_all(follow):
+    '''Run the backups of all the clusters due, according to their schedule'''
+    log = GlobalSettings(DEFAULT_SETTINGS).logger()
+    try:
+        scheduler = Scheduler(DEFAULT_SETTINGS)
+        scheduler.run(follow=follow)
+    except Exception as err: # pylint: disable=broad-except
+        log.exception(err)
+        sys.exit(1)
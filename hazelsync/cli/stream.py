@@ -10,8 +10,17 @@ log = getLogger('hazelsync')
 
 @click.command()
 @click.argument('name')
-def stream(name):
+@click.option('--follow', '-f', is_flag=True, help='Keep running and stream the data in a loop')
+@click.option('--interval', '-i', default=60, help='Seconds between two runs in follow mode')
+@click.option('--max-interval', default=600, help='Maximum seconds between two runs when they fail')
+def stream(name, follow, interval, max_interval):
     '''Pull some data to ease the backup speed'''
     with with_cluster(name) as cluster:
         log.info("Running hazel stream for %s", name)
-        cluster.stream()
+        if not follow:
+            cluster.stream()
+            return
+        try:
+            cluster.follow(interval, max_interval)
+        except KeyboardInterrupt:
+            log.info("Stopped hazel stream for %s", name)
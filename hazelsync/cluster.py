@@ -1,13 +1,24 @@
 '''Retrieve a cluster configuration'''
 
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
 from datetime import datetime
 from logging import getLogger, FileHandler, DEBUG, Formatter
 from pathlib import Path
+from typing import Dict, List, Optional
 
+import dateutil.parser
+
+from hazelsync.backend import Snapshot
+from hazelsync.catalog import Catalog
 from hazelsync.metrics import Gauge, Timer
 from hazelsync.plugin import get_plugin
 from hazelsync.reports import Report
-from hazelsync.settings import ClusterSettings
+from hazelsync.retention import Retention
+from hazelsync.settings import ClusterSettings, SettingError
+from hazelsync.utils.logs import ClusterFilter, cluster_context, inherit_cluster
 
 log = getLogger('hazelsync')
 
@@ -19,6 +30,9 @@ PROM_STATUS_MAP = {
     'unknown': 4
 }
 
+# Minimum number of seconds between two progress metrics of the same slot
+PROGRESS_INTERVAL = 10
+
 def merge_statuses(slots) -> str:
     '''Return the general status given a list of slots'''
     if all(slot['status'] == 'failure' for slot in slots):
@@ -33,6 +47,12 @@ def merge_statuses(slots) -> str:
         status = 'unknown'
     return status
 
+def add_stats(slots: list, stats: dict):
+    '''Add some statistics (by slot path) to the statistics of the slots'''
+    for slot in slots:
+        if stats.get(slot['slot']):
+            slot['stats'] = {**slot.get('stats', {}), **stats[slot['slot']]}
+
 class Cluster:
     '''Class used to represent the cluster configuration for backup
     and restore'''
@@ -47,6 +67,9 @@ class Cluster:
         self.backend = get_plugin('backend', backend_type)(name=settings.name, **backend_options)
         self.job = get_plugin('job', job_type)(name=settings.name, **job_options, backend=self.backend)
         self.job_type = job_type
+        self.pipeline_snapshots = settings.pipeline_snapshots
+        self.retention = settings.retention
+        self.catalog = Catalog(settings.name) if settings.catalog else None
 
         # Metrics
         self.engine = settings.globals.metrics
@@ -60,9 +83,56 @@ class Cluster:
         self.metrics['slot_status'] = Gauge('slot_status',
             tags={'action': None, 'cluster': self.name, 'job': self.job_type, 'slot': None},
             desc='Status of each slot', engine=self.engine)
+        self.metrics['transfer_bytes'] = Gauge('transfer_bytes',
+            tags={'action': None, 'cluster': self.name, 'job': self.job_type, 'slot': None},
+            desc='Bytes transferred so far by a running transfer', engine=self.engine)
+        self.metrics['pruned_snapshots'] = Gauge('pruned_snapshots',
+            tags={'action': None, 'cluster': self.name, 'job': self.job_type},
+            desc='Number of snapshots pruned', engine=self.engine)
+        self.metrics['transfer_rate'] = Gauge('transfer_rate',
+            tags={'action': None, 'cluster': self.name, 'job': self.job_type, 'slot': None},
+            desc='Current rate of a running transfer (in bytes/s)', engine=self.engine)
+
+        # Hooks for the jobs supporting them
+        self.action = None
+        self.last_progress = {}
+        if hasattr(self.job, 'on_progress'):
+            self.job.on_progress = self.report_progress
+        if hasattr(self.job, 'bandwidth'):
+            self.job.bandwidth = settings.globals.bandwidth
+
+    def slot_metric(self, key: str) -> Gauge:
+        '''Return the gauge of a per-slot statistic, creating it if needed'''
+        name = f"slot_{key}"
+        if name not in self.metrics:
+            self.metrics[name] = Gauge(name,
+                tags={'action': None, 'cluster': self.name, 'job': self.job_type, 'slot': None},
+                desc=f"Statistic {key} of each slot", engine=self.engine)
+        return self.metrics[name]
 
+    def export_slots(self, slots: list, action: str):
+        '''Export the status and the statistics of each slot to the metrics'''
+        for slot in slots:
+            self.metrics['slot_status'].set(PROM_STATUS_MAP[slot['status']], action=action, slot=slot['slot'])
+            for key, value in slot.get('stats', {}).items():
+                self.slot_metric(key).set(value, action=action, slot=slot['slot'])
+
+    def report_progress(self, slot: Path, progress: dict):
+        '''Send the progress of a running transfer to the metrics'''
+        now = time.monotonic()
+        last = self.last_progress.get(slot)
+        if last is not None and now - last < PROGRESS_INTERVAL:
+            return
+        self.last_progress[slot] = now
+        self.metrics['transfer_bytes'].set(progress['bytes'], action=self.action, slot=slot.name)
+        self.metrics['transfer_rate'].set(progress['rate'], action=self.action, slot=slot.name)
+
+    @contextmanager
     def config_logging(self, action: str):
-        '''Configure the logging'''
+        '''Log to the file of the action during the context.
+        Only the lines of the threads working for the cluster are written, since several
+        clusters can run at the same time in one process.
+        '''
         path = Path(f'/var/log/hazelsync/{self.name}')
         path.mkdir(exist_ok=True, parents=True)
         if action in ['stream']:
@@ -74,50 +144,220 @@ class Cluster:
         handler = FileHandler(filename)
         handler.setLevel(DEBUG)
         handler.setFormatter(formatter)
+        handler.addFilter(ClusterFilter(self.name))
         log.addHandler(handler)
+        try:
+            with cluster_context(self.name):
+                yield
+        finally:
+            log.removeHandler(handler)
+            handler.close()
 
     def backup(self):
         '''Run the backup of a cluster'''
-        self.config_logging('backup')
-        start_time = datetime.now()
-        with self.metrics['runtime'].time(action='backup'):
-            slots = self.job.backup()
-        with self.metrics['runtime'].time(action='snapshot'):
-            for slot in slots:
-                if slot['status'] == 'success':
-                    self.backend.snapshot(slot['slot'])
-        end_time = datetime.now()
-        status = merge_statuses(slots)
-        report = Report(
-            cluster=self.name,
-            job_name=self.job_type,
-            job_type='backup',
-            start_time=start_time,
-            end_time=end_time,
-            status=status,
-            slots=slots,
-        )
-        report.write()
-        self.metrics['job_status'].set(PROM_STATUS_MAP[status], action='backup')
-        for slot in slots:
-            self.metrics['slot_status'].set(PROM_STATUS_MAP[slot['status']], action='backup', slot=slot['slot'])
-        self.engine.flush()
-
-    def stream(self):
-        '''Stream some data to make backup faster'''
-        self.config_logging('stream')
-        with self.metrics['runtime'].time(action='stream'):
-            slots = self.job.stream()
-        slots = self.job.stream()
-        status = merge_statuses(slots)
-        self.metrics['job_status'].set(PROM_STATUS_MAP[status], action='stream')
-        for slot in slots:
-            self.metrics['slot_status'].set(PROM_STATUS_MAP[slot['status']], action='stream', slot=slot['slot'])
-        self.engine.flush()
-
-    def restore(self, snapshot):
-        '''Restore a snapshot on a cluster'''
-        self.config_logging('restore')
-        with self.metrics['runtime'].time(action='restore'):
-            self.job.restore(snapshot)
-        self.engine.flush()
+        with self.config_logging('backup'):
+            self.action = 'backup'
+            start_time = datetime.now()
+            if self.pipeline_snapshots and hasattr(self.job, 'on_slot_done'):
+                slots = self.backup_pipelined()
+            else:
+                with self.metrics['runtime'].time(action='backup'):
+                    slots = self.job.backup()
+                with self.metrics['runtime'].time(action='snapshot'):
+                    self.backend.snapshot_many([slot['slot'] for slot in slots if slot['status'] == 'success'])
+            self.replicate(slots)
+            self.update_catalog()
+            add_stats(slots, self.backend.slot_metrics([slot['slot'] for slot in slots]))
+            end_time = datetime.now()
+            status = merge_statuses(slots)
+            report = Report(
+                cluster=self.name,
+                job_name=self.job_type,
+                job_type='backup',
+                start_time=start_time,
+                end_time=end_time,
+                status=status,
+                slots=slots,
+            )
+            report.write()
+            self.metrics['job_status'].set(PROM_STATUS_MAP[status], action='backup')
+            self.export_slots(slots, 'backup')
+            self.engine.flush()
+
+    def backup_pipelined(self) -> list:
+        '''Run the backup of the job, snapshotting each slot as soon as its backup succeeded,
+        while the backup of the other slots goes on. The snapshots are taken one batch at a time
+        (with the slots that succeeded since the previous batch), and their total time is issued
+        as the snapshot runtime.
+        '''
+        durations = []
+        pending = []
+        lock = threading.Lock()
+        def snapshot():
+            with lock:
+                batch = list(pending)
+                pending.clear()
+            if not batch:
+                return
+            start = datetime.now()
+            try:
+                self.backend.snapshot_many(batch)
+            finally:
+                durations.append((start, datetime.now()))
+        futures = []
+        def on_slot_done(slot: dict):
+            if slot['status'] == 'success':
+                with lock:
+                    pending.append(slot['slot'])
+                futures.append(executor.submit(inherit_cluster(snapshot)))
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            self.job.on_slot_done = on_slot_done
+            try:
+                with self.metrics['runtime'].time(action='backup'):
+                    slots = self.job.backup()
+            finally:
+                self.job.on_slot_done = None
+        for future in futures:
+            future.result()
+        if durations:
+            runtime = sum((stop - start).total_seconds() for start, stop in durations)
+            self.metrics['runtime'].record(durations[0][0], durations[-1][1], runtime, action='snapshot')
+        return slots
+
+    def replicate(self, slots: list):
+        '''Replicate the successful slots (for the backends supporting it), and add the
+        replication statistics to the statistics of the slots
+        '''
+        start = datetime.now()
+        replicated = self.backend.replicate([slot['slot'] for slot in slots if slot['status'] == 'success'])
+        if not replicated:
+            return
+        self.metrics['runtime'].record(start, datetime.now(), action='replicate')
+        add_stats(slots, replicated)
+
+    def update_catalog(self):
+        '''Add the new snapshots to the catalog of the files (if enabled).
+        A failure does not fail the backup, the snapshots are added at the next update.
+        '''
+        if self.catalog is None:
+            return
+        try:
+            with self.metrics['runtime'].time(action='catalog'):
+                added = self.catalog.update(self.backend)
+            log.info("Added %d snapshots to the catalog", added)
+        except Exception as err: # pylint: disable=broad-except
+            log.exception("Could not update the catalog of %s: %s", self.name, err)
+
+    def stream(self) -> str:
+        '''Stream some data to make backup faster, and return the status'''
+        with self.config_logging('stream'):
+            self.action = 'stream'
+            with self.metrics['runtime'].time(action='stream'):
+                slots = self.job.stream()
+            status = merge_statuses(slots)
+            self.metrics['job_status'].set(PROM_STATUS_MAP[status], action='stream')
+            self.export_slots(slots, 'stream')
+            self.engine.flush()
+        return status
+
+    def follow(self, interval: int = 60, max_interval: int = 600):
+        '''Stream the data in a loop, waiting between each run.
+        The connections to the hosts are kept open between the runs (for the jobs supporting it),
+        and the wait is doubled after each failed run, up to `max_interval`.
+        :param interval: Seconds to wait between two successful runs.
+        :param max_interval: Maximum seconds to wait after failed runs.
+        '''
+        delay = interval
+        with ExitStack() as stack:
+            if hasattr(self.job, 'connections'):
+                stack.enter_context(self.job.connections(max_interval * 2))
+            while True:
+                status = self.stream()
+                if status == 'success':
+                    delay = interval
+                else:
+                    delay = min(delay * 2, max_interval)
+                    log.warning("Stream of %s finished with status %s, next run in %ds", self.name, status, delay)
+                time.sleep(delay)
+
+    def prune(self, dry_run: bool = False) -> list:
+        '''Destroy the snapshots expired according to the retention policy, and return them
+        :param dry_run: Only return the expired snapshots, without destroying them.
+        '''
+        if self.retention is None:
+            raise SettingError(self.name, "No retention policy configured")
+        try:
+            retention = Retention(**self.retention)
+        except TypeError as err:
+            raise SettingError(self.name, f"Invalid retention policy: {err}") from err
+        with self.config_logging('prune'):
+            self.action = 'prune'
+            snapshots = self.backend.list_snapshots()
+            expired = retention.expired(snapshots, datetime.now())
+            log.info("%d snapshots out of %d expired", len(expired), len(snapshots))
+            if dry_run:
+                return expired
+            with self.metrics['runtime'].time(action='prune'):
+                for slot in sorted({snapshot.slot for snapshot in expired}):
+                    # Do not destroy snapshots while a job writes in the slot
+                    with self.backend.lock(self.backend.ensure_slot(slot)):
+                        self.backend.destroy_snapshots([snapshot.path for snapshot in expired if snapshot.slot == slot])
+            self.update_catalog()
+            self.metrics['pruned_snapshots'].set(len(expired), action='prune')
+            self.engine.flush()
+        return expired
+
+    def resolve_snapshots(self, when: str = 'latest', slots: Optional[List[str]] = None) -> Dict[str, Snapshot]:
+        '''Return the snapshot to restore for each slot: its newest snapshot taken at or before a given time.
+        :param when: A time (like `2021-01-02T03:04:05`), or `latest` for the last snapshots.
+        :param slots: The slots to restore (all of them by default).
+        '''
+        target = None if when == 'latest' else dateutil.parser.isoparse(when)
+        chosen = {}
+        for snapshot in self.backend.list_snapshots():
+            if slots is not None and snapshot.slot not in slots:
+                continue
+            if target is not None and snapshot.time > target:
+                continue
+            if snapshot.slot not in chosen or snapshot.time > chosen[snapshot.slot].time:
+                chosen[snapshot.slot] = snapshot
+        missing = set(slots or []) - set(chosen)
+        if missing:
+            raise Exception(f"No snapshot of {', '.join(sorted(missing))} at {when}")
+        if not chosen:
+            raise Exception(f"No snapshot of cluster {self.name} at {when}")
+        return chosen
+
+    def restore(self, when: str = 'latest', hosts: Optional[List[str]] = None) -> list:
+        '''Restore the snapshots of a cluster on its hosts, write the report of the restore,
+        and return the status of each slot
+        :param when: The time of the snapshots to restore (see `resolve_snapshots`).
+        :param hosts: The hosts to restore (all of them by default).
+        '''
+        with self.config_logging('restore'):
+            self.action = 'restore'
+            start_time = datetime.now()
+            slots = [host.split('.')[0] for host in hosts] if hosts else None
+            snapshots = self.resolve_snapshots(when, slots)
+            with self.metrics['runtime'].time(action='restore'), ExitStack() as stack:
+                # The snapshots of some backends are extracted to a staging directory until the end of the restore
+                directories = {
+                    slot: stack.enter_context(self.backend.open_snapshot(snapshot))
+                    for slot, snapshot in snapshots.items()
+                }
+                slots = self.job.restore(directories)
+            status = merge_statuses(slots)
+            report = Report(
+                cluster=self.name,
+                job_name=self.job_type,
+                job_type='restore',
+                start_time=start_time,
+                end_time=datetime.now(),
+                status=status,
+                slots=slots,
+            )
+            report.write()
+            self.metrics['job_status'].set(PROM_STATUS_MAP[status], action='restore')
+            self.export_slots(slots, 'restore')
+            self.engine.flush()
+        return slots
@@ -1,17 +1,50 @@
 '''Rsync style backup'''
 
+import queue
+import re
+import shlex
+import subprocess #nosec
+import tempfile
+import threading
+import time
 from logging import getLogger
 from pathlib import Path
+from typing import Dict, Iterator, List, Optional
 
 from filelock import Timeout
 
 from hazelsync.job.rsync import RsyncJob
-from hazelsync.utils.rsync import rsync_run, RsyncError
+from hazelsync.settings import SettingError
+from hazelsync.utils.rsync import rsync_run, merge_stats, iter_lines, RsyncError, PATH
 
 log = getLogger('hazelsync')
 
 PRE_SCRIPT = '''psql -c "SELECT pg_start_backup('hazelsync', true);"'''
 POST_SCRIPT = '''psql -c "SELECT pg_stop_backup();"'''
+LAG_SCRIPT = '''psql -At -c "SELECT pg_current_wal_lsn();"'''
+
+WAL_SEGMENT = re.compile(r'^[0-9A-F]{24}$')
+LSN = re.compile(r'^([0-9A-F]+)/([0-9A-F]+)$')
+
+# Command of the SSH helper printing the WAL segments when they are complete
+WATCH_COMMAND = 'wal-watch'
+WATCH_PREFIX = 'WAL'
+# Seconds to wait for the watch to end after its timeout, before killing it
+WATCH_GRACE = 30
+
+STREAM_MODES = ['poll', 'watch']
+
+def parse_lsn(output: str) -> int:
+    '''Return the position in bytes of the WAL location printed by PostgreSQL'''
+    for line in reversed(output.splitlines()):
+        match = LSN.match(line.strip())
+        if match:
+            return (int(match.group(1), 16) << 32) + int(match.group(2), 16)
+    raise ValueError(f"No WAL location found in: {output}")
+
+def segment_number(name: str, segment_size: int) -> int:
+    '''Return the number of a WAL segment from its file name (the timeline is ignored)'''
+    return int(name[8:16], 16) * (0x100000000 // segment_size) + int(name[16:24], 16)
 
 class PgsqlJob(RsyncJob):
     '''Subclass of rsync job to backup PostgreSQL with the WAL archive method.'''
@@ -20,7 +53,18 @@ class PgsqlJob(RsyncJob):
         waldir: str,
         delete_wal: bool = True,
         stream_timeout: int = 60,
+        stream_mode: str = 'poll',
+        watch_timeout: int = 60,
+        wal_segment_size: int = 16 * 1024 * 1024,
         **kwargs):
+        '''
+        :param stream_mode: `poll` to rsync the WAL directory, or `watch` to pull only the segments
+            the host notifies as complete (falling back to `poll` if the watch fails).
+        :param watch_timeout: Seconds a watch lasts in `watch` mode.
+        :param wal_segment_size: The size of the WAL segments of the server, in bytes.
+        '''
+        if stream_mode not in STREAM_MODES:
+            raise SettingError(kwargs.get('name'), f"stream_mode should be one of {STREAM_MODES}, got {stream_mode}")
         self.waldir = Path(waldir)
         super().__init__(paths=[Path(datadir)], excludes=[self.waldir], **kwargs)
         self.scripts['pre'] = [PRE_SCRIPT]
@@ -29,6 +73,10 @@ class PgsqlJob(RsyncJob):
         if delete_wal:
             self.stream_options += ['--remove-source-files']
         self.stream_timeout = stream_timeout
+        self.delete_wal = delete_wal
+        self.stream_mode = stream_mode
+        self.watch_timeout = watch_timeout
+        self.wal_segment_size = wal_segment_size
 
     def backup_rsync_host(self, host: str):
         try:
@@ -40,47 +88,180 @@ class PgsqlJob(RsyncJob):
         '''A function to execute very regularly to avoid long backup time.
         In PostgreSQL case, we will rsync the WAL logs.
         '''
-        slots = []
-        for host in self.hosts:
-            slot = {'slot': host.split('.')[0]}
+        return self.map_hosts(self.stream_slot)
+
+    def stream_slot(self, host: str) -> dict:
+        '''Stream the data of a single host and return the status of its slot'''
+        with self.connection(host):
+            slot = self.stream_status(host)
+            lag = self.archive_lag(host)
+        if lag:
+            slot['stats'] = {**slot.get('stats', {}), **lag}
+        return slot
+
+    def stream_status(self, host: str) -> dict:
+        '''Stream the data of a single host, catching the errors in the status of its slot'''
+        slot = {'slot': host.split('.')[0]}
+        try:
+            stats = self.stream_host(host)
+            slot['status'] = 'success'
+            if stats:
+                slot['stats'] = stats
+        except RsyncError as err:
+            log.error("Failed to rsync (stream) for %s, %s: %s", host, self.waldir, err)
+            slot['status'] = 'failure'
+            slot['logs'] = str(err)
+        except Timeout:
+            slot['status'] = 'locked'
+        except Exception as err:
+            slot['status'] = 'unknown'
+            slot['logs'] = str(err)
+        return slot
+
+    def archive_lag(self, host: str) -> dict:
+        '''Return how far the WAL archived in the slot of a host is behind the host, in segments,
+        bytes and seconds (the age of the newest segment archived, when some are missing).
+        Nothing is returned if the lag cannot be computed.
+        '''
+        shortname = host.split('.')[0]
+        directory = self.slots[shortname] / self.waldir.relative_to('/')
+        newest = self.newest_segment(directory)
+        if newest is None:
+            log.debug("No WAL segment archived yet in %s", directory)
+            return {}
+        try:
+            position = parse_lsn(self.ssh(host, LAG_SCRIPT, self.stream_timeout).decode(errors='replace'))
+        except Exception as err: # pylint: disable=broad-except
+            log.warning("Could not get the WAL location of %s: %s", host, err)
+            return {}
+        number = segment_number(newest.name, self.wal_segment_size)
+        # The current segment is still being written, so it cannot be archived yet
+        segments = max(position // self.wal_segment_size - number - 1, 0)
+        return {
+            'archive_lag_segments': segments,
+            'archive_lag_bytes': max(position - (number + 1) * self.wal_segment_size, 0),
+            'archive_lag_seconds': int(time.time() - newest.stat().st_mtime) if segments else 0,
+        }
+
+    def newest_segment(self, directory: Path) -> Optional[Path]:
+        '''Return the newest WAL segment of a directory'''
+        if not directory.is_dir():
+            return None
+        segments = [path for path in directory.iterdir() if WAL_SEGMENT.match(path.name)]
+        if not segments:
+            return None
+        return max(segments, key=lambda path: segment_number(path.name, self.wal_segment_size))
+
+    def stream_host(self, host: str) -> dict:
+        '''Fetch the stream data for one host and return the transfer statistics'''
+        if self.stream_mode == 'watch':
             try:
-                self.stream_host(host)
-                slot['status'] = 'success'
-            except RsyncError as err:
-                log.error("Failed to rsync (stream) for %s, %s: %s", host, self.waldir, err)
-                slot['status'] = 'failure'
-                slot['logs'] = str(err)
-            except Timeout:
-                slot['status'] = 'locked'
-            except Exception as err:
-                slot['status'] = 'unknown'
-                slot['logs'] = str(err)
-            slots.append(slot)
-        return slots
-
-    def stream_host(self, host: str):
-        '''Fetch the stream data for one host'''
+                return self.watch_host(host)
+            except subprocess.CalledProcessError as err:
+                log.warning("Could not watch %s on %s, polling instead: %s", self.waldir, host, err.stderr)
+        return self.poll_host(host)
+
+    def poll_host(self, host: str) -> dict:
+        '''Rsync the whole WAL directory of a host and return the transfer statistics'''
         shortname = host.split('.')[0]
         slot = self.slots[shortname]
         with self.backend.lock(slot, self.stream_timeout):
             log.info("Running rsync (stream) on %s, %s", host, self.waldir)
-            rsync_run(
+            return rsync_run(
                 source=self.waldir,
                 destination=slot,
                 source_host=host,
                 options=self.rsync_options+self.stream_options,
                 user=self.user,
                 private_key=self.private_key,
+                ssh_options=self.ssh_options(host),
+                progress=self.progress(host),
+                bandwidth=self.bandwidth,
             )
 
-    def restore(self):
-        '''Restore job
+    def watch_host(self, host: str) -> dict:
+        '''Watch the WAL directory of a host, pulling the segments as soon as they are complete,
+        and return the transfer statistics.
+        :raises subprocess.CalledProcessError: If the watch failed before notifying any segment.
+        '''
+        command = f"{WATCH_COMMAND} {shlex.quote(str(self.waldir))} {self.watch_timeout}"
+        cmd = ['ssh', '-l', self.user, '-i', str(self.private_key), *self.ssh_options(host), host, command]
+        log.info("Watching %s on %s", self.waldir, host)
+        stats = []
+        with tempfile.TemporaryFile() as stderr:
+            with subprocess.Popen(cmd, shell=False, env=dict(PATH=PATH), #nosec
+                stdout=subprocess.PIPE, stderr=stderr) as proc:
+                try:
+                    for segments in self.watch_batches(proc.stdout):
+                        stats.append(self.pull_segments(host, segments))
+                finally:
+                    if proc.poll() is None:
+                        proc.kill()
+            if proc.returncode and not stats:
+                stderr.seek(0)
+                raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr.read())
+        return merge_stats(stats)
+
+    def watch_batches(self, stream) -> Iterator[List[str]]:
+        '''Read the segments notified by a watch, grouping the ones notified together'''
+        notifications = queue.Queue()
+        def read():
+            for line in iter_lines(stream):
+                if line.startswith(f"{WATCH_PREFIX} "):
+                    notifications.put(line[len(WATCH_PREFIX)+1:])
+            notifications.put(None)
+        threading.Thread(target=read, daemon=True).start()
+        ended = False
+        while not ended:
+            try:
+                segments = [notifications.get(timeout=self.watch_timeout + WATCH_GRACE)]
+            except queue.Empty:
+                log.warning("Watch of %s did not end after %ds, stopping it", self.waldir, self.watch_timeout)
+                return
+            while not notifications.empty():
+                segments.append(notifications.get())
+            ended = None in segments
+            segments = [segment for segment in segments if segment is not None]
+            if segments:
+                yield segments
+
+    def pull_segments(self, host: str, segments: List[str]) -> dict:
+        '''Rsync some segments of the WAL directory of a host and return the transfer statistics'''
+        shortname = host.split('.')[0]
+        slot = self.slots[shortname]
+        destination = slot / self.waldir.relative_to('/')
+        if not self.delete_wal:
+            # The segments stay on the host, so they are notified again by every watch
+            segments = [segment for segment in segments if not (destination / segment).exists()]
+            if not segments:
+                return {}
+        destination.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(prefix='hazelsync-files-') as files_from:
+            files_from.write('\n'.join(segments).encode())
+            files_from.flush()
+            with self.backend.lock(slot, self.stream_timeout):
+                log.info("Running rsync (stream) on %s, %d segments of %s", host, len(segments), self.waldir)
+                return rsync_run(
+                    source=self.waldir,
+                    destination=destination,
+                    source_host=host,
+                    options=self.rsync_options+self.stream_options+['--files-from', files_from.name],
+                    user=self.user,
+                    private_key=self.private_key,
+                    ssh_options=self.ssh_options(host),
+                    progress=self.progress(host),
+                    bandwidth=self.bandwidth,
+                )
+
+    def restore(self, snapshots: Dict[str, Path]) -> list:
+        '''Restore job. The data directory and the WAL archive cannot just be pushed back to
+        a running database, so it is not supported.
         '''
-        raise NotImplementedError()
+        raise NotImplementedError("Restore of PostgreSQL clusters not implemented yet")
 
     def restore_rsync_host(self, host: str, snapshot: Path):
         '''Restore the data of a single host
         :param host: The host to restore
         :param snapshot: The snapshot to restore
         '''
-        raise NotImplementedError()
+        raise NotImplementedError("Restore of PostgreSQL clusters not implemented yet")
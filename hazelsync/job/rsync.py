@@ -1,19 +1,36 @@
 '''Rsync style backup'''
 
+import os
+import shlex
 import subprocess #nosec
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from datetime import datetime
 from logging import getLogger
 from enum import Enum
 from pathlib import Path
-from typing import List, Union, Optional
+from typing import Callable, Dict, List, Union, Optional
 
 from filelock import Timeout
 
-from hazelsync.utils.rsync import rsync_run, RsyncError, PATH
+from hazelsync.reports import Report
+from hazelsync.settings import SettingError
+from hazelsync.utils.functions import disk_usage
+from hazelsync.utils.logs import inherit_cluster
+from hazelsync.utils.rsync import rsync_run, rsync_list, failed_paths, merge_stats, split_shards, RsyncError, PATH
+from hazelsync.utils.rsync import CODECS, PERMANENT_RETURN_CODES, choose_compression, compression_options
+from hazelsync.utils.ssh import SshMaster
+from hazelsync.utils.time import duration_parser
 
 Script = Union[str, dict]
 
 log = getLogger('hazelsync')
 
+# Seconds subtracted from the last backup time when looking for changed files, for clock skews
+CHANGED_SINCE_MARGIN = 300
+
 class RunStyle(Enum):
     '''The run style of rsync (parallel or sequential)'''
     SEQ = 'seq'
@@ -33,47 +50,226 @@ class RsyncJob:
         pre_scripts: Optional[List[Script]] = None,
         post_scripts: Optional[List[Script]] = None,
         run_style: str = 'seq',
+        max_parallel: int = 4,
+        single_transfer: bool = False,
+        multiplex: bool = False,
+        shards: Optional[Dict[str, int]] = None,
+        changed_only: bool = False,
+        full_every: Optional[str] = None,
+        retries: int = 0,
+        retry_delay: int = 10,
+        compression: Optional[str] = None,
     ):
         '''Create a new rsync plan.
         :param hosts: A list of hostnames to rsync to.
         :param paths: A list of path that will need to be rsynced from the target hosts.
         :param run_style: Whether to run the hosts sequentially or in parallel.
+        :param max_parallel: The maximum number of hosts to run at the same time in async mode.
+        :param single_transfer: Whether to rsync all the paths of a host with a single rsync process.
+        :param multiplex: Whether to share a single SSH connection between all the commands run on a host.
+        :param shards: Paths to split into several rsync processes running at the same time, with the number
+            of processes for each of them.
+        :param changed_only: Whether to only transfer the files changed since the last successful backup.
+        :param full_every: How often to do a full backup when changed_only is set (e.g. `7d`).
+        :param retries: How many times to retry a failed rsync. Partially transferred files are kept to be resumed.
+        :param retry_delay: Seconds to wait before the first retry. The delay doubles after each retry.
+        :param compression: The compression codec to use (none, lz4 or zstd), or `auto` to choose it for each
+            host from the previous backups.
         '''
         self.name = name
         self.hosts = hosts
         self.paths = [Path(path) for path in paths]
         self.private_key = Path(private_key)
         self.run_style = RunStyle(run_style)
+        if max_parallel < 1:
+            raise SettingError(name, f"max_parallel should be at least 1 (got {max_parallel})")
+        self.max_parallel = max_parallel
         self.status = []
         self.backend = backend
         self.user = user
         self.scripts = {}
         self.scripts['pre'] = pre_scripts or []
         self.scripts['post'] = post_scripts or []
-        self.rsync_options = ['-a', '-R', '-A', '--numeric-ids']
+        self.rsync_options = ['-a', '-R', '-A', '--numeric-ids', '--stats']
         self.includes = includes
         self.excludes = excludes
+        self.single_transfer = single_transfer
+        self.multiplex = multiplex
+        self.shards = {Path(path): count for path, count in (shards or {}).items()}
+        for path, count in self.shards.items():
+            if path not in self.paths:
+                raise SettingError(name, f"Sharded path {path} is not in the paths to backup")
+            if count < 1:
+                raise SettingError(name, f"Number of shards for {path} should be at least 1 (got {count})")
+        self.masters = {}
+        self.transfer_stats = {}
+        # (start, end) times of the transfers of each host, to measure their wall-clock time
+        self.transfer_spans = {}
+        # Size of the top-level entries of the sharded paths of each host, updated by the transfers
+        self.shard_weights = {}
+        self.changed_only = changed_only
+        self.full_every = duration_parser(full_every) if full_every else None
+        self.since = {}
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.attempts = {}
+        if retries > 0:
+            self.rsync_options += ['--partial-dir=.rsync-partial']
+        if compression is not None and compression not in [*CODECS, 'auto']:
+            raise SettingError(name, f"Unknown compression {compression} (should be one of {CODECS} or auto)")
+        self.compression = compression
+        self.codecs = {}
+        # Function called with a slot and the progress of its running transfer (set by the cluster)
+        self.on_progress = None
+        # Bandwidth budget shared by the transfers (set by the cluster)
+        self.bandwidth = None
+        # Function called with the status of each slot as soon as its backup ends (set by the cluster)
+        self.on_slot_done = None
 
         self.slots = {host.split('.')[0]: self.backend.ensure_slot(host.split('.')[0]) for host in self.hosts}
 
+    def map_hosts(self, func, hosts: Optional[List[str]] = None, run_style: Optional[RunStyle] = None) -> list:
+        '''Call a function on every host, following the run style.
+        Results are returned in the same order as the hosts.
+        :param func: A function taking a host as argument.
+        :param hosts: The hosts to call the function on (all the hosts by default).
+        :param run_style: Override the run style of the job.
+        '''
+        hosts = self.hosts if hosts is None else hosts
+        if (run_style or self.run_style) == RunStyle.ASYNC:
+            with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+                return list(executor.map(inherit_cluster(func), hosts))
+        return [func(host) for host in hosts]
+
     def backup(self):
         '''Run the job'''
-        slots = []
-        if self.run_style == RunStyle.SEQ:
+        return self.map_hosts(self.backup_host)
+
+    def backup_host(self, host: str) -> dict:
+        '''Backup a single host and return the status of its slot.
+        Errors are caught so that a host failure does not affect the other hosts.
+        '''
+        shortname = host.split('.')[0]
+        slot = {'slot': self.slots[shortname]}
+        self.transfer_stats[shortname] = []
+        self.transfer_spans[shortname] = []
+        self.attempts[shortname] = 0
+        if self.compression:
+            self.codecs[shortname] = self.choose_codec(host)
+        if self.changed_only:
+            self.since[shortname] = self.changed_since(host)
+            slot['mode'] = 'changed' if self.since[shortname] else 'full'
+        try:
+            with self.connection(host):
+                self.backup_rsync_host(host)
+            slot['status'] = 'success'
+        except Exception as err:
+            log.error(err)
+            slot['status'] = 'failure'
+            slot['logs'] = [str(err).split("\n")]
+        self.since.pop(shortname, None)
+        attempts = self.attempts.pop(shortname)
+        if self.retries > 0:
+            slot['attempts'] = attempts
+        stats = merge_stats(self.transfer_stats.pop(shortname), self.transfer_spans.pop(shortname))
+        if stats:
+            slot['stats'] = stats
+        shard_weights = self.shard_weights.pop(shortname, None)
+        if shard_weights:
+            slot['shards'] = shard_weights
+        if self.compression:
+            slot['compression'] = {'codec': self.codecs.pop(shortname)}
+            if stats.get('bytes_received'):
+                slot['compression']['ratio'] = round(stats.get('literal_bytes', 0) / stats['bytes_received'], 2)
+        if self.on_slot_done is not None:
+            self.on_slot_done(slot)
+        return slot
+
+    def choose_codec(self, host: str) -> str:
+        '''Return the compression codec to use for a host.
+        In auto mode, it depends on the codec and statistics of the last successful backup of the host.
+        '''
+        if self.compression != 'auto':
+            return self.compression
+        slot = str(self.slots[host.split('.')[0]])
+        previous = None
+        for report in Report.history(self.name):
+            status = next((status for status in report.slots if status.get('slot') == slot), None)
+            if report.job_type == 'backup' and status and status['status'] == 'success':
+                if 'compression' in status:
+                    previous = {**status.get('stats', {}), 'codec': status['compression']['codec']}
+                break
+        codec = choose_compression(previous)
+        log.info("Using compression %s for %s", codec, host)
+        return codec
+
+    def changed_since(self, host: str) -> Optional[datetime]:
+        '''Return the start time of the last successful backup of a host, when only the files changed
+        since then need to be backed up. Return None when a full backup is needed.
+        '''
+        slot = str(self.slots[host.split('.')[0]])
+        now = datetime.now()
+        since = None
+        for report in Report.history(self.name):
+            if self.full_every and report.start_time < now - self.full_every:
+                log.info("No full backup of %s since %s, doing a full backup", host, self.full_every)
+                return None
+            if report.job_type != 'backup':
+                continue
+            status = next((status for status in report.slots if status.get('slot') == slot), None)
+            if status is None or status['status'] != 'success':
+                continue
+            since = since or report.start_time
+            if not self.full_every or status.get('mode', 'full') == 'full':
+                return since
+        return None
+
+    @contextmanager
+    def connection(self, host: str, persist: int = 60):
+        '''Keep a multiplexed SSH connection open to the host (if enabled) during the context.
+        Nested contexts on the same host reuse the already opened connection.
+        :param host: The host to connect to.
+        :param persist: Seconds the connection stays up without being used.
+        '''
+        if not self.multiplex or host in self.masters:
+            yield
+            return
+        with SshMaster(host, self.user, self.private_key, persist) as master:
+            self.masters[host] = master
+            try:
+                yield
+            finally:
+                del self.masters[host]
+
+    @contextmanager
+    def connections(self, persist: int = 60):
+        '''Keep a multiplexed SSH connection open to every host (if enabled) during the context,
+        for the actions running several times in a row.
+        :param persist: Seconds the connections stay up without being used.
+        '''
+        with ExitStack() as stack:
             for host in self.hosts:
-                shortname = host.split('.')[0]
-                slot = {'slot': self.slots[shortname]}
-                try:
-                    self.backup_rsync_host(host)
-                    slot['status'] = 'success'
-                except Exception as err:
-                    log.error(err)
-                    slot['status'] = 'failure'
-                    slot['logs'] = [str(err).split("\n")]
-                slots.append(slot)
-        elif self.run_style == RunStyle.ASYNC:
-            raise NotImplementedError()
-        return slots
+                stack.enter_context(self.connection(host, persist))
+            yield
+
+    def ssh_options(self, host: str) -> List[str]:
+        '''SSH options to use for connecting to a host'''
+        master = self.masters.get(host)
+        return master.options() if master else []
+
+    def progress(self, host: str) -> Optional[Callable[[dict], None]]:
+        '''Return a function reporting the progress of a transfer on a host (if a hook is set)'''
+        if self.on_progress is None:
+            return None
+        slot = self.slots[host.split('.')[0]]
+        return lambda current: self.on_progress(slot, current)
+
+    def ssh(self, host: str, command: str, timeout: Optional[int] = None) -> bytes:
+        '''Run a command on a host and return its output'''
+        cmd = ['ssh', '-l', self.user, '-i', str(self.private_key), *self.ssh_options(host), host, command]
+        proc = subprocess.run(cmd, shell=False, timeout=timeout, env=dict(PATH=PATH), #nosec
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        return proc.stdout
 
     def run_scripts(self, stype: str, host: str):
         '''Run a collection of scripts on a given host'''
@@ -85,9 +281,7 @@ class RsyncJob:
             script_cmd = data['cmd']
             timeout = data.get('timeout', 120)
             log.debug("Running %s script: %s", stype, script_cmd)
-            cmd = ['ssh', '-l', self.user, '-i', str(self.private_key), host, script_cmd]
-            subprocess.run(cmd, shell=False, timeout=timeout, env=dict(PATH=PATH), #nosec
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+            self.ssh(host, script_cmd, timeout)
 
     def backup_rsync_host(self, host: str):
         '''Rsync a single host
@@ -98,46 +292,306 @@ class RsyncJob:
         exceptions = []
         with self.backend.lock(slot_path):
             self.run_scripts('pre', host)
-            for path in self.paths:
-                log.info("Running rsync on %s, %s", host, path)
-                slot = {'slot': shortname}
-                try:
-                    rsync_run(
-                        source=path,
-                        destination=slot_path,
-                        source_host=host,
-                        options=self.rsync_options,
-                        includes=self.includes,
-                        excludes=self.excludes,
-                        user=self.user,
-                        private_key=self.private_key,
-                    )
-                    slot['status'] = 'success'
-                except RsyncError as err:
-                    slot['status'] = 'failure'
-                    slot['logs'] = str(err)
-                    exceptions.append(err)
-                except Timeout as err:
-                    slot['status'] = 'locked'
-                    exceptions.append(err)
-                except Exception as err:
-                    slot['status'] = 'unknown'
-                    slot['logs'] = str(err)
-                    exceptions.append(err)
-                self.status.append(slot)
+            since = self.since.get(shortname)
+            paths = [path for path in self.paths if path not in self.shards]
+            batches = [paths] if self.single_transfer else [[path] for path in paths]
+            batches += [[path] for path in self.shards]
+            for batch in batches:
+                if since:
+                    for path in batch:
+                        exceptions += self.rsync_changed(host, path, since)
+                elif batch:
+                    exceptions += self.rsync_paths(host, batch)
         if exceptions:
             raise Exception(exceptions)
         self.run_scripts('post', host)
-        return slot
 
-    def restore(self):
-        '''Restore job
+    def rsync_paths(self, host: str, paths: List[Path]) -> list:
+        '''Rsync one or several paths of a host in a single transfer, or a sharded path
+        in several concurrent transfers.
+        The status of each path is recorded, and the errors are returned.
+        '''
+        log.info("Running rsync on %s, %s", host, ', '.join(map(str, paths)))
+        if paths[0] in self.shards:
+            try:
+                sources = self.shard_sources(host, paths[0])
+            except Exception as err:
+                log.error("Could not shard %s on %s: %s", paths[0], host, err)
+                sources = [[paths[0]]]
+        else:
+            sources = [paths if self.single_transfer else paths[0]]
+        # The transfers of the changed files cannot see the removed files: the full passes remove them from the slot
+        options = ['--delete'] if self.changed_only else []
+        if len(sources) == 1:
+            results = [self.transfer(host, paths, sources[0], options=options)]
+        else:
+            with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+                results = list(executor.map(inherit_cluster(
+                    lambda source: self.transfer(host, paths, source, options=options)), sources))
+        return self.record_status(host, paths, results)
+
+    def rsync_changed(self, host: str, path: Path, since: datetime) -> list:
+        '''Rsync the files of a path changed since a given time.
+        The status of the path is recorded, and the errors are returned.
         '''
-        raise NotImplementedError()
+        shortname = host.split('.')[0]
+        log.info("Running rsync on %s, %s (files changed since %s)", host, path, since)
+        with tempfile.NamedTemporaryFile(prefix='hazelsync-files-') as files_from:
+            try:
+                changed = self.changed_files(host, path, since)
+            except Exception as err:
+                stderr = getattr(err, 'stderr', None)
+                log.error("Could not list the changed files of %s on %s: %s %s", path, host, err, stderr or '')
+                return self.record_status(host, [path], [({path: 'failure'}, err)])
+            log.debug("%d files changed in %s on %s", len(changed), path, host)
+            if not changed:
+                return self.record_status(host, [path], [])
+            files_from.write(b'\0'.join(changed))
+            files_from.flush()
+            # The changed directories are transferred recursively: the content of a renamed or moved
+            # directory keeps its ctime
+            result = self.transfer(host, [path], path,
+                destination=self.slots[shortname] / path.relative_to('/'),
+                options=['--files-from', files_from.name, '--from0', '-r'],
+            )
+        return self.record_status(host, [path], [result])
+
+    def changed_files(self, host: str, path: Path, since: datetime) -> List[bytes]:
+        '''List the files and directories of a path on a host changed since a given time, relatively to the path'''
+        timestamp = int(since.timestamp()) - CHANGED_SINCE_MARGIN
+        # ctime also catches the renamed and moved files and directories (but not the content of the directories)
+        command = f"find {shlex.quote(str(path))} -newerct @{timestamp} -print0"
+        output = self.ssh(host, command)
+        prefix = os.fsencode(str(path)).rstrip(b'/') + b'/'
+        return [entry[len(prefix):] for entry in output.split(b'\0') if entry.startswith(prefix)]
+
+    def record_status(self, host: str, paths: List[Path], results: List[tuple]) -> list:
+        '''Record the status of each path from the results of its transfers, and return the errors'''
+        shortname = host.split('.')[0]
+        failed = {}
+        errors = []
+        for transfer_failed, error in results:
+            failed.update(transfer_failed)
+            if error:
+                errors.append(error)
+        for path in paths:
+            slot = {'slot': shortname, 'path': path, 'status': failed.get(path, 'success')}
+            if path in failed and failed[path] != 'locked':
+                slot['logs'] = "\n".join(map(str, errors))
+            self.status.append(slot)
+        return errors
+
+    def transfer(self,
+        host: str,
+        paths: List[Path],
+        source: Union[Path, List[Path]],
+        destination: Optional[Path] = None,
+        options: Optional[List[str]] = None,
+    ) -> tuple:
+        '''Run one rsync transfer from a host.
+        Returns the status of the failed paths, and the error if any.
+        :param paths: The paths the transfer is part of.
+        :param source: The source(s) of the rsync.
+        :param destination: Where to rsync to, if not at the root of the slot.
+        :param options: Additional rsync options.
+        '''
+        shortname = host.split('.')[0]
+        start = time.monotonic()
+        try:
+            stats = self.rsync_retry(host,
+                source=source,
+                destination=destination or self.slots[shortname],
+                source_host=host,
+                options=self.rsync_options + self.compression_options(host) + (options or []),
+                includes=self.includes,
+                excludes=self.excludes,
+                user=self.user,
+                private_key=self.private_key,
+                ssh_options=self.ssh_options(host),
+                progress=self.progress(host),
+                # Shards can be files
+                trailing_slash=paths[0] not in self.shards,
+                bandwidth=self.bandwidth,
+                transfers=self.parallel_transfers(),
+            )
+            self.transfer_stats.setdefault(shortname, []).append(stats)
+            self.transfer_spans.setdefault(shortname, []).append((start, time.monotonic()))
+            if paths[0] in self.shards and 'total_size' in (stats or {}):
+                self.update_shard_weights(host, paths[0], source, stats['total_size'])
+        except RsyncError as err:
+            return {path: 'failure' for path in failed_paths(err, paths)}, err
+        except Timeout as err:
+            return {path: 'locked' for path in paths}, err
+        except Exception as err:
+            return {path: 'unknown' for path in paths}, err
+        return {}, None
+
+    def parallel_transfers(self, restore: bool = False) -> int:
+        '''Return the number of transfers of the job that can run at the same time (to share the bandwidth budget)
+        :param restore: Count the transfers of a restore (hosts always run in parallel, paths are not sharded).
+        '''
+        hosts = min(self.max_parallel, len(self.hosts)) if restore or self.run_style == RunStyle.ASYNC else 1
+        if restore:
+            return hosts
+        return hosts * max(self.shards.values(), default=1)
+
+    def compression_options(self, host: str) -> List[str]:
+        '''Return the rsync options for the compression of a host'''
+        codec = self.codecs.get(host.split('.')[0])
+        return compression_options(codec) if codec else []
+
+    def rsync_retry(self, host: str, **kwargs) -> dict:
+        '''Run rsync, and retry with an exponential backoff if it fails for a reason
+        that may be temporary. The number of attempts of the slot is updated.
+        '''
+        shortname = host.split('.')[0]
+        attempt = 1
+        while True:
+            self.attempts[shortname] = max(self.attempts.get(shortname, 0), attempt)
+            try:
+                return rsync_run(**kwargs)
+            except RsyncError as err:
+                if attempt > self.retries or err.returncode in PERMANENT_RETURN_CODES:
+                    raise
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                log.warning("Rsync on %s failed (attempt %d/%d), retrying in %ds: %s",
+                    host, attempt, self.retries + 1, delay, err)
+                time.sleep(delay)
+                attempt += 1
+
+    def shard_sources(self, host: str, path: Path) -> List[List[Path]]:
+        '''Split a path into the sources of several transfers, balanced by the size of the
+        entries at the top of the path. The sizes are the ones recorded by the previous backup,
+        measured on the local copy when there is none, or listed by rsync for the new entries.
+        '''
+        shortname = host.split('.')[0]
+        entries = rsync_list(
+            source=path,
+            source_host=host,
+            user=self.user,
+            private_key=self.private_key,
+            ssh_options=self.ssh_options(host),
+        )
+        if not entries:
+            return [[path]]
+        past_sizes = self.previous_shard_weights(host, path)
+        if past_sizes is None:
+            try:
+                past_sizes = disk_usage(self.slots[shortname] / path.relative_to('/'))
+            except OSError as err:
+                log.warning("Could not measure the local copy of %s on %s: %s", path, host, err)
+                past_sizes = {}
+        weights = {entry['name']: past_sizes.get(entry['name'], entry['size']) for entry in entries}
+        self.shard_weights.setdefault(shortname, {})[str(path)] = dict(weights)
+        shards = split_shards(weights, self.shards[path])
+        log.debug("Sharded %s on %s into %d transfers", path, host, len(shards))
+        return [[path / name for name in shard] for shard in shards]
+
+    def previous_shard_weights(self, host: str, path: Path) -> Optional[Dict[str, int]]:
+        '''Return the sizes of the top-level entries of a sharded path recorded by the last backup
+        of a host, or None if no backup recorded them
+        '''
+        slot = str(self.slots[host.split('.')[0]])
+        for report in Report.history(self.name):
+            if report.job_type != 'backup':
+                continue
+            status = next((status for status in report.slots if status.get('slot') == slot), None)
+            if status and str(path) in status.get('shards', {}):
+                return status['shards'][str(path)]
+        return None
+
+    def update_shard_weights(self, host: str, path: Path, source: List[Path], total_size: int):
+        '''Update the sizes of the entries of a shard from the total size of its transfer.
+        The total is shared between the entries in proportion to their previous sizes.
+        '''
+        weights = self.shard_weights.get(host.split('.')[0], {}).get(str(path))
+        if weights is None:
+            return
+        names = [entry.name for entry in source]
+        previous = sum(weights.get(name, 0) for name in names)
+        for name in names:
+            share = weights.get(name, 0) / previous if previous else 1 / len(names)
+            weights[name] = int(total_size * share)
+
+    def restore(self, snapshots: Dict[str, Path]) -> list:
+        '''Push the snapshots back to their hosts, `max_parallel` hosts at a time (whatever the run style),
+        and return the status of each slot.
+        :param snapshots: The directory of the snapshot to restore for each slot. The hosts of the
+            other slots are not restored.
+        '''
+        hosts = [host for host in self.hosts if host.split('.')[0] in snapshots]
+        return self.map_hosts(
+            lambda host: self.restore_host(host, snapshots[host.split('.')[0]]),
+            hosts, RunStyle.ASYNC,
+        )
+
+    def restore_host(self, host: str, snapshot: Path) -> dict:
+        '''Restore a single host and return the status of its slot, with the statistics and
+        throughput of the transfers.
+        Errors are caught so that a host failure does not affect the other hosts.
+        '''
+        shortname = host.split('.')[0]
+        slot = {'slot': self.slots[shortname], 'snapshot': snapshot}
+        self.transfer_stats[shortname] = []
+        self.transfer_spans[shortname] = []
+        self.attempts[shortname] = 0
+        if self.compression:
+            self.codecs[shortname] = self.choose_codec(host)
+        start = time.monotonic()
+        try:
+            with self.connection(host):
+                self.restore_rsync_host(host, snapshot)
+            slot['status'] = 'success'
+        except Exception as err:
+            log.error(err)
+            slot['status'] = 'failure'
+            slot['logs'] = [str(err).split("\n")]
+        seconds = time.monotonic() - start
+        self.codecs.pop(shortname, None)
+        attempts = self.attempts.pop(shortname)
+        if self.retries > 0:
+            slot['attempts'] = attempts
+        stats = merge_stats(self.transfer_stats.pop(shortname), self.transfer_spans.pop(shortname))
+        if stats:
+            slot['stats'] = stats
+            slot['stats']['transfer_seconds'] = round(seconds, 2)
+            slot['stats']['transfer_rate'] = round(stats.get('bytes_sent', 0) / seconds, 2) if seconds else 0.0
+        log.info("Restore of %s from %s: %s in %.1fs", host, snapshot, slot['status'], seconds)
+        return slot
 
     def restore_rsync_host(self, host: str, snapshot: Path):
-        '''Restore the data of a single host
+        '''Restore the data of a single host, with the same transport options as the backup
+        (compression, multiplexed connection, bandwidth budget, retries). The files of the host
+        missing from the snapshot are kept.
         :param host: The host to restore
         :param snapshot: The snapshot to restore
         '''
-        raise NotImplementedError()
+        # The paths are pushed one by one to their location, so rsync must not recreate the relative paths
+        options = [option for option in self.rsync_options if option != '-R']
+        errors = []
+        for path in self.paths:
+            source = snapshot / path.relative_to('/')
+            if not source.exists():
+                log.warning("%s is not in the snapshot %s, not restoring it", path, snapshot)
+                continue
+            log.info("Restoring %s on %s from %s", path, host, snapshot)
+            try:
+                stats = self.rsync_retry(host,
+                    source=source,
+                    destination=path if source.is_dir() else path.parent,
+                    dest_host=host,
+                    options=options + self.compression_options(host),
+                    user=self.user,
+                    private_key=self.private_key,
+                    ssh_options=self.ssh_options(host),
+                    progress=self.progress(host),
+                    # Files are restored to their path, directories to their content
+                    trailing_slash=source.is_dir(),
+                    bandwidth=self.bandwidth,
+                    transfers=self.parallel_transfers(restore=True),
+                )
+                self.transfer_stats.setdefault(host.split('.')[0], []).append(stats)
+            except RsyncError as err:
+                errors.append(err)
+        if errors:
+            raise Exception(errors)
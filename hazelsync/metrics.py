@@ -61,8 +61,15 @@ class Timer(Gauge):
 
     def stop_timer(self, **tags):
         '''Stop the timer and issue the metric'''
-        self.stop = datetime.now()
-        self.runtime = (self.stop - self.start).total_seconds()
+        self.record(self.start, datetime.now(), **tags)
+
+    def record(self, start: datetime, stop: datetime, runtime: Optional[float] = None, **tags):
+        '''Issue the metric of a period measured elsewhere
+        :param runtime: The time to issue, when it is not the whole period.
+        '''
+        self.start = start
+        self.stop = stop
+        self.runtime = (self.stop - self.start).total_seconds() if runtime is None else runtime
         self.fields['start_time'] = self.start.timestamp()
         self.fields['stop_time'] = self.stop.timestamp()
         self.set(self.runtime, **tags)
@@ -116,8 +123,9 @@ class Influxdb2(MetricEngine):
     def __init__(self, config):
         address = config.get('address')
         token = config.get('token')
-        write_options = config.get('write_options', {})
-        self.api = InfluxDBClient(url=address, token=token).write_api(**write_options)
+        self.write_options = config.get('write_options', {})
+        self.client = InfluxDBClient(url=address, token=token)
+        self.api = self.client.write_api(**self.write_options)
         self.bucket = config.get('bucket', 'hazelsync')
     def register(self, metrics: List[Metric]):
         '''Registrating a metric'''
@@ -133,6 +141,8 @@ class Influxdb2(MetricEngine):
         '''Terminating all batches'''
         log.debug('Flushing the API write batch')
         self.api.close()
+        # Closing the write API flushes its batches, a new one is needed for the next metrics
+        self.api = self.client.write_api(**self.write_options)
 
 def get_metrics_engine(config: dict) -> MetricEngine:
     '''Detect the metric engine used by the config
@@ -2,7 +2,7 @@
 
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List
+from typing import Iterator, List, Optional
 from dataclasses import dataclass
 from enum import Enum
 from logging import getLogger
@@ -120,8 +120,10 @@ class Report:
         return reports
 
     @staticmethod
-    def last_report(cluster: str) -> 'Report':
-        '''Return the last know report'''
+    def last_report(cluster: str, job_type: Optional[str] = None) -> 'Report':
+        '''Return the last know report
+        :param job_type: Only consider the reports of a type of job (`backup` or `restore`).
+        '''
         path = Report.directory / cluster
         if path.is_dir():
             log.debug("Directory %s exists", path)
@@ -129,9 +131,25 @@ class Report:
             log.debug("Found paths: %s", paths)
         else:
             raise Exception(f"No reports found at {path}: No such directory")
-        path = sorted(paths)[-1]
-        report = Report.read(path)
-        return report
+        for report_path in sorted(paths, reverse=True):
+            report = Report.read(report_path)
+            if job_type is None or report.job_type == job_type:
+                return report
+        kind = f"{job_type} reports" if job_type else "reports"
+        raise Exception(f"No {kind} found at {path}")
+
+    @staticmethod
+    def history(cluster: str) -> Iterator['Report']:
+        '''Iterate over the reports of a cluster, from the newest to the oldest'''
+        path = Report.directory / cluster
+        if not path.is_dir():
+            log.debug("No reports found at %s", path)
+            return
+        for report_path in sorted(path.glob('*.yaml'), reverse=True):
+            try:
+                yield Report.read(report_path)
+            except Exception as err:  # pylint: disable=broad-except
+                log.error("Cannot read report at %s: %s", report_path, err)
 
     @staticmethod
     def read(path: Path) -> 'Report':
@@ -0,0 +1,69 @@
+'''Choose the snapshots to keep and the ones to prune'''
+
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from hazelsync.backend import Snapshot
+from hazelsync.utils.time import duration_parser
+
+# Functions giving the period a snapshot time belongs to
+PERIODS: Dict[str, Callable[[datetime], tuple]] = {
+    'hourly': lambda time: (time.date(), time.hour),
+    'daily': lambda time: (time.date(),),
+    'weekly': lambda time: tuple(time.isocalendar()[:2]),
+    'monthly': lambda time: (time.year, time.month),
+}
+
+class Retention:
+    '''A retention policy.
+    The newest snapshot of each period (hour, day, week, month) is kept for the duration
+    given to the period, in addition to the last snapshots.
+    '''
+    def __init__(self,
+        keep_last: int = 1,
+        hourly: Optional[str] = None,
+        daily: Optional[str] = None,
+        weekly: Optional[str] = None,
+        monthly: Optional[str] = None,
+    ):
+        '''
+        :param keep_last: Number of snapshots of each slot to keep whatever their age.
+        :param hourly: How long to keep a snapshot per hour (a duration like `2d`).
+        :param daily: How long to keep a snapshot per day.
+        :param weekly: How long to keep a snapshot per week.
+        :param monthly: How long to keep a snapshot per month.
+        '''
+        self.keep_last = keep_last
+        durations = {'hourly': hourly, 'daily': daily, 'weekly': weekly, 'monthly': monthly}
+        self.durations = {
+            period: duration_parser(str(duration))
+            for period, duration in durations.items()
+            if duration
+        }
+
+    def keep(self, snapshots: List[Snapshot], now: datetime) -> List[Snapshot]:
+        '''Return the snapshots of a slot to keep'''
+        ordered = sorted(snapshots, key=lambda snapshot: snapshot.time, reverse=True)
+        keep = ordered[:self.keep_last]
+        for period, duration in self.durations.items():
+            seen = set()
+            for snapshot in ordered:
+                if snapshot.time < now - duration:
+                    break
+                key = PERIODS[period](snapshot.time)
+                if key not in seen:
+                    seen.add(key)
+                    keep.append(snapshot)
+        return keep
+
+    def expired(self, snapshots: List[Snapshot], now: datetime) -> List[Snapshot]:
+        '''Return the snapshots to prune, slot by slot'''
+        slots = defaultdict(list)
+        for snapshot in snapshots:
+            slots[snapshot.slot].append(snapshot)
+        expired = []
+        for slot_snapshots in slots.values():
+            keep = {id(snapshot) for snapshot in self.keep(slot_snapshots, now)}
+            expired += [snapshot for snapshot in slot_snapshots if id(snapshot) not in keep]
+        return sorted(expired, key=lambda snapshot: (snapshot.slot, snapshot.time))
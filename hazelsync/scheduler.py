@@ -0,0 +1,104 @@
+'''Run the backups of all the configured clusters'''
+
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from logging import getLogger
+from typing import Dict, List
+
+from hazelsync.cluster import Cluster
+from hazelsync.reports import Report
+from hazelsync.settings import ClusterSettings, GlobalSettings, SettingError, DEFAULT_SETTINGS
+
+log = getLogger('hazelsync')
+
+class Scheduler:
+    '''Run the backups of the clusters when they are due, a few at a time.
+    The clusters with the highest priority are started first, and the number of
+    backups running at the same time is capped globally and per backend type.
+    '''
+    def __init__(self, global_path=DEFAULT_SETTINGS):
+        '''
+        :param global_path: The path of the global settings.
+        '''
+        self.global_path = global_path
+        options = GlobalSettings(global_path).scheduler
+        self.max_parallel = options.get('max_parallel', 4)
+        self.backend_limits = options.get('backend_limits', {})
+        self.interval = options.get('interval', 60)
+        for name, limit in {'max_parallel': self.max_parallel, **self.backend_limits}.items():
+            if limit < 1:
+                raise SettingError('scheduler', f"Concurrency limit {name} should be at least 1, got {limit}")
+        self.last_start = {}
+
+    def last_run(self, settings: ClusterSettings) -> datetime:
+        '''Return the start of the last backup of a cluster, or None if it never ran'''
+        last = self.last_start.get(settings.name)
+        for report in Report.history(settings.name):
+            if report.job_type == 'backup':
+                if last is None or report.start_time > last:
+                    last = report.start_time
+                break
+        return last
+
+    def due(self, now: datetime) -> List[ClusterSettings]:
+        '''Return the clusters due for a backup, in the order they should start'''
+        clusters = []
+        for name, config in sorted(ClusterSettings.list().items()):
+            if config['config_status'] != 'success':
+                continue
+            try:
+                settings = ClusterSettings(name, self.global_path)
+            except Exception as err: # pylint: disable=broad-except
+                log.error("Cannot load the settings of cluster %s: %s", name, err)
+                continue
+            last = self.last_run(settings)
+            if last is None or last + settings.every <= now:
+                clusters.append((settings, last or datetime.min))
+        clusters.sort(key=lambda item: (-item[0].priority, item[1]))
+        return [settings for settings, _ in clusters]
+
+    def backup(self, settings: ClusterSettings):
+        '''Run the backup of a cluster'''
+        log.info("Starting the backup of cluster %s", settings.name)
+        try:
+            Cluster(settings).backup()
+            log.info("Backup of cluster %s finished", settings.name)
+        except Exception as err: # pylint: disable=broad-except
+            log.exception("Backup of cluster %s failed: %s", settings.name, err)
+
+    def dispatch(self, queue: List[ClusterSettings], running: Dict, executor) -> List[ClusterSettings]:
+        '''Start the queued backups allowed by the concurrency limits, and return the ones left'''
+        left = []
+        for settings in queue:
+            backend = settings.backend_type
+            same_backend = len([s for s in running.values() if s.backend_type == backend])
+            if len(running) >= self.max_parallel or same_backend >= self.backend_limits.get(backend, self.max_parallel):
+                left.append(settings)
+                continue
+            self.last_start[settings.name] = datetime.now()
+            running[executor.submit(self.backup, settings)] = settings
+        return left
+
+    def run(self, follow: bool = False):
+        '''Run the backups due
+        :param follow: Keep running and start the backups when they become due.
+        '''
+        queue = self.due(datetime.now())
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            while queue or running or follow:
+                queue = self.dispatch(queue, running, executor)
+                if running:
+                    done, _ = wait(running, timeout=self.interval if follow else None, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        running.pop(future)
+                else:
+                    time.sleep(self.interval)
+                if follow:
+                    busy = [settings.name for settings in [*queue, *running.values()]]
+                    queue += [
+                        settings for settings in self.due(datetime.now())
+                        if settings.name not in busy
+                    ]
+                    queue.sort(key=lambda settings: -settings.priority)
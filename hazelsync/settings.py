@@ -8,6 +8,8 @@ from pathlib import Path
 import yaml
 
 from hazelsync.metrics import get_metrics_engine
+from hazelsync.utils.bandwidth import BandwidthBudget
+from hazelsync.utils.time import duration_parser
 
 DEFAULT_SETTINGS = '/etc/hazelsync.yaml'
 CLUSTER_DIRECTORY = '/etc/hazelsync.d'
@@ -64,6 +66,11 @@ class GlobalSettings:
         metrics_config = data.get('metrics', {})
         self.metrics = get_metrics_engine(metrics_config)
 
+        bandwidth_limit = data.get('bandwidth_limit')
+        self.bandwidth = BandwidthBudget(bandwidth_limit) if bandwidth_limit else None
+
+        self.scheduler = data.get('scheduler', {})
+
     def logger(self):
         '''Setup logging and return the logger'''
         logging.config.dictConfig(self.logging)
@@ -95,6 +102,14 @@ class ClusterSettings:
         self.backend_type = data.get('backend') or self.globals.default_backend
         self.backend_options = data.get('backend_options', {})
 
+        self.pipeline_snapshots = data.get('pipeline_snapshots', False)
+        self.retention = data.get('retention')
+        self.catalog = data.get('catalog', False)
+
+        schedule = data.get('schedule', {})
+        self.every = duration_parser(str(schedule.get('every', '1d')))
+        self.priority = schedule.get('priority', 0)
+
     @staticmethod
     def list() -> dict:
         '''List the backup cluster found in the settings'''
@@ -1,14 +1,87 @@
 '''Define the behavior of the SSH helper with the rsync plugin'''
 
+import os
+import shlex
+import sys
+import time
 from logging import getLogger
+from pathlib import Path
+from typing import Dict, Tuple
 
+from hazelsync.ssh import Unauthorized
 from hazelsync.ssh.rsync import RsyncSsh
-from hazelsync.job.pgsql import PRE_SCRIPT, POST_SCRIPT
+from hazelsync.job.pgsql import PRE_SCRIPT, POST_SCRIPT, LAG_SCRIPT, WATCH_COMMAND, WATCH_PREFIX
 
 log = getLogger('hazelsync')
 
+# Seconds between two scans of the WAL directory when watching it
+WATCH_SCAN_INTERVAL = 0.5
+
+def scan_wal(directory: Path) -> Dict[str, Tuple[int, int]]:
+    '''Return the size and modification time of the files of a WAL directory'''
+    files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # Hidden files are temporary files of the archive command
+            if entry.name.startswith('.') or not entry.is_file(follow_symlinks=False):
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+def watch_wal(directory: Path, timeout: int, output=None, interval: float = WATCH_SCAN_INTERVAL):
+    '''Print the name of the WAL files of a directory when they are complete, until the timeout.
+    A file is complete when it did not change between two scans.
+    :param directory: The WAL directory to watch.
+    :param timeout: Seconds to watch the directory.
+    :param output: The stream to print the names to (standard output by default).
+    :param interval: Seconds between two scans.
+    '''
+    output = output or sys.stdout
+    deadline = time.monotonic() + timeout
+    previous = {}
+    notified = set()
+    while True:
+        current = scan_wal(directory)
+        for name, state in sorted(current.items()):
+            if name not in notified and previous.get(name) == state:
+                print(f"{WATCH_PREFIX} {name}", file=output, flush=True)
+                notified.add(name)
+        # Forget the files pulled (and removed) to keep the set small
+        notified &= set(current)
+        previous = current
+        if time.monotonic() >= deadline:
+            return
+        time.sleep(interval)
+
 class PgsqlSsh(RsyncSsh):
     '''A class to handle the client authorization'''
     def __init__(self, config):
         super().__init__(config)
-        self.allowed_scripts = [PRE_SCRIPT, POST_SCRIPT]
+        self.allowed_scripts = [PRE_SCRIPT, POST_SCRIPT, LAG_SCRIPT]
+
+    def authorize(self, cmd_line: str):
+        if cmd_line.split(' ')[0] == WATCH_COMMAND:
+            self.authorize_watch(cmd_line)
+            return
+        super().authorize(cmd_line)
+
+    def authorize_watch(self, cmd_line: str) -> Tuple[Path, int]:
+        '''Check a WAL watch command, and return the directory and timeout to watch'''
+        args = shlex.split(cmd_line)
+        if len(args) != 3 or not args[2].isdigit():
+            raise Unauthorized(f"Unauthorized watch arguments: {cmd_line}")
+        if cmd_line != ' '.join(map(shlex.quote, args)):
+            raise Unauthorized(f"Unauthorized watch quoting: {cmd_line}")
+        directory = Path(args[1])
+        self.authorize_path(directory)
+        return directory, int(args[2])
+
+    def run(self, cmd_line: str):
+        '''Watch the WAL directory in the helper itself, and run the other commands'''
+        if cmd_line.split(' ')[0] == WATCH_COMMAND:
+            directory, timeout = self.authorize_watch(cmd_line)
+            log.info("Watching %s for %ds", directory, timeout)
+            watch_wal(directory, timeout)
+            return
+        super().run(cmd_line)
@@ -1,5 +1,7 @@
 '''Define the behavior of the SSH helper with the rsync plugin'''
 
+import re
+import shlex
 from logging import getLogger
 from pathlib import Path
 
@@ -7,6 +9,10 @@ from hazelsync.ssh import SshHelper, Unauthorized
 
 log = getLogger('hazelsync')
 
+# Arguments of the `find` command listing changed files and directories (rsync job with `changed_only`).
+# `-not -type d` is still accepted for the older clients only listing the files.
+FIND_ARGUMENTS = re.compile(r'^-newerct @\d+ (-not -type d )?-print0$')
+
 class RsyncSsh(SshHelper):
     '''A class to handle the client authorization'''
     def __init__(self, config):
@@ -32,16 +38,34 @@ class RsyncSsh(SshHelper):
             return
 
         if cmd[0] == 'rsync':
-            log.debug("Rsync command. Will check path.")
-            path_to_sync = Path(cmd[-1])
-            for path in self.allowed_paths:
-                log.debug("Checking if `%s` is among `%s`", path_to_sync, self.allowed_paths)
-                if path_to_sync == path:
-                    log.info("%s is in allowed path", path_to_sync)
-                    return
-                if path in path_to_sync.parents:
-                    log.info("%s is in allowed path (children of %s)", path_to_sync, path)
-                    return
-            raise Unauthorized(f"Unauthorized backup path requested: {path_to_sync}")
+            log.debug("Rsync command. Will check paths.")
+            # Sources come after the `.` argument, and there can be several of them
+            paths_to_sync = cmd[cmd.index('.')+1:] if '.' in cmd[:-1] else cmd[-1:]
+            for path_to_sync in paths_to_sync:
+                self.authorize_path(Path(path_to_sync))
+            return
+
+        if cmd[0] == 'find':
+            log.debug("Find command. Will check path and arguments.")
+            args = shlex.split(cmd_line)
+            if len(args) < 2 or not FIND_ARGUMENTS.match(' '.join(args[2:])):
+                raise Unauthorized(f"Unauthorized find arguments: {cmd_line}")
+            # The command is run by a shell, so it should not contain anything the shell would expand
+            if cmd_line != ' '.join(map(shlex.quote, args)):
+                raise Unauthorized(f"Unauthorized find quoting: {cmd_line}")
+            self.authorize_path(Path(args[1]))
+            return
 
         raise Unauthorized(f"Unauthorized command: {cmd_line}")
+
+    def authorize_path(self, path_to_sync: Path):
+        '''Return an exception if a path is not among the allowed paths'''
+        for path in self.allowed_paths:
+            log.debug("Checking if `%s` is among `%s`", path_to_sync, self.allowed_paths)
+            if path_to_sync == path:
+                log.info("%s is in allowed path", path_to_sync)
+                return
+            if path in path_to_sync.parents:
+                log.info("%s is in allowed path (children of %s)", path_to_sync, path)
+                return
+        raise Unauthorized(f"Unauthorized backup path requested: {path_to_sync}")
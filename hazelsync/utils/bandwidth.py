@@ -0,0 +1,95 @@
+'''Share a bandwidth budget between concurrent transfers'''
+
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from logging import getLogger
+from pathlib import Path
+
+from filelock import FileLock
+
+BANDWIDTH_DIRECTORY = Path('/run/hazelsync/bandwidth')
+# Seconds between two checks of the budget left when it is all used
+POLL_INTERVAL = 1.0
+
+log = getLogger('hazelsync')
+
+def pid_alive(pid: int) -> bool:
+    '''Check if a process is still running'''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class BandwidthBudget:
+    '''A bandwidth budget shared between the transfers running at the same time,
+    including the ones of other hazelsync processes.
+    Each running transfer is registered in a directory with the limit it was given.
+    The limit of a running transfer cannot change, so a new transfer gets the budget left by
+    the others, capped to an equal share of the budget between the transfers running and the ones
+    expected to run at the same time (the hosts run in parallel and the shards of a job), so that
+    the transfers starting next are not starved. It waits for a running transfer to end when all
+    the budget is used.
+    '''
+    directory = BANDWIDTH_DIRECTORY
+    poll_interval = POLL_INTERVAL
+
+    def __init__(self, limit: int):
+        '''
+        :param limit: The total bandwidth allowed, in KiB/s (the unit of rsync `--bwlimit`).
+        '''
+        self.limit = limit
+
+    def running(self) -> dict:
+        '''Return the limits of the transfers running, and clean the stale ones'''
+        transfers = {}
+        for path in self.directory.glob('*.json'):
+            try:
+                data = json.loads(path.read_text(encoding='utf-8'))
+            except (OSError, ValueError):
+                continue
+            if pid_alive(data['pid']):
+                transfers[path.name] = data['limit']
+            else:
+                log.debug("Removing stale bandwidth registration %s", path)
+                path.unlink()
+        return transfers
+
+    def reserve(self, path: Path, expected: int = 1) -> int:
+        '''Register a transfer with the bandwidth left, or return 0 if all the budget is used
+        :param expected: The number of transfers expected to run at the same time, including this one.
+        '''
+        with FileLock(str(self.directory / '.lock')):
+            others = self.running()
+            free = self.limit - sum(others.values())
+            # Keep a share of the budget for the expected transfers not started yet
+            fair = self.limit // max(len(others) + 1, expected)
+            limit = min(free, max(fair, 1))
+            if limit < 1:
+                return 0
+            path.write_text(json.dumps({'pid': os.getpid(), 'limit': limit}), encoding='utf-8')
+        log.debug("Bandwidth limit of %d KiB/s (%d other transfers running)", limit, len(others))
+        return limit
+
+    @contextmanager
+    def share(self, expected: int = 1):
+        '''Register a transfer during the context, and give the bandwidth limit it should use
+        :param expected: The number of transfers expected to run at the same time, including this one.
+        '''
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"{os.getpid()}-{uuid.uuid4().hex}.json"
+        limit = self.reserve(path, expected)
+        if not limit:
+            log.info("Bandwidth budget of %d KiB/s used, waiting for a transfer to end", self.limit)
+        while not limit:
+            time.sleep(self.poll_interval)
+            limit = self.reserve(path, expected)
+        try:
+            yield limit
+        finally:
+            path.unlink()
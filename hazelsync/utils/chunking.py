@@ -0,0 +1,146 @@
+'''Split files into content-defined chunks'''
+
+import hashlib
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+try:
+    import numpy
+except ImportError:
+    # Optional dependency (hazelsync[dedup]): without it, the chunks are cut byte by byte
+    numpy = None
+
+# Random 64 bits values of the gear hash, one per byte value (derived from sha256 so that
+# the chunk boundaries never change between versions)
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big') for i in range(256)]
+MASK_64 = (1 << 64) - 1
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64) if numpy else None
+# A gear hash only depends on the last 64 bytes (older bytes are shifted out)
+WINDOW = 64
+READ_SIZE = 4 * 1024 * 1024
+# Number of bytes hashed at once by the vectorized scan
+HASH_BLOCK = 32 * 1024
+
+MIN_SIZE = 16 * 1024
+AVERAGE_SIZE = 64 * 1024
+MAX_SIZE = 256 * 1024
+
+def boundary_mask(average_size: int) -> int:
+    '''Return the mask of the hash bits that must be zero at a chunk boundary,
+    using the highest bits (the ones depending on the most bytes)
+    '''
+    bits = average_size.bit_length() - 1
+    return ((1 << bits) - 1) << (64 - bits)
+
+def find_boundary(data: bytes, start: int, min_size: int, mask: int, max_size: int) -> int:
+    '''Return the end of the chunk starting at a given offset of some data, cut where the
+    gear hash of the last bytes matches the mask, between the minimum and maximum sizes
+    '''
+    end = min(len(data), start + max_size)
+    if end <= start + min_size:
+        return end
+    digest = 0
+    # Skip the bytes that cannot be a boundary, except the ones the hash of the first candidate depends on
+    for i in range(start + max(min_size - WINDOW, 0), end):
+        digest = ((digest << 1) + GEAR[data[i]]) & MASK_64
+        if i >= start + min_size and not digest & mask:
+            return i + 1
+    return end
+
+def gear_hashes(data) -> 'numpy.ndarray':
+    '''Return the gear hash at each position of some data, with vectorized operations.
+    The hash at a position only depends on the last `WINDOW` bytes, so it is the sum of their
+    gear values shifted by their distance. The sums are built by doubling the number of bytes
+    they cover: h2n(i) = hn(i) + (hn(i - n) << n).
+    '''
+    hashes = numpy.take(GEAR_ARRAY, numpy.frombuffer(data, dtype=numpy.uint8))
+    shifted = numpy.empty_like(hashes)
+    span = 1
+    while span < WINDOW:
+        # The shifts and additions wrap around 64 bits, like MASK_64
+        numpy.left_shift(hashes[:-span], numpy.uint64(span), out=shifted[span:])
+        numpy.add(hashes[span:], shifted[span:], out=hashes[span:])
+        span *= 2
+    return hashes
+
+def boundary_candidates(data: bytes, mask: int) -> 'numpy.ndarray':
+    '''Return the (sorted) positions of some data where the gear hash matches the mask.
+    The data is hashed by blocks, so that the arrays stay in the CPU cache.
+    '''
+    view = memoryview(data)
+    candidates = [numpy.empty(0, dtype=numpy.intp)]
+    for offset in range(0, len(data), HASH_BLOCK):
+        # The hashes of a block depend on the bytes before it
+        first = max(offset - WINDOW + 1, 0)
+        hashes = gear_hashes(view[first:offset + HASH_BLOCK])[offset - first:]
+        candidates.append(numpy.flatnonzero((hashes & numpy.uint64(mask)) == 0) + offset)
+    return numpy.concatenate(candidates)
+
+def next_boundary(candidates: 'numpy.ndarray', start: int, length: int, min_size: int, max_size: int) -> int:
+    '''Return the end of the chunk starting at a given offset, like `find_boundary`, from the
+    positions of the data where the hash matches the mask
+    '''
+    end = min(length, start + max_size)
+    if end <= start + min_size:
+        return end
+    index = numpy.searchsorted(candidates, start + min_size)
+    if index < len(candidates) and candidates[index] < end:
+        return int(candidates[index]) + 1
+    return end
+
+def chunk_stream(stream: BinaryIO,
+    min_size: int = MIN_SIZE,
+    average_size: int = AVERAGE_SIZE,
+    max_size: int = MAX_SIZE,
+) -> Iterator[bytes]:
+    '''Split a stream into content-defined chunks.
+    Inserting or removing data only changes the chunks around the change, so the other chunks
+    are deduplicated with the ones of the previous versions.
+    '''
+    mask = boundary_mask(average_size)
+    # The hashes of the whole buffer are the ones of each chunk when the first candidate of a chunk
+    # is far enough from its start to not depend on the bytes before it
+    vectorized = numpy is not None and min_size >= WINDOW
+    candidates = None
+    buffer = b''
+    start = 0
+    eof = False
+    while start < len(buffer) or not eof:
+        if not eof and len(buffer) - start < max_size:
+            data = stream.read(max(READ_SIZE, max_size))
+            eof = not data
+            buffer = buffer[start:] + data
+            start = 0
+            candidates = None
+            continue
+        if vectorized:
+            if candidates is None:
+                candidates = boundary_candidates(buffer, mask)
+            end = next_boundary(candidates, start, len(buffer), min_size, max_size)
+        else:
+            end = find_boundary(buffer, start, min_size, mask, max_size)
+        yield buffer[start:end]
+        start = end
+
+def chunk_file(path: str, min_size: int = MIN_SIZE, average_size: int = AVERAGE_SIZE,
+    max_size: int = MAX_SIZE) -> Tuple[str, List[Tuple[str, int]]]:
+    '''Return the sha256 of a file, and the sha256 and length of its chunks'''
+    digest = hashlib.sha256()
+    chunks = []
+    with open(path, 'rb') as stream:
+        for chunk in chunk_stream(stream, min_size, average_size, max_size):
+            digest.update(chunk)
+            chunks.append((hashlib.sha256(chunk).hexdigest(), len(chunk)))
+    return digest.hexdigest(), chunks
+
+def chunk_files(paths: List[str], min_size: int = MIN_SIZE, average_size: int = AVERAGE_SIZE,
+    max_size: int = MAX_SIZE) -> List[Optional[Tuple[str, List[Tuple[str, int]]]]]:
+    '''Return the digests and chunks of several files (to process a batch of small files in a worker),
+    or None for the files that do not exist anymore
+    '''
+    results = []
+    for path in paths:
+        try:
+            results.append(chunk_file(path, min_size, average_size, max_size))
+        except FileNotFoundError:
+            results.append(None)
+    return results
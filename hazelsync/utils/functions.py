@@ -1,7 +1,14 @@
 '''Some utils functions'''
 
 import os
+import subprocess #nosec
+from logging import getLogger
 from pathlib import Path
+from typing import Dict
+
+from hazelsync.utils.rsync import PATH
+
+log = getLogger('hazelsync')
 
 CA_BUNDLE_PATHS = [
     '/etc/ssl/certs/ca-certificates.crt', # Debian / Ubuntu / Gentoo
@@ -22,3 +29,22 @@ def ca_bundle():
         if Path(ca_path).exists():
             return ca_path
     return None
+
+def disk_usage(directory: Path) -> Dict[str, int]:
+    '''Return the apparent size (in bytes) of each entry at the top of a directory.
+    Entries that cannot be read are counted with the size du could read.
+    '''
+    if not directory.is_dir():
+        return {}
+    cmd = ['du', '--apparent-size', '--block-size=1', '--max-depth=1', '--all', str(directory)]
+    proc = subprocess.run(cmd, shell=False, check=False, #nosec
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=dict(PATH=PATH))
+    if proc.returncode != 0:
+        log.warning("Could not measure all the entries of %s: %s", directory, proc.stderr.decode(errors='replace'))
+    sizes = {}
+    for line in proc.stdout.decode(errors='replace').splitlines():
+        size, path = line.split('\t', 1)
+        path = Path(path)
+        if path != directory:
+            sizes[path.name] = int(size)
+    return sizes
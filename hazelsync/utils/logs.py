@@ -0,0 +1,51 @@
+'''Route the log lines of the threads of a cluster to the log file of the cluster'''
+
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from logging import Filter, LogRecord
+from typing import Callable, Optional
+
+# Cluster each thread is working for, by thread identifier
+THREAD_CLUSTERS = {}
+
+def current_cluster() -> Optional[str]:
+    '''Return the cluster the current thread is working for'''
+    return THREAD_CLUSTERS.get(threading.get_ident())
+
+@contextmanager
+def cluster_context(cluster: Optional[str]):
+    '''Mark the current thread as working for a cluster during the context'''
+    ident = threading.get_ident()
+    previous = THREAD_CLUSTERS.get(ident)
+    if cluster is None:
+        THREAD_CLUSTERS.pop(ident, None)
+    else:
+        THREAD_CLUSTERS[ident] = cluster
+    try:
+        yield
+    finally:
+        if previous is None:
+            THREAD_CLUSTERS.pop(ident, None)
+        else:
+            THREAD_CLUSTERS[ident] = previous
+
+def inherit_cluster(func: Callable) -> Callable:
+    '''Wrap a function run in another thread (of a thread pool), so that it works for the
+    cluster of the thread creating the wrapper
+    '''
+    cluster = current_cluster()
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with cluster_context(cluster):
+            return func(*args, **kwargs)
+    return wrapper
+
+class ClusterFilter(Filter):
+    '''Only keep the log records of the threads working for a cluster'''
+    def __init__(self, cluster: str):
+        super().__init__()
+        self.cluster = cluster
+
+    def filter(self, record: LogRecord) -> bool:
+        return THREAD_CLUSTERS.get(record.thread) == self.cluster
@@ -1,10 +1,17 @@
 '''Utils for running rsync commands'''
 
 import os
+import re
 import subprocess #nosec
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack
 from logging import getLogger
 from pathlib import Path
-from typing import Optional, List
+from typing import Callable, Iterator, Optional, List, Set, Union
+
+from hazelsync.utils.bandwidth import BandwidthBudget
 
 log = getLogger('hazelsync')
 
@@ -21,14 +28,72 @@ DEFAULT_PATH = ':'.join([
 # We need to use DEFAULT_PATH even when PATH return empty string.
 PATH = os.environ.get('PATH') or DEFAULT_PATH
 
+# Return codes of rsync meaning only some files could not be transferred
+PARTIAL_RETURN_CODES = [23, 24]
+# Return codes of rsync that will not change by running it again
+# (syntax error, incompatible protocol, unsupported action and files that cannot be transferred)
+PERMANENT_RETURN_CODES = [1, 2, 4, *PARTIAL_RETURN_CODES]
+# Paths are quoted in rsync error messages (e.g. `rsync: [sender] link_stat "/data" failed: ...`)
+QUOTED_PATH = re.compile(r'"(/[^"]*)"')
+
+# Lines of `--info=progress2`, e.g. `  1,234,567  12%   10.52MB/s    0:00:03 (xfr#5, to-chk=100/200)`
+PROGRESS_LINE = re.compile(r'^\s*(?P<bytes>[\d,]+)\s+(?P<percent>\d+)%\s+(?P<rate>[\d.,]+)(?P<unit>[kMGT]?)B/s\s')
+RATE_UNITS = {'': 1, 'k': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+# Lines of `--stats`
+STATS_LINES = {
+    'files': re.compile(r'^Number of files: ([\d,]+)'),
+    'files_transferred': re.compile(r'^Number of (?:regular )?files transferred: ([\d,]+)'),
+    'total_size': re.compile(r'^Total file size: ([\d,]+) bytes'),
+    'transferred_size': re.compile(r'^Total transferred file size: ([\d,]+) bytes'),
+    'literal_bytes': re.compile(r'^Literal data: ([\d,]+) bytes'),
+    'matched_bytes': re.compile(r'^Matched data: ([\d,]+) bytes'),
+    'bytes_sent': re.compile(r'^Total bytes sent: ([\d,]+)'),
+    'bytes_received': re.compile(r'^Total bytes received: ([\d,]+)'),
+    'speedup': re.compile(r'^total size is [\d,]+\s+speedup is ([\d.,]+)'),
+}
+# Compression codecs, from the cheapest to the strongest
+CODECS = ['none', 'lz4', 'zstd']
+ZSTD_LEVEL = 3
+# Thresholds (in bytes/s received) under which the link is slow, and above which it is fast
+SLOW_LINK_RATE = 10 * 1024**2
+FAST_LINK_RATE = 100 * 1024**2
+# Share of a CPU used by the local rsync above which the transfer is considered CPU bound.
+# In a backup the local rsync is the receiver, which decompresses: the sender compressing uses
+# several times more CPU, so it is already saturated when the receiver is half busy.
+CPU_BOUND = 0.5
+# Only keep the end of stderr in memory
+STDERR_MAX_LINES = 1000
+READ_SIZE = 64 * 1024
+
 class RsyncError(RuntimeError):
     '''Error issued when the rsync command fails'''
     def __init__(self, err):
+        self.cmd = err.cmd
+        self.returncode = err.returncode
+        self.stderr = err.stderr.decode(errors='replace') if isinstance(err.stderr, bytes) else err.stderr
         super().__init__(f"Error during command `{err.cmd}` (return code {err.returncode}): {err.stderr}")
 
+def failed_paths(err: RsyncError, paths: List[Path]) -> Set[Path]:
+    '''Return the paths affected by the errors of an rsync run with multiple sources.
+    Fall back to all the paths when the errors cannot be attributed.
+    :param err: The error raised by the rsync run.
+    :param paths: The source paths given to rsync.
+    '''
+    if err.returncode not in PARTIAL_RETURN_CODES or not err.stderr:
+        return set(paths)
+    failed = set()
+    for line in err.stderr.splitlines():
+        for match in QUOTED_PATH.findall(line):
+            match = Path(match)
+            owners = [path for path in paths if path == match or path in match.parents]
+            if not owners:
+                return set(paths)
+            failed.update(owners)
+    return failed or set(paths)
+
 # pylint: disable=too-many-arguments
 def rsync_run(
-    source: Path,
+    source: Union[Path, List[Path]],
     destination: Path,
     options: Optional[List[str]] = None,
     source_host: Optional[str] = None,
@@ -38,35 +103,231 @@ def rsync_run(
     ssh_options: Optional[List[str]] = None,
     user: str = 'root',
     private_key: Optional[Path] = None,
-):
-    '''Run a sanitized rsync command'''
-    if options is None:
-        options = []
-    if ssh_options is None:
-        ssh_options = []
-    source = f"{user}@{source_host}:{source}/" if source_host else f"{source}/"
-    destination = f"{dest_host}:{destination}/" if dest_host else f"{destination}/"
+    progress: Optional[Callable[[dict], None]] = None,
+    trailing_slash: bool = True,
+    bandwidth: Optional[BandwidthBudget] = None,
+    transfers: int = 1,
+) -> dict:
+    '''Run a sanitized rsync command.
+    Several sources can be given to transfer them with a single rsync process.
+    :param progress: A function called with the progress of the transfer while it runs.
+    :param trailing_slash: Whether to add a trailing slash to the sources (disable it when some are files).
+    :param bandwidth: A bandwidth budget to take the bandwidth limit of the transfer from.
+    :param transfers: The number of transfers expected to run at the same time, sharing the bandwidth budget.
+    :returns: The statistics of the transfer (when rsync is run with `--stats`).
+    '''
+    options = list(options or [])
+    sources = source if isinstance(source, (list, tuple)) else [source]
+    slash = '/' if trailing_slash else ''
+    sources = [f"{user}@{source_host}:{src}{slash}" if source_host else f"{src}{slash}" for src in sources]
+    destination = f"{user}@{dest_host}:{destination}/" if dest_host else f"{destination}/"
     if includes is not None:
         for inc in includes:
             options += ['--include', inc]
     if excludes is not None:
         for exc in excludes:
             options += ['--exclude', exc]
+    options += rsh_options(ssh_options, private_key)
+    if progress:
+        options += ['--info=progress2']
+    with ExitStack() as stack:
+        if bandwidth:
+            options += ['--bwlimit', str(stack.enter_context(bandwidth.share(transfers)))]
+        cmd = ['rsync', *options, *sources, destination]
+        log.debug('Running command: %s', cmd)
+        return execute(cmd, progress)
+
+def rsh_options(ssh_options: Optional[List[str]] = None, private_key: Optional[Path] = None) -> List[str]:
+    '''Return the rsync options to use a customized ssh command'''
+    ssh_options = list(ssh_options or [])
     if private_key:
         ssh_options += ['-i', str(private_key)]
     if ssh_options:
-        ssh_string = 'ssh ' + ' '.join(ssh_options)
-        options += ['--rsh', ssh_string]
-    cmd = ['rsync', *options, source, destination]
-    log.debug('Running command: %s', cmd)
-    execute(cmd)
+        return ['--rsh', 'ssh ' + ' '.join(ssh_options)]
+    return []
 
-def execute(cmd):
-    '''Execute a command and log properly'''
+def rsync_list(
+    source: Path,
+    source_host: Optional[str] = None,
+    ssh_options: Optional[List[str]] = None,
+    user: str = 'root',
+    private_key: Optional[Path] = None,
+) -> List[dict]:
+    '''List the entries at the top of a directory with rsync.
+    Each entry is a dict with its name, size (in bytes) and whether it is a directory.
+    '''
+    source = f"{user}@{source_host}:{source}/" if source_host else f"{source}/"
+    cmd = ['rsync', '--list-only', *rsh_options(ssh_options, private_key), source]
+    log.debug('Running command: %s', cmd)
     try:
         proc = subprocess.run(cmd, shell=False, check=True, #nosec
             stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=dict(PATH=PATH))
-        for line in proc.stdout.split(b'\n'):
-            log.debug(line)
     except subprocess.CalledProcessError as err:
-        raise Exception(f"Error during command `{err.cmd}` (return code {err.returncode}): {err.stderr}") from err
+        raise RsyncError(err) from err
+    entries = []
+    for line in proc.stdout.decode(errors='replace').splitlines():
+        # e.g. `drwxr-xr-x          4,096 2021/05/01 10:00:00 name`
+        fields = line.split(None, 4)
+        if len(fields) != 5 or fields[4] == '.':
+            continue
+        entries.append({'name': fields[4], 'size': parse_number(fields[1]), 'dir': fields[0].startswith('d')})
+    return entries
+
+def split_shards(weights: dict, count: int) -> List[list]:
+    '''Split weighted items into a number of shards of balanced total weight.
+    The heaviest items are placed first, each in the lightest shard so far.
+    Empty shards are dropped.
+    '''
+    shards = [[] for _ in range(count)]
+    totals = [0] * count
+    for item in sorted(weights, key=lambda item: weights[item], reverse=True):
+        lightest = totals.index(min(totals))
+        shards[lightest].append(item)
+        totals[lightest] += weights[item]
+    return [shard for shard in shards if shard]
+
+def merge_stats(stats_list: List[dict], spans: Optional[List[tuple]] = None) -> dict:
+    '''Merge the statistics of several transfers into one
+    :param spans: The (start, end) times of the transfers. When given, `seconds` is the wall-clock
+        time during which at least one transfer was running (the transfers can run at the same time),
+        and `rsync_seconds` the sum of the times of the transfers.
+    '''
+    merged = {}
+    for stats in stats_list:
+        for key, value in stats.items():
+            if key != 'speedup':
+                merged[key] = merged.get(key, 0) + value
+    if spans and 'seconds' in merged:
+        merged['rsync_seconds'] = merged['seconds']
+        merged['seconds'] = round(wall_seconds(spans), 3)
+    exchanged = merged.get('bytes_sent', 0) + merged.get('bytes_received', 0)
+    if 'total_size' in merged and exchanged:
+        # Same definition as rsync
+        merged['speedup'] = round(merged['total_size'] / exchanged, 2)
+    return merged
+
+def wall_seconds(spans: List[tuple]) -> float:
+    '''Return the time covered by some (start, end) intervals, counting their overlaps once'''
+    total = 0.0
+    current_start, current_end = None, None
+    for start, end in sorted(spans):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+def compression_options(codec: str) -> List[str]:
+    '''Return the rsync options to use a compression codec'''
+    if codec == 'none':
+        return []
+    options = ['--compress', f"--compress-choice={codec}"]
+    if codec == 'zstd':
+        options += [f"--compress-level={ZSTD_LEVEL}"]
+    return options
+
+def choose_compression(previous: Optional[dict] = None) -> str:
+    '''Choose the compression codec of a transfer from the codec and statistics of the previous one.
+    The compression is made cheaper when rsync was CPU bound on a fast link, and stronger
+    when the link was slow while rsync had CPU to spare.
+    The CPU is the one used by the local rsync (the receiver of a backup), per rsync process.
+    :param previous: The codec and statistics (`codec`, `bytes_received`, `seconds` of wall-clock
+        time, `cpu_seconds` of local CPU time, and `rsync_seconds` of the rsync processes if some
+        of them ran at the same time).
+    '''
+    if not previous or previous.get('codec') not in CODECS or not previous.get('seconds'):
+        return 'lz4'
+    index = CODECS.index(previous['codec'])
+    rate = previous.get('bytes_received', 0) / previous['seconds']
+    cpu = previous.get('cpu_seconds', 0) / (previous.get('rsync_seconds') or previous['seconds'])
+    if rate >= FAST_LINK_RATE:
+        index = 0
+    elif cpu >= CPU_BOUND and rate >= SLOW_LINK_RATE:
+        index = max(index - 1, 0)
+    elif cpu < CPU_BOUND and rate < SLOW_LINK_RATE:
+        index = min(index + 1, len(CODECS) - 1)
+    return CODECS[index]
+
+def parse_number(text: str) -> Union[int, float]:
+    '''Parse a number printed by rsync (with thousands separators)'''
+    text = text.replace(',', '')
+    return float(text) if '.' in text else int(text)
+
+def parse_progress(line: str) -> Optional[dict]:
+    '''Parse a line of `--info=progress2` output.
+    Returns None if the line is not a progress line.
+    '''
+    match = PROGRESS_LINE.match(line)
+    if not match:
+        return None
+    return {
+        'bytes': parse_number(match.group('bytes')),
+        'percent': int(match.group('percent')),
+        'rate': parse_number(match.group('rate')) * RATE_UNITS[match.group('unit')],
+    }
+
+def parse_stat(line: str) -> Optional[tuple]:
+    '''Parse a line of `--stats` output.
+    Returns a (key, value) tuple, or None if the line is not a statistic.
+    '''
+    for key, regex in STATS_LINES.items():
+        match = regex.match(line)
+        if match:
+            return key, parse_number(match.group(1))
+    return None
+
+def iter_lines(stream) -> Iterator[str]:
+    '''Iterate over the lines of a binary stream as they arrive.
+    Carriage returns are considered as line ends, since rsync uses them to redraw its progress.
+    '''
+    buffer = b''
+    while True:
+        chunk = stream.read1(READ_SIZE) if hasattr(stream, 'read1') else stream.read(READ_SIZE)
+        if not chunk:
+            break
+        buffer += chunk
+        *lines, buffer = re.split(b'[\r\n]', buffer)
+        for line in lines:
+            if line:
+                yield line.decode(errors='replace')
+    if buffer:
+        yield buffer.decode(errors='replace')
+
+def execute(cmd, progress: Optional[Callable[[dict], None]] = None) -> dict:
+    '''Execute a command and log properly.
+    The output is processed while the command runs instead of being buffered.
+    :param progress: A function called with each progress line parsed.
+    :returns: The statistics parsed from the output.
+    '''
+    stats = {}
+    stderr = deque(maxlen=STDERR_MAX_LINES)
+    start = time.monotonic()
+    with subprocess.Popen(cmd, shell=False, #nosec
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=dict(PATH=PATH)) as proc:
+        stderr_reader = threading.Thread(target=lambda: stderr.extend(iter_lines(proc.stderr)), daemon=True)
+        stderr_reader.start()
+        for line in iter_lines(proc.stdout):
+            current = parse_progress(line)
+            if current is not None:
+                if progress:
+                    progress(current)
+                continue
+            log.debug(line)
+            stat = parse_stat(line)
+            if stat:
+                stats[stat[0]] = stat[1]
+        stderr_reader.join()
+        # Wait with wait4 to know the CPU used by the local rsync (and the ssh it runs), not the remote one
+        _, status, rusage = os.wait4(proc.pid, 0)
+        returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        proc.returncode = returncode
+    stats['seconds'] = round(time.monotonic() - start, 3)
+    stats['cpu_seconds'] = round(rusage.ru_utime + rusage.ru_stime, 3)
+    if returncode != 0:
+        err = subprocess.CalledProcessError(returncode, cmd, stderr='\n'.join(stderr))
+        raise RsyncError(err)
+    return stats
@@ -0,0 +1,93 @@
+'''Utils for sharing a SSH connection between several commands'''
+
+import shutil
+import subprocess #nosec
+import tempfile
+from logging import getLogger
+from pathlib import Path
+from typing import List, Optional
+
+from hazelsync.utils.rsync import PATH
+
+log = getLogger('hazelsync')
+
+class SshMaster:
+    '''A multiplexed SSH master connection to a host.
+    Every SSH command using the options of the master will reuse its connection instead
+    of doing a new key exchange and authentication.
+    '''
+    def __init__(self,
+        host: str,
+        user: str = 'root',
+        private_key: Optional[Path] = None,
+        persist: int = 60,
+    ):
+        '''
+        :param host: The host to connect to.
+        :param user: The user to connect as.
+        :param private_key: The private key to use for authentication.
+        :param persist: Seconds the master stays up after its last client, in case it is not closed.
+        '''
+        self.host = host
+        self.user = user
+        self.private_key = private_key
+        self.persist = persist
+        self.control_dir = None
+        self.opened = False
+
+    @property
+    def control_path(self) -> Path:
+        '''The path of the control socket'''
+        # %C is a hash of the connection parameters, to stay below the socket path length limit
+        return self.control_dir / '%C'
+
+    def options(self) -> List[str]:
+        '''SSH options to use the master connection (if opened)'''
+        if not self.opened:
+            return []
+        return ['-o', f"ControlPath={self.control_path}"]
+
+    def base_cmd(self) -> List[str]:
+        '''Return the beginning of a SSH command line to the host'''
+        cmd = ['ssh', '-l', self.user]
+        if self.private_key:
+            cmd += ['-i', str(self.private_key)]
+        return cmd
+
+    def open(self):
+        '''Open the master connection in the background'''
+        self.control_dir = Path(tempfile.mkdtemp(prefix='hazelsync-ssh-'))
+        cmd = [*self.base_cmd(), '-M', '-N', '-f',
+            '-o', f"ControlPath={self.control_path}",
+            '-o', f"ControlPersist={self.persist}",
+            self.host]
+        log.debug("Opening SSH master connection: %s", cmd)
+        try:
+            subprocess.run(cmd, shell=False, check=True, env=dict(PATH=PATH), #nosec
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self.opened = True
+        except subprocess.CalledProcessError as err:
+            log.warning("Could not open SSH master connection to %s, continuing without: %s", self.host, err.stderr)
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+
+    def close(self):
+        '''Close the master connection'''
+        if not self.opened:
+            return
+        cmd = [*self.base_cmd(), '-O', 'exit', '-o', f"ControlPath={self.control_path}", self.host]
+        log.debug("Closing SSH master connection: %s", cmd)
+        try:
+            subprocess.run(cmd, shell=False, check=True, env=dict(PATH=PATH), #nosec
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except subprocess.CalledProcessError as err:
+            log.warning("Could not close SSH master connection to %s: %s", self.host, err.stderr)
+        finally:
+            self.opened = False
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
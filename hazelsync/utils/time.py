@@ -8,17 +8,22 @@ import pyparsing as pp
 from pyparsing import pyparsing_common as ppc
 
 FACTORS = {
+    'min': 1 / (24 * 60),
+    'h': 1 / 24,
     'd': 1,
     'w': 7,
     'm': 30,
     'y': 365,
 }
 
-DAY = (pp.Literal('d') | pp.CaselessKeyword('day') | pp.CaselessKeyword('days')).setParseAction(lambda: 'd')
-WEEK = (pp.Literal('w') | pp.CaselessKeyword('week') | pp.CaselessKeyword('weeks')).setParseAction(lambda: 'w')
-MONTH = (pp.Literal('m') | pp.CaselessKeyword('month') | pp.CaselessKeyword('months')).setParseAction(lambda: 'm')
-YEAR = (pp.Literal('y') | pp.CaselessKeyword('year') | pp.CaselessKeyword('years')).setParseAction(lambda: 'y')
-UNIT = (DAY | WEEK | MONTH | YEAR).setParseAction(lambda t: FACTORS[t.asList()[0]])
+MINUTE = (pp.CaselessKeyword('minute') | pp.CaselessKeyword('minutes') | pp.Literal('min')).setParseAction(lambda: 'min')
+HOUR = (pp.CaselessKeyword('hour') | pp.CaselessKeyword('hours') | pp.Literal('h')).setParseAction(lambda: 'h')
+DAY = (pp.CaselessKeyword('day') | pp.CaselessKeyword('days') | pp.Literal('d')).setParseAction(lambda: 'd')
+WEEK = (pp.CaselessKeyword('week') | pp.CaselessKeyword('weeks') | pp.Literal('w')).setParseAction(lambda: 'w')
+MONTH = (pp.CaselessKeyword('month') | pp.CaselessKeyword('months') | pp.Literal('m')).setParseAction(lambda: 'm')
+YEAR = (pp.CaselessKeyword('year') | pp.CaselessKeyword('years') | pp.Literal('y')).setParseAction(lambda: 'y')
+# Words are tried before letters, and MINUTE before MONTH, since `m` is a prefix of `min`
+UNIT = (MINUTE | HOUR | DAY | WEEK | MONTH | YEAR).setParseAction(lambda t: FACTORS[t.asList()[0]])
 
 SINGLE_DURATION = (ppc.integer('value') + UNIT('unit')).setParseAction(lambda t : t['value'] * t['unit'])
 
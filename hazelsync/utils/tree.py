@@ -0,0 +1,166 @@
+'''Utils for copying directory trees by linking or cloning their files'''
+
+import errno
+import fcntl
+import os
+import shutil
+import stat
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from logging import getLogger
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+from hazelsync.utils.logs import inherit_cluster
+
+log = getLogger('hazelsync')
+
+# ioctl cloning a file on the filesystems supporting reflinks (btrfs, XFS...): _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# Errors of FICLONE when the filesystem (or the pair of files) does not support reflinks
+UNSUPPORTED_ERRORS = [errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS]
+# Number of files of a directory linked by a task (a thread)
+FILE_BATCH = 1000
+
+def hardlink(source: str, destination: str):
+    '''Create a hard link of a file (or of a symlink itself)'''
+    os.link(source, destination, follow_symlinks=False)
+
+def clone(source: str, destination: str):
+    '''Create a copy-on-write clone of a regular file, sharing its data blocks until one of
+    them is modified
+    '''
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            os.unlink(destination)
+            raise
+
+def reflink(source: str, destination: str) -> bool:
+    '''Clone a regular file with its metadata, or hard link it when the filesystem cannot clone it.
+    Other files (symlinks, devices...) are hard linked.
+    :return: False if a regular file was hard linked instead of cloned.
+    '''
+    if not stat.S_ISREG(os.lstat(source).st_mode):
+        hardlink(source, destination)
+        return True
+    try:
+        clone(source, destination)
+    except OSError as err:
+        if err.errno not in UNSUPPORTED_ERRORS:
+            raise
+        log.warning("Cannot clone %s (%s), hard linking it", source, err)
+        hardlink(source, destination)
+        return False
+    copy_metadata(source, destination)
+    return True
+
+def reflink_supported(source: Path, destination: Path) -> bool:
+    '''Check if the files of a directory can be cloned to another one'''
+    with tempfile.NamedTemporaryFile(dir=str(source), prefix='.reflink-') as probe:
+        probe.write(b'probe')
+        probe.flush()
+        target = destination / f"{Path(probe.name).name}.clone"
+        try:
+            clone(probe.name, str(target))
+        except OSError as err:
+            if err.errno not in UNSUPPORTED_ERRORS:
+                raise
+            log.debug("Reflinks from %s to %s are not supported: %s", source, destination, err)
+            return False
+        target.unlink()
+        return True
+
+def copy_metadata(source: str, destination: str):
+    '''Copy the owner, permissions and times of a file or directory'''
+    info = os.stat(source, follow_symlinks=False)
+    try:
+        os.chown(destination, info.st_uid, info.st_gid, follow_symlinks=False)
+    except PermissionError:
+        log.debug("Cannot change the owner of %s", destination)
+    shutil.copystat(source, destination, follow_symlinks=False)
+
+def link_directory(source: str, destination: str) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+    '''Create a directory, and list the entries of its source directory
+    :return: The subdirectories and the files left to link, as (source, destination) pairs.
+    '''
+    os.mkdir(destination)
+    subdirs = []
+    files = []
+    with os.scandir(source) as entries:
+        for entry in entries:
+            target = os.path.join(destination, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append((entry.path, target))
+            else:
+                files.append((entry.path, target))
+    return subdirs, files
+
+def link_files(files: List[Tuple[str, str]], link: Callable[[str, str], Optional[bool]]) -> Tuple[int, int]:
+    '''Link some files
+    :return: The number of files linked, and the number of them the link function fell back on
+        hard linking (when it returned False).
+    '''
+    fallbacks = 0
+    for source, destination in files:
+        if link(source, destination) is False:
+            fallbacks += 1
+    return len(files), fallbacks
+
+def link_tree(source: Path, destination: Path, workers: int = 8,
+    link: Callable[[str, str], Optional[bool]] = hardlink) -> dict:
+    '''Copy a directory tree by linking its files, with several threads walking its directories
+    and linking batches of their files (so that a directory with many files is linked by several threads).
+    The directories are created with the owner, permissions and times of their source.
+    :param workers: The number of directories or batches of files processed at the same time.
+    :param link: The function creating the copy of a file (`hardlink` by default, or `reflink`).
+    :return: Statistics of the copy: number of `files` and `directories`, `seconds`, `rate` in files/s,
+        and number of `fallbacks` to hard links.
+    '''
+    start = time.time()
+    directories = [(str(source), str(destination))]
+    files = 0
+    fallbacks = 0
+    link_directory_task = inherit_cluster(link_directory)
+    link_files_task = inherit_cluster(link_files)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(link_directory_task, str(source), str(destination))}
+        batches = set()
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in batches:
+                        batches.remove(future)
+                        count, fallback_count = future.result()
+                        files += count
+                        fallbacks += fallback_count
+                        continue
+                    subdirs, entries = future.result()
+                    for subdir in subdirs:
+                        directories.append(subdir)
+                        pending.add(executor.submit(link_directory_task, *subdir))
+                    for i in range(0, len(entries), FILE_BATCH):
+                        batch = executor.submit(link_files_task, entries[i:i + FILE_BATCH], link)
+                        batches.add(batch)
+                        pending.add(batch)
+        except Exception:
+            for future in pending:
+                future.cancel()
+            raise
+    # Creating the entries of a directory changes its times, so they are copied last
+    for subdir in reversed(directories):
+        copy_metadata(*subdir)
+    seconds = time.time() - start
+    log.debug("Linked %d files of %s in %.1fs", files, source, seconds)
+    if fallbacks:
+        log.warning("%d files of %s could not be cloned and were hard linked", fallbacks, source)
+    return {
+        'files': files,
+        'directories': len(directories),
+        'seconds': seconds,
+        'rate': files / seconds if seconds else 0.0,
+        'fallbacks': fallbacks,
+    }
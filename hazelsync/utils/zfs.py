@@ -3,15 +3,109 @@ Utils for wrapping ZFS commands.
 These utils exist due to the lack of support in the libzfs_core library.
 '''
 
+import json
+import queue
+import re
 import subprocess #nosec
+import tempfile
+import threading
+import time
+from collections import defaultdict
 from pathlib import Path
-from typing import Optional
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
 from hazelsync.utils.rsync import PATH as _PATH
 
 class ZfsError(RuntimeError):
     '''ZFS command runtime error'''
 
+# Size of the chunks read from `zfs send`, and default size of the buffer between send and receive
+CHUNK_SIZE = 1024 * 1024
+BUFFER_SIZE = 64 * 1024 * 1024
+
+# Maximum length of the snapshot list given to a `zfs destroy` command
+# (a single argument is limited to 128KiB on Linux)
+DESTROY_MAX_LENGTH = 64 * 1024
+
+# Sizes with a unit, as accepted by `zfs set` (powers of 1024)
+SIZE_VALUE = re.compile(r'^(\d+(?:\.\d+)?)([KMGTPEZ]?)B?$', re.IGNORECASE)
+SIZE_UNITS = ['', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']
+
+# Properties of the datasets and snapshots in the inventory
+INVENTORY_PROPERTIES = ['type', 'mountpoint', 'used', 'available', 'referenced', 'written', 'creation']
+
+# Channel program returning the inventory of the datasets and snapshots under a root (recursively).
+# Arguments: root [property]... (the properties to get in addition to INVENTORY_PROPERTIES)
+INVENTORY_PROGRAM = '''
+args = ...
+argv = args["argv"]
+root = argv[1]
+properties = {PROPERTIES}
+for i = 2, #argv do
+    table.insert(properties, argv[i])
+end
+inventory = {}
+function describe(name)
+    local values = {}
+    for _, property in ipairs(properties) do
+        values[property] = zfs.get_prop(name, property)
+    end
+    inventory[name] = values
+end
+function walk(name)
+    describe(name)
+    for snapshot in zfs.list.snapshots(name) do
+        describe(snapshot)
+    end
+    for child in zfs.list.children(name) do
+        walk(child)
+    end
+end
+walk(root)
+return inventory
+'''.replace('PROPERTIES', ', '.join(f'"{prop}"' for prop in INVENTORY_PROPERTIES))
+
+# Channel program listing the snapshots under a root (recursively), with their creation time.
+# Arguments: root
+LIST_SNAPSHOTS_PROGRAM = '''
+args = ...
+argv = args["argv"]
+snapshots = {}
+function walk(name)
+    for snapshot in zfs.list.snapshots(name) do
+        snapshots[snapshot] = zfs.get_prop(snapshot, "creation")
+    end
+    for child in zfs.list.children(name) do
+        walk(child)
+    end
+end
+walk(argv[1])
+return snapshots
+'''
+
+# Channel programs running a sync task on all their arguments, or on none of them
+# if one of them cannot be done. The placeholder is replaced by the task name.
+BATCH_PROGRAM = '''
+args = ...
+argv = args["argv"]
+for i = 1, #argv do
+    local err = zfs.check.TASK(argv[i])
+    if err ~= 0 then
+        error("cannot TASK " .. argv[i] .. ": error " .. err)
+    end
+end
+for i = 1, #argv do
+    local err = zfs.sync.TASK(argv[i])
+    if err ~= 0 then
+        error("cannot TASK " .. argv[i] .. ": error " .. err)
+    end
+end
+return #argv
+'''
+SNAPSHOT_PROGRAM = BATCH_PROGRAM.replace('TASK', 'snapshot')
+DESTROY_PROGRAM = BATCH_PROGRAM.replace('TASK', 'destroy')
+
 def _run(cmd):
     '''Run a command and wrap the errors'''
     try:
@@ -28,10 +122,13 @@ def _run(cmd):
         raise ZfsError(f"Failed to run `{cmd_line}` (exit {exitcode}): {stderr}") from proc
     return proc
 
-def zfs_create(mount_point: Path):
+def zfs_create(mount_point: Path, properties: Optional[dict] = None):
     '''Create a dataset'''
     dataset = str(mount_point)[1:]
-    cmd = ['zfs', 'create', dataset]
+    property_list = []
+    for key, value in (properties or {}).items():
+        property_list += ['-o', f"{key}={value}"]
+    cmd = ['zfs', 'create', *property_list, dataset]
     _run(cmd)
 
 def zfs_get(name: str, prop: str):
@@ -44,32 +141,237 @@ def zfs_get(name: str, prop: str):
 
 def zfs_set(name: str, prop: str, value: str):
     '''Set the properties of an object'''
-    cmd = ['zfs', 'set', name, f"{prop}={value}"]
-    prop = _run(cmd)
+    cmd = ['zfs', 'set', f"{prop}={value}", name]
+    _run(cmd)
 
-def zfs_ensure(name: str, prop: str, should: str):
-    '''Ensure a property is set to a given value'''
-    real = zfs_get(name, prop)
-    if real != should:
+def zfs_ensure(name: str, prop: str, should: str, inventory: Optional[dict] = None):
+    '''Ensure a property is set to a given value
+    :param inventory: An inventory of the properties (see `zfs_inventory`) to use instead of
+        getting the property, updated when the property is set.
+    '''
+    if inventory is not None and prop in inventory.get(name, {}):
+        real = str(inventory[name][prop])
+    else:
+        real = zfs_get(name, prop)
+    if normalize_value(real) != normalize_value(should):
         zfs_set(name, prop, should)
-
-def zfs_list(dataset: Optional[str] = None):
-    '''List the datasets available under a given path/name'''
-    cmd = ['zfs', 'list', '-H', '-r', '-t', 'filesystem', str(dataset)]
-    proc = _run(cmd)
-    datasets = {}
-    for line in proc.stdout.strip().split('\n'):
-        name, used, avail, refer, mountpoint = line.split('\t')
-        dataset = {'name': name, 'used': used, 'avail': avail, 'refer': refer}
-        datasets[Path(mountpoint)] = dataset
-    return datasets
+        if inventory is not None:
+            inventory.setdefault(name, {})[prop] = parse_value(normalize_value(should))
 
 def zfs_snapshot(mount_point: Path, properties: Optional[dict] = None):
     '''Create a snapshot for a dataset'''
-    dataset = str(mount_point)[1:]
+    zfs_snapshots([mount_point], properties)
+
+def zfs_snapshots(mount_points: List[Path], properties: Optional[dict] = None):
+    '''Create the snapshots of several datasets at once.
+    The snapshots are created atomically, in the same transaction group.
+    '''
+    datasets = [str(mount_point)[1:] for mount_point in mount_points]
     property_list = []
     if properties:
         for key, value in properties.items():
             property_list += ['-o', f"{key}={value}"]
-    cmd = ['zfs', 'snapshot', '-r', dataset, *property_list]
+    cmd = ['zfs', 'snapshot', '-r', *property_list, *datasets]
     _run(cmd)
+
+def parse_value(value: str):
+    '''Convert the numbers of the parseable output of zfs'''
+    return int(value) if value.isdigit() else value
+
+def normalize_value(value: str) -> str:
+    '''Convert a size with a unit (like `128K` or `1.5M`) to bytes, as in the parseable output
+    of zfs, so that a configured value can be compared to the value of the inventory
+    '''
+    match = SIZE_VALUE.match(value.strip())
+    if not match:
+        return value
+    return str(int(float(match.group(1)) * 1024 ** SIZE_UNITS.index(match.group(2).upper())))
+
+def zfs_inventory(mount_point: Path, properties: Optional[List[str]] = None) -> Dict[str, dict]:
+    '''Return the properties of every dataset and snapshot under a given path, with a single command.
+    The sizes are in bytes, and the times are timestamps.
+    :param properties: Properties to get in addition to `INVENTORY_PROPERTIES`.
+    '''
+    dataset = str(mount_point)[1:]
+    props = ','.join([*INVENTORY_PROPERTIES, *(properties or [])])
+    cmd = ['zfs', 'get', '-H', '-p', '-r', '-t', 'filesystem,snapshot', '-o', 'name,property,value', props, dataset]
+    proc = _run(cmd)
+    inventory = defaultdict(dict)
+    for line in proc.stdout.strip().split('\n'):
+        if line:
+            name, prop, value = line.split('\t')
+            inventory[name][prop] = parse_value(value)
+    return dict(inventory)
+
+def zfs_list_snapshots(mount_point: Path) -> List[Tuple[Path, datetime]]:
+    '''List the snapshots under a given path, with their creation time'''
+    dataset = str(mount_point)[1:]
+    cmd = ['zfs', 'list', '-H', '-p', '-r', '-t', 'snapshot', '-o', 'name,creation', dataset]
+    proc = _run(cmd)
+    snapshots = []
+    for line in proc.stdout.strip().split('\n'):
+        if line:
+            name, creation = line.split('\t')
+            snapshots.append((Path('/' + name), datetime.fromtimestamp(int(creation))))
+    return snapshots
+
+def zfs_destroy(snapshots: List[Path]):
+    '''Destroy snapshots, with one command per dataset (or per batch of snapshots for the
+    datasets with a lot of them, to keep the argument below the length limit)
+    '''
+    names = defaultdict(list)
+    for snapshot in snapshots:
+        dataset, name = str(snapshot)[1:].split('@')
+        names[dataset].append(name)
+    for dataset, dataset_names in names.items():
+        batch = []
+        length = len(dataset)
+        for name in dataset_names:
+            if batch and length + len(name) + 1 > DESTROY_MAX_LENGTH:
+                _run(['zfs', 'destroy', f"{dataset}@{','.join(batch)}"])
+                batch = []
+                length = len(dataset)
+            batch.append(name)
+            length += len(name) + 1
+        _run(['zfs', 'destroy', f"{dataset}@{','.join(batch)}"])
+
+def zfs_program(pool: str, program: str, args: List[str], readonly: bool = False):
+    '''Run a ZFS channel program (Lua script running in the kernel, in a single transaction)
+    and return its result.
+    :param pool: The pool the program runs on.
+    :param program: The Lua code of the program.
+    :param args: The arguments of the program.
+    :param readonly: Run the program in read-only mode.
+    '''
+    with tempfile.NamedTemporaryFile('w', prefix='hazelsync-', suffix='.lua') as script:
+        script.write(program)
+        script.flush()
+        cmd = ['zfs', 'program', '-j', *(['-n'] if readonly else []), pool, script.name, *args]
+        proc = _run(cmd)
+    try:
+        return json.loads(proc.stdout)['return']
+    except (ValueError, KeyError) as err:
+        raise ZfsError(f"Unexpected output of channel program: {proc.stdout}") from err
+
+def zfs_program_inventory(mount_point: Path, properties: Optional[List[str]] = None) -> Dict[str, dict]:
+    '''Return the properties of every dataset and snapshot under a path with a read-only channel program,
+    like `zfs_inventory`
+    '''
+    dataset = str(mount_point)[1:]
+    return zfs_program(dataset.split('/')[0], INVENTORY_PROGRAM, [dataset, *(properties or [])], readonly=True)
+
+def zfs_program_list_snapshots(mount_point: Path) -> List[Tuple[Path, datetime]]:
+    '''List the snapshots under a given path with a channel program, like `zfs_list_snapshots`'''
+    dataset = str(mount_point)[1:]
+    result = zfs_program(dataset.split('/')[0], LIST_SNAPSHOTS_PROGRAM, [dataset], readonly=True)
+    return [(Path('/' + name), datetime.fromtimestamp(creation)) for name, creation in result.items()]
+
+def zfs_program_snapshots(mount_points: List[Path]):
+    '''Create the snapshots of several datasets with a channel program'''
+    snapshots = [str(mount_point)[1:] for mount_point in mount_points]
+    zfs_program(snapshots[0].split('/')[0], SNAPSHOT_PROGRAM, snapshots)
+
+def zfs_program_destroy(snapshots: List[Path]):
+    '''Destroy snapshots with a channel program'''
+    names = [str(snapshot)[1:] for snapshot in snapshots]
+    zfs_program(names[0].split('/')[0], DESTROY_PROGRAM, names)
+
+def zfs_snapshot_names(dataset: str) -> List[str]:
+    '''Return the names of the snapshots of a dataset, from the oldest to the newest,
+    or nothing if the dataset does not exist
+    '''
+    cmd = ['zfs', 'list', '-H', '-t', 'snapshot', '-o', 'name', '-s', 'creation', '-d', '1', dataset]
+    try:
+        proc = _run(cmd)
+    except ZfsError as err:
+        if 'does not exist' in str(err):
+            return []
+        raise err
+    return [line.split('@')[1] for line in proc.stdout.strip().split('\n') if line]
+
+def zfs_resume_token(dataset: str) -> Optional[str]:
+    '''Return the token to resume an interrupted receive of a dataset, if any'''
+    try:
+        token = zfs_get(dataset, 'receive_resume_token')
+    except ZfsError:
+        return None
+    return None if token == '-' else token
+
+def zfs_pipe(send: List[str],
+    receive: Optional[List[str]] = None,
+    output: Optional[Path] = None,
+    buffer_size: int = BUFFER_SIZE,
+) -> dict:
+    '''Stream the output of a `zfs send` command to a `zfs receive` command or to a file,
+    through a buffer absorbing the speed variations of both sides, and return the throughput.
+    :param send: The send command.
+    :param receive: The receive command.
+    :param output: The file to write the stream to (instead of a receive command).
+    :param buffer_size: The size of the buffer, in bytes.
+    '''
+    chunks = queue.Queue(maxsize=max(buffer_size // CHUNK_SIZE, 1))
+    start = time.monotonic()
+    transferred = 0
+    with tempfile.TemporaryFile() as send_stderr, tempfile.TemporaryFile() as receive_stderr:
+        sender = subprocess.Popen(send, stdout=subprocess.PIPE, stderr=send_stderr, env=dict(PATH=_PATH)) #nosec
+        def read():
+            while True:
+                chunk = sender.stdout.read(CHUNK_SIZE)
+                chunks.put(chunk)
+                if not chunk:
+                    return
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        receiver = None
+        sink_error = None
+        complete = False
+        try:
+            if receive:
+                receiver = subprocess.Popen(receive, stdin=subprocess.PIPE, stderr=receive_stderr, env=dict(PATH=_PATH)) #nosec
+                sink = receiver.stdin
+            else:
+                sink = output.open('wb')
+            with sink:
+                while True:
+                    chunk = chunks.get()
+                    if not chunk:
+                        complete = True
+                        break
+                    sink.write(chunk)
+                    transferred += len(chunk)
+        except BrokenPipeError:
+            # The receiver failed, its error is reported below
+            pass
+        except OSError as err:
+            # Full or failing disk when writing to a file
+            sink_error = err
+        finally:
+            if not complete:
+                sender.kill()
+                # Unblock the reader
+                while reader.is_alive():
+                    try:
+                        chunks.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+            sender.wait()
+            if receiver:
+                receiver.wait()
+        # The receiver first, since the sender is killed when the receiver fails
+        if receiver and receiver.returncode != 0:
+            receive_stderr.seek(0)
+            message = receive_stderr.read().decode(errors='replace')
+            raise ZfsError(f"Failed to run `{' '.join(receive)}` (exit {receiver.returncode}): {message}")
+        if sink_error is not None:
+            target = output if output else f"`{' '.join(receive)}`"
+            raise ZfsError(f"Failed to write the stream to {target}: {sink_error}") from sink_error
+        if sender.returncode != 0:
+            send_stderr.seek(0)
+            message = send_stderr.read().decode(errors='replace')
+            raise ZfsError(f"Failed to run `{' '.join(send)}` (exit {sender.returncode}): {message}")
+    seconds = time.monotonic() - start
+    return {
+        'bytes': transferred,
+        'seconds': round(seconds, 3),
+        'rate': round(transferred / seconds, 1) if seconds else 0,
+    }
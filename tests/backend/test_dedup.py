@@ -0,0 +1,164 @@
+'''Test for the deduplicated chunk store backend'''
+
+import hashlib
+import os
+import time
+
+from unittest.mock import patch
+
+import pytest
+from freezegun import freeze_time
+
+from hazelsync.backend import BackendError
+from hazelsync.backend.dedup import ChunkStore, DedupBackend
+from hazelsync.utils.chunking import chunk_file
+from hazelsync.settings import SettingError
+
+@pytest.fixture(scope='function')
+def backend(tmp_path):
+    return DedupBackend('cluster01', basedir=str(tmp_path), workers=2,
+        min_chunk_size=1024, average_chunk_size=4096, max_chunk_size=16384)
+
+def fill(slot, data):
+    (slot / 'lib').mkdir()
+    (slot / 'lib' / 'app.jar').write_bytes(data)
+    (slot / 'hostname').write_text(slot.name)
+    (slot / 'current').symlink_to('lib/app.jar')
+
+class TestDedupBackend:
+    def test_dedup(self, backend):
+        data = os.urandom(100000)
+        host01, host02 = backend.ensure_slot('host01'), backend.ensure_slot('host02')
+        fill(host01, data)
+        fill(host02, data)
+        backend.snapshot(host01)
+        backend.snapshot(host02)
+        first, second = backend.slot_metrics([host01, host02]).values()
+        assert first['ingest_bytes'] == 100006
+        assert first['ingest_stored_bytes'] == 100006
+        # Only the hostname is new in the second slot
+        assert second['ingest_stored_bytes'] == 6
+        assert second['dedup_ratio'] > 0.99
+        assert len(backend.list_snapshots()) == 2
+
+    def test_extract(self, backend, tmp_path):
+        slot = backend.ensure_slot('host01')
+        fill(slot, os.urandom(50000))
+        os.chmod(str(slot / 'hostname'), 0o600)
+        backend.snapshot(slot)
+        snapshot, = backend.list_snapshots()
+        restored = tmp_path / 'restored'
+        backend.extract(snapshot.path, restored)
+        assert (restored / 'lib' / 'app.jar').read_bytes() == (slot / 'lib' / 'app.jar').read_bytes()
+        assert os.readlink(str(restored / 'current')) == 'lib/app.jar'
+        assert (restored / 'hostname').stat().st_mode & 0o777 == 0o600
+        assert (restored / 'lib').stat().st_mtime == (slot / 'lib').stat().st_mtime
+        files = {entry['path']: entry for entry in backend.snapshot_files(snapshot)}
+        assert sorted(files) == ['hostname', 'lib/app.jar']
+        assert files['hostname']['sha256'] == hashlib.sha256(b'host01').hexdigest()
+
+    def test_open_snapshot(self, backend):
+        slot = backend.ensure_slot('host01')
+        fill(slot, os.urandom(50000))
+        backend.snapshot(slot)
+        snapshot, = backend.list_snapshots()
+        with backend.open_snapshot(snapshot) as directory:
+            assert directory.parent == backend.stagingdir
+            assert (directory / 'lib' / 'app.jar').read_bytes() == (slot / 'lib' / 'app.jar').read_bytes()
+        assert not directory.exists()
+
+    def test_destroy(self, backend):
+        slot = backend.ensure_slot('host01')
+        fill(slot, os.urandom(50000))
+        backend.snapshot(slot)
+        (slot / 'lib' / 'app.jar').write_bytes(os.urandom(50000))
+        time.sleep(1)
+        backend.snapshot(slot)
+        old, new = sorted(backend.list_snapshots(), key=lambda snapshot: snapshot.time)
+        backend.destroy_snapshots([old.path])
+        # The pack of the first snapshot has chunks still used by the second one (hostname)
+        assert len(list((backend.storedir / 'packs').iterdir())) == 2
+        backend.destroy_snapshots([new.path])
+        assert list((backend.storedir / 'packs').iterdir()) == []
+        with pytest.raises(BackendError):
+            backend.destroy_snapshots([slot])
+
+    def test_unchanged(self, backend):
+        slot = backend.ensure_slot('host01')
+        fill(slot, os.urandom(50000))
+        backend.snapshot(slot)
+        (slot / 'hostname').write_text('host01.example.com')
+        time.sleep(1)
+        backend.snapshot(slot)
+        stats = backend.slot_metrics([slot])[slot]
+        # Only the hostname is read again
+        assert stats['ingest_unchanged_files'] == 1
+        assert stats['ingest_bytes'] == 50018
+        new = max(backend.list_snapshots(), key=lambda snapshot: snapshot.time)
+        files = {entry['path']: entry for entry in backend.snapshot_files(new)}
+        assert files['lib/app.jar']['sha256'] == hashlib.sha256((slot / 'lib' / 'app.jar').read_bytes()).hexdigest()
+        assert files['hostname']['sha256'] == hashlib.sha256(b'host01.example.com').hexdigest()
+
+    def test_changed_during_snapshot(self, backend):
+        slot = backend.ensure_slot('host01')
+        (slot / 'data').write_bytes(os.urandom(10000))
+        stale = chunk_file(str(slot / 'data'), *backend.chunk_sizes)
+        (slot / 'data').write_bytes(os.urandom(10000))
+        entry = {'path': 'data', 'type': 'file', 'size': 10000, 'mtime': (slot / 'data').stat().st_mtime}
+        stats = {'bytes': 0, 'chunks': 0, 'new_chunks': 0, 'stored_bytes': 0, 'skipped_files': 0}
+        store = ChunkStore(backend.storedir)
+        try:
+            # The file is read again
+            backend.store_batch(store, slot, [entry], [stale], stats)
+            assert entry['sha256'] == hashlib.sha256((slot / 'data').read_bytes()).hexdigest()
+            # The file keeps changing
+            other = {'path': 'data', 'type': 'file', 'size': 10000, 'mtime': (slot / 'data').stat().st_mtime}
+            (slot / 'data').write_bytes(os.urandom(10000))
+            with patch('hazelsync.backend.dedup.chunk_file', return_value=stale):
+                backend.store_batch(store, slot, [other], [stale], stats)
+            assert 'chunks' not in other
+            assert stats['skipped_files'] == 1
+            # The file was removed
+            removed = {'path': 'removed', 'type': 'file', 'size': 10000, 'mtime': 0.0}
+            backend.store_batch(store, slot, [removed], [None], stats)
+            assert stats['skipped_files'] == 2
+        finally:
+            store.close()
+
+    def test_changed_to_stored_chunks(self, backend):
+        slot = backend.ensure_slot('host01')
+        old, new = os.urandom(10000), os.urandom(10000)
+        (slot / 'data').write_bytes(old)
+        entry = {'path': 'data', 'type': 'file', 'size': 10000, 'mtime': (slot / 'data').stat().st_mtime}
+        stale = chunk_file(str(slot / 'data'), *backend.chunk_sizes)
+        # The file changes to a content already in the store after it was chunked
+        (slot / 'other').write_bytes(new)
+        backend.snapshot(slot)
+        (slot / 'data').write_bytes(new)
+        os.utime(str(slot / 'data'), (entry['mtime'] + 10, entry['mtime'] + 10))
+        stats = {'bytes': 0, 'chunks': 0, 'new_chunks': 0, 'stored_bytes': 0, 'skipped_files': 0}
+        store = ChunkStore(backend.storedir)
+        try:
+            backend.store_batch(store, slot, [entry], [stale], stats)
+        finally:
+            store.close()
+        assert entry['sha256'] == hashlib.sha256(new).hexdigest()
+        assert entry['mtime'] == (slot / 'data').stat().st_mtime
+
+    def test_same_second(self, backend):
+        slot = backend.ensure_slot('host01')
+        fill(slot, os.urandom(50000))
+        with freeze_time('2021-01-01T00:00:00'):
+            backend.snapshot(slot)
+            snapshot, = backend.list_snapshots()
+            content = snapshot.path.read_text()
+            (slot / 'hostname').write_text('host01.example.com')
+            with pytest.raises(BackendError):
+                backend.snapshot(slot)
+        # The first snapshot is kept
+        assert [snapshot.path for snapshot in backend.list_snapshots()] == [snapshot.path]
+        assert snapshot.path.read_text() == content
+
+    def test_chunk_sizes(self, tmp_path):
+        with pytest.raises(SettingError):
+            DedupBackend('cluster01', basedir=str(tmp_path), min_chunk_size=65536, average_chunk_size=4096)
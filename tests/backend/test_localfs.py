@@ -0,0 +1,127 @@
+'''Test for the local filesystem backend'''
+
+import errno
+import os
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+
+from hazelsync.backend import BackendError
+from hazelsync.backend.localfs import LocalfsBackend
+from hazelsync.settings import SettingError
+from hazelsync.utils.tree import link_files
+
+@pytest.fixture(scope='function')
+def backend(tmp_path):
+    return LocalfsBackend('cluster01', basedir=str(tmp_path))
+
+class TestLocalfsBackend:
+    def test_init(self, backend, tmp_path):
+        assert backend.slotdir == tmp_path / 'cluster01' / 'slots'
+        assert backend.snapshotdir == tmp_path / 'cluster01' / 'snapshots'
+        assert backend.ensure_slot('host01').is_dir()
+
+    def test_list_snapshots(self, backend):
+        (backend.snapshotdir / 'host-01-2021-01-02T03:04:05').mkdir()
+        (backend.snapshotdir / 'host01-1609556645').mkdir()
+        snapshots = backend.list_snapshots()
+        assert len(snapshots) == 1
+        assert snapshots[0].slot == 'host-01'
+        assert snapshots[0].time == datetime(2021, 1, 2, 3, 4, 5)
+
+    def test_destroy_snapshots(self, backend, tmp_path):
+        snapshot = backend.snapshotdir / 'host01-2021-01-02T03:04:05'
+        (snapshot / 'data').mkdir(parents=True)
+        backend.destroy_snapshots([snapshot])
+        assert not snapshot.exists()
+        with pytest.raises(BackendError):
+            backend.destroy_snapshots([tmp_path])
+
+    def test_snapshot(self, backend):
+        slot = backend.ensure_slot('host01')
+        (slot / 'etc' / 'conf.d').mkdir(parents=True)
+        (slot / 'etc' / 'hosts').write_text('127.0.0.1 localhost')
+        (slot / 'etc' / 'conf.d' / 'app.conf').write_text('key: value')
+        (slot / 'link').symlink_to('etc/hosts')
+        os.utime(slot / 'etc', (1609459200, 1609459200))
+        backend.snapshot(slot)
+        snapshot, = backend.snapshotdir.iterdir()
+        assert (snapshot / 'etc' / 'hosts').stat().st_ino == (slot / 'etc' / 'hosts').stat().st_ino
+        assert (snapshot / 'etc' / 'conf.d' / 'app.conf').read_text() == 'key: value'
+        assert os.readlink(snapshot / 'link') == 'etc/hosts'
+        assert (snapshot / 'etc').stat().st_mtime == 1609459200
+        stats = backend.slot_metrics([slot])[slot]
+        assert stats['snapshot_files'] == 3
+        assert stats['snapshot_directories'] == 3
+
+    def test_snapshot_flat(self, backend):
+        slot = backend.ensure_slot('host01')
+        for i in range(5):
+            (slot / f"file{i}").write_text(str(i))
+        with patch('hazelsync.utils.tree.FILE_BATCH', 2), \
+            patch('hazelsync.utils.tree.link_files', wraps=link_files) as batch:
+            backend.snapshot(slot)
+        # The files of a directory are linked in batches, by several threads
+        assert sorted(len(mycall.args[0]) for mycall in batch.call_args_list) == [1, 2, 2]
+        snapshot, = backend.snapshotdir.iterdir()
+        assert sorted(path.name for path in snapshot.iterdir()) == [f"file{i}" for i in range(5)]
+        assert backend.slot_metrics([slot])[slot]['snapshot_files'] == 5
+
+    def test_snapshot_failure(self, backend):
+        slot = backend.ensure_slot('host01')
+        (slot / 'data').write_text('')
+        with patch('hazelsync.utils.tree.os.link', side_effect=PermissionError('denied')):
+            with pytest.raises(PermissionError):
+                backend.snapshot(slot)
+        assert list(backend.snapshotdir.iterdir()) == []
+
+    def test_snapshot_mode(self, tmp_path):
+        with pytest.raises(SettingError):
+            LocalfsBackend('cluster01', basedir=str(tmp_path), snapshot_mode='copy')
+
+def fake_ficlone(fd, request, source_fd):
+    '''Copy the data like FICLONE would share it'''
+    os.write(fd, os.pread(source_fd, 1024, 0))
+
+class TestLocalfsReflink:
+    def test_snapshot(self, tmp_path):
+        backend = LocalfsBackend('cluster01', basedir=str(tmp_path), snapshot_mode='reflink')
+        slot = backend.ensure_slot('host01')
+        (slot / 'data').write_text('content')
+        (slot / 'data').chmod(0o600)
+        with patch('hazelsync.utils.tree.fcntl.ioctl', side_effect=fake_ficlone) as ioctl:
+            backend.snapshot(slot)
+        # The probe and the file are cloned
+        assert ioctl.call_count == 2
+        assert backend.reflink
+        snapshot, = backend.snapshotdir.iterdir()
+        assert (snapshot / 'data').read_text() == 'content'
+        assert (snapshot / 'data').stat().st_ino != (slot / 'data').stat().st_ino
+        assert (snapshot / 'data').stat().st_mode & 0o777 == 0o600
+
+    def test_fallback(self, tmp_path):
+        backend = LocalfsBackend('cluster01', basedir=str(tmp_path), snapshot_mode='reflink')
+        slot = backend.ensure_slot('host01')
+        (slot / 'data').write_text('content')
+        error = OSError(errno.EOPNOTSUPP, 'Operation not supported')
+        with patch('hazelsync.utils.tree.fcntl.ioctl', side_effect=error) as ioctl:
+            backend.snapshot(slot)
+        # Only the probe is tried, then the files are hard linked
+        assert ioctl.call_count == 1
+        assert backend.reflink is False
+        snapshot, = backend.snapshotdir.iterdir()
+        assert (snapshot / 'data').stat().st_ino == (slot / 'data').stat().st_ino
+        assert [path.name for path in slot.iterdir()] == ['data']
+
+    def test_fallback_file(self, tmp_path):
+        backend = LocalfsBackend('cluster01', basedir=str(tmp_path), snapshot_mode='reflink')
+        slot = backend.ensure_slot('host01')
+        (slot / 'data').write_text('content')
+        (slot / 'other').write_text('content')
+        error = OSError(errno.EXDEV, 'Invalid cross-device link')
+        # The probe is cloned, not the files
+        with patch('hazelsync.utils.tree.fcntl.ioctl', side_effect=[None, error, error]):
+            backend.snapshot(slot)
+        assert backend.reflink
+        assert backend.slot_metrics([slot])[slot]['snapshot_fallbacks'] == 2
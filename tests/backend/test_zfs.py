@@ -0,0 +1,235 @@
+'''Test for the ZFS backend'''
+
+import json
+from pathlib import Path
+from subprocess import CalledProcessError, CompletedProcess
+from unittest.mock import patch
+
+import pytest
+
+from hazelsync.backend.zfs import ZfsBackend
+from hazelsync.utils.zfs import ZfsError, normalize_value, zfs_pipe
+
+@pytest.fixture(scope='function')
+def backend():
+    with patch('hazelsync.backend.zfs.zfs_inventory', return_value={}), \
+        patch('hazelsync.backend.zfs.zfs_create'), \
+        patch.object(Path, 'is_dir', return_value=True):
+        yield ZfsBackend('cluster01', basedir='/backup')
+
+class TestZfsBackend:
+    def test_snapshot_many(self, backend):
+        with patch('hazelsync.utils.zfs.subprocess.run') as run:
+            backend.snapshot_many([Path('/backup/cluster01/host01'), Path('/backup/cluster01/host02')])
+        cmd = run.call_args.args[0]
+        assert cmd[:3] == ['zfs', 'snapshot', '-r']
+        first, second = cmd[3:]
+        assert first.startswith('backup/cluster01/host01@')
+        # One point in time for all the slots
+        assert second == first.replace('host01', 'host02')
+
+    def test_snapshot_many_empty(self, backend):
+        with patch('hazelsync.utils.zfs.subprocess.run') as run:
+            backend.snapshot_many([])
+        run.assert_not_called()
+
+    def test_snapshot_outside(self, backend):
+        with patch('hazelsync.utils.zfs.subprocess.run') as run:
+            with pytest.raises(Exception):
+                backend.snapshot_many([Path('/backup/cluster01/host01'), Path('/backup/cluster02/host01')])
+        run.assert_not_called()
+
+def completed(stdout=''):
+    return CompletedProcess([], 0, stdout=stdout, stderr='')
+
+class TestZfsProgram:
+    def test_inventory(self):
+        output = json.dumps({'return': {
+            'backup/cluster01': {'type': 'filesystem', 'mountpoint': '/backup/cluster01', 'used': 2048, 'compression': 'lz4'},
+            'backup/cluster01/host01': {'type': 'filesystem', 'mountpoint': '/backup/cluster01/host01', 'used': 1024},
+            'backup/cluster01/host01@2021-01-01T00:00:00': {'type': 'snapshot', 'used': 0},
+        }})
+        with patch('hazelsync.utils.zfs.subprocess.run', return_value=completed(output)) as run, \
+            patch.object(Path, 'is_dir', return_value=True):
+            backend = ZfsBackend('cluster01', basedir='/backup', engine='program', properties={'compression': 'lz4'})
+            backend.ensure_slot('host01')
+        # A single read-only command lists the datasets and snapshots, and their properties
+        assert run.call_count == 1
+        cmd = run.call_args.args[0]
+        assert cmd[:5] == ['zfs', 'program', '-j', '-n', 'backup']
+        assert cmd[6:] == ['backup/cluster01', 'compression']
+        assert backend.datasets[Path('/backup/cluster01/host01')]['used'] == 1024
+        assert Path('/backup/cluster01/host01@2021-01-01T00:00:00') not in backend.datasets
+
+    def test_inventory_set_property(self):
+        output = json.dumps({'return': {
+            'backup/cluster01': {'type': 'filesystem', 'mountpoint': '/backup/cluster01', 'compression': 'off'},
+        }})
+        with patch('hazelsync.utils.zfs.subprocess.run', side_effect=[completed(output), completed()]) as run, \
+            patch.object(Path, 'is_dir', return_value=True):
+            backend = ZfsBackend('cluster01', basedir='/backup', engine='program', properties={'compression': 'lz4'})
+        # Native properties cannot be set by a channel program
+        assert run.call_args.args[0] == ['zfs', 'set', 'compression=lz4', 'backup/cluster01']
+        assert backend.engine == 'program'
+        assert backend.inventory['backup/cluster01']['compression'] == 'lz4'
+
+    def test_fallback(self):
+        error = CalledProcessError(1, [], stderr='channel programs are not supported')
+        inventory = '\n'.join([
+            'backup/cluster01\ttype\tfilesystem',
+            'backup/cluster01\tmountpoint\t/backup/cluster01',
+            'backup/cluster01\tcompression\toff',
+        ])
+        with patch('hazelsync.utils.zfs.subprocess.run',
+            side_effect=[error, completed(inventory), completed(), completed()]) as run, \
+            patch.object(Path, 'is_dir', return_value=True):
+            backend = ZfsBackend('cluster01', basedir='/backup', engine='program', properties={'compression': 'lz4'})
+            backend.ensure_slot('host01')
+        assert backend.engine == 'cli'
+        # The properties are compared to the inventory instead of being read one by one
+        assert [mycall.args[0][:2] for mycall in run.call_args_list] == [
+            ['zfs', 'program'], ['zfs', 'get'], ['zfs', 'set'], ['zfs', 'create'],
+        ]
+        assert backend.inventory['backup/cluster01']['compression'] == 'lz4'
+
+    def test_fallback_sizes(self):
+        error = CalledProcessError(1, [], stderr='channel programs are not supported')
+        inventory = '\n'.join([
+            'backup/cluster01\ttype\tfilesystem',
+            'backup/cluster01\tmountpoint\t/backup/cluster01',
+            'backup/cluster01\trecordsize\t1048576',
+        ])
+        with patch('hazelsync.utils.zfs.subprocess.run', side_effect=[error, completed(inventory), completed()]) as run, \
+            patch.object(Path, 'is_dir', return_value=True):
+            backend = ZfsBackend('cluster01', basedir='/backup', engine='program', properties={'recordsize': '1M'})
+            backend.ensure_slot('host01')
+        # The parseable size of the inventory is the same as the configured one
+        assert [mycall.args[0][:2] for mycall in run.call_args_list] == [
+            ['zfs', 'program'], ['zfs', 'get'], ['zfs', 'create'],
+        ]
+
+    def test_normalize_value(self):
+        assert normalize_value('128K') == '131072'
+        assert normalize_value('1.5m') == '1572864'
+        assert normalize_value('512') == '512'
+        assert normalize_value('lz4') == 'lz4'
+        assert normalize_value('none') == 'none'
+
+    def test_slot_metrics(self, backend):
+        inventory = {
+            'backup/cluster01/host01': {'type': 'filesystem', 'mountpoint': '/backup/cluster01/host01',
+                'used': 3000, 'referenced': 2000},
+            'backup/cluster01/host01@2021-01-01T00:00:00': {'type': 'snapshot', 'creation': 1609459200, 'written': 500},
+            'backup/cluster01/host01@2021-01-02T00:00:00': {'type': 'snapshot', 'creation': 1609545600, 'written': 100},
+            'backup/cluster01/host02': {'type': 'filesystem', 'mountpoint': '/backup/cluster01/host02',
+                'used': 10, 'referenced': 10},
+        }
+        with patch('hazelsync.backend.zfs.zfs_inventory', return_value=inventory):
+            metrics = backend.slot_metrics([Path('/backup/cluster01/host01'), Path('/backup/cluster01/host02')])
+        assert metrics == {
+            Path('/backup/cluster01/host01'): {'space_used': 3000, 'space_referenced': 2000, 'space_written': 100},
+            Path('/backup/cluster01/host02'): {'space_used': 10, 'space_referenced': 10},
+        }
+
+    def test_destroy(self, backend):
+        snapshots = [
+            Path('/backup/cluster01/host01@2021-01-01T00:00:00'),
+            Path('/backup/cluster01/host01@2021-01-02T00:00:00'),
+            Path('/backup/cluster01/host02@2021-01-01T00:00:00'),
+        ]
+        with patch('hazelsync.utils.zfs.subprocess.run') as run:
+            backend.destroy_snapshots(snapshots)
+        assert [mycall.args[0] for mycall in run.call_args_list] == [
+            ['zfs', 'destroy', 'backup/cluster01/host01@2021-01-01T00:00:00,2021-01-02T00:00:00'],
+            ['zfs', 'destroy', 'backup/cluster01/host02@2021-01-01T00:00:00'],
+        ]
+
+class TestZfsSnapshots:
+    def test_list_snapshots(self, backend):
+        output = '\n'.join([
+            'backup/cluster01@2021-01-01T00:00:00\t1609459200',
+            'backup/cluster01/host01@2021-01-01T00:00:00\t1609459200',
+        ])
+        with patch('hazelsync.utils.zfs.subprocess.run', return_value=completed(output)):
+            snapshots = backend.list_snapshots()
+        assert [(snapshot.slot, snapshot.path) for snapshot in snapshots] == [
+            ('host01', Path('/backup/cluster01/host01@2021-01-01T00:00:00')),
+        ]
+
+    def test_destroy_batches(self, backend):
+        snapshots = [Path(f"/backup/cluster01/host01@snapshot{i:05d}") for i in range(10000)]
+        with patch('hazelsync.utils.zfs.subprocess.run') as run:
+            backend.destroy_snapshots(snapshots)
+        args = [mycall.args[0][2] for mycall in run.call_args_list]
+        assert len(args) == 3
+        assert all(len(arg) <= 64 * 1024 for arg in args)
+        assert sum(len(arg.split('@')[1].split(',')) for arg in args) == 10000
+
+class TestZfsReplication:
+    def test_pipe_file(self, tmp_path):
+        output = tmp_path / 'stream'
+        stats = zfs_pipe(['head', '-c', '3000000', '/dev/zero'], output=output, buffer_size=2 * 1024 * 1024)
+        assert stats['bytes'] == 3000000
+        assert output.stat().st_size == 3000000
+
+    def test_pipe_receive_failure(self):
+        with pytest.raises(ZfsError, match='false'):
+            zfs_pipe(['head', '-c', '30000000', '/dev/zero'], ['false'])
+
+    def test_pipe_file_full(self):
+        with pytest.raises(ZfsError, match='/dev/full'):
+            zfs_pipe(['head', '-c', '30000000', '/dev/zero'], output=Path('/dev/full'))
+
+    def test_replicate_dataset(self, backend):
+        backend.replication = {'dataset': 'backup2/cluster01'}
+        names = {
+            'backup/cluster01/host01': ['2021-01-01T00:00:00', '2021-01-02T00:00:00', '2021-01-03T00:00:00'],
+            'backup2/cluster01/host01': ['2021-01-01T00:00:00', '2021-01-02T00:00:00'],
+        }
+        stats = {'bytes': 1000, 'seconds': 2.0, 'rate': 500.0}
+        with patch('hazelsync.backend.zfs.zfs_snapshot_names', side_effect=names.get), \
+            patch('hazelsync.backend.zfs.zfs_resume_token', return_value='1-abcdef'), \
+            patch('hazelsync.backend.zfs.zfs_pipe', return_value=stats) as pipe:
+            results = backend.replicate([Path('/backup/cluster01/host01')])
+        resume, incremental = [mycall.args[:2] for mycall in pipe.call_args_list]
+        receive = ['zfs', 'receive', '-s', '-u', '-F', 'backup2/cluster01/host01']
+        assert resume == (['zfs', 'send', '-t', '1-abcdef'], receive)
+        assert incremental == (['zfs', 'send', '-i', 'backup/cluster01/host01@2021-01-02T00:00:00',
+            'backup/cluster01/host01@2021-01-03T00:00:00'], receive)
+        assert results == {Path('/backup/cluster01/host01'): {
+            'replication_bytes': 2000, 'replication_seconds': 4.0, 'replication_rate': 500.0,
+        }}
+
+    def test_replicate_directory(self, backend, tmp_path):
+        backend.replication = {'directory': str(tmp_path)}
+        (tmp_path / 'host01@2021-01-01T00:00:00.zfs').write_text('')
+        names = ['2021-01-01T00:00:00', '2021-01-02T00:00:00']
+        def pipe(send, output, buffer_size):
+            output.write_text('stream')
+            return {'bytes': 6, 'seconds': 1.0, 'rate': 6.0}
+        with patch('hazelsync.backend.zfs.zfs_snapshot_names', return_value=names), \
+            patch('hazelsync.backend.zfs.zfs_pipe', side_effect=pipe):
+            backend.replicate([Path('/backup/cluster01/host01')])
+            # Already replicated
+            assert backend.replicate([Path('/backup/cluster01/host01')]) == {Path('/backup/cluster01/host01'): {}}
+        assert sorted(path.name for path in tmp_path.iterdir()) == [
+            'host01@2021-01-01T00:00:00+2021-01-02T00:00:00.zfs',
+            'host01@2021-01-01T00:00:00.zfs',
+        ]
+
+    def test_replicate_directory_failure(self, backend, tmp_path):
+        backend.replication = {'directory': str(tmp_path)}
+        def pipe(send, output, buffer_size):
+            output.write_text('stre')
+            raise ZfsError(f"Failed to write the stream to {output}: No space left on device")
+        with patch('hazelsync.backend.zfs.zfs_snapshot_names', return_value=['2021-01-01T00:00:00']), \
+            patch('hazelsync.backend.zfs.zfs_pipe', side_effect=pipe):
+            results = backend.replicate([Path('/backup/cluster01/host01')])
+        assert results == {Path('/backup/cluster01/host01'): {'replication_failed': 1}}
+        assert list(tmp_path.iterdir()) == []
+
+    def test_replicate_failure(self, backend):
+        backend.replication = {'dataset': 'backup2/cluster01'}
+        with patch('hazelsync.backend.zfs.zfs_snapshot_names', side_effect=ZfsError('pool is busy')):
+            results = backend.replicate([Path('/backup/cluster01/host01')])
+        assert results == {Path('/backup/cluster01/host01'): {'replication_failed': 1}}
@@ -57,3 +57,31 @@ class TestNagios:
         assert merge_status('ok', 'ok') == 'ok'
         assert merge_status('unknown', 'critical') == 'critical'
         assert merge_status('warning', 'unknown') == 'unknown'
+
+class TestNagiosRestore:
+    clusters = TestNagios.clusters
+    reports = {
+        'backup1': {
+            **TestNagios.reports['backup1'],
+            '2020-12-24T03:00:00': {
+                'cluster': 'backup1',
+                'job_type': 'restore',
+                'job_name': 'rsync',
+                'start_time': '2020-12-24T03:00:00',
+                'end_time': '2020-12-24T03:10:00',
+                'status': 'failure',
+                'slots': [{'slot': '/opt/backup', 'status': 'failure'}],
+            },
+        }
+    }
+
+    @freeze_time('2020-12-24T12:00:00+09:00')
+    def test_ignore_restore(self, clusterdir, reportdir, caplog):
+        caplog.set_level(logging.FATAL)
+        runner = CliRunner(mix_stderr=True)
+        result = runner.invoke(nagios, ['--clusterdir', str(clusterdir), '--reportdir', str(reportdir)])
+        assert result.exit_code == 0
+        assert result.output == dedent('''\
+            OK Hazelsync backups - 1/1
+            [OK] backup1: slots 1/1 succeeded
+        ''')
@@ -1,12 +1,15 @@
 '''Test for rsync module'''
 
+import io
+
 import pytest
-from unittest.mock import create_autospec
+from unittest.mock import create_autospec, MagicMock
 from unittest.mock import call, patch
 from pathlib import Path
 
-from hazelsync.job.pgsql import PgsqlJob
+from hazelsync.job.pgsql import PgsqlJob, parse_lsn, segment_number
 from hazelsync.backend.dummy import DummyBackend
+from hazelsync.settings import SettingError
 from hazelsync.utils.rsync import DEFAULT_PATH
 
 @pytest.fixture(scope='function')
@@ -30,8 +33,8 @@ class TestRsync:
         with patch('hazelsync.job.rsync.rsync_run') as rsync, \
         patch('subprocess.run') as subprocess:
             job.backup()
-            options = ['-a', '-R', '-A', '--numeric-ids']
-            args = {'source': Path('/data/pgsql'), 'options': options, 'includes': None, 'excludes': [Path('/data/wal')], 'private_key': private_key, 'user': 'root'}
+            options = ['-a', '-R', '-A', '--numeric-ids', '--stats']
+            args = {'source': Path('/data/pgsql'), 'options': options, 'includes': None, 'excludes': [Path('/data/wal')], 'private_key': private_key, 'user': 'root', 'ssh_options': [], 'progress': None, 'trailing_slash': True, 'bandwidth': None, 'transfers': 1}
             rsync.assert_called_with(source_host='master01', destination=backend.tmp_dir/'master01', **args)
             backup_pre_script = '''psql -c "SELECT pg_start_backup('hazelsync', true);"'''
             backup_post_script = '''psql -c "SELECT pg_stop_backup();"'''
@@ -47,6 +50,81 @@ class TestRsync:
         job = PgsqlJob(name='myhosts', hosts=['master01'], datadir='/data/pgsql', waldir='/data/wal', private_key=private_key, backend=backend)
         with patch('hazelsync.job.pgsql.rsync_run') as rsync:
             job.stream()
-            options = ['-a', '-R', '-A', '--numeric-ids', '--remove-source-files']
-            args = {'source': Path('/data/wal'), 'options': options, 'private_key': private_key, 'user': 'root'}
+            options = ['-a', '-R', '-A', '--numeric-ids', '--stats', '--remove-source-files']
+            args = {'source': Path('/data/wal'), 'options': options, 'private_key': private_key, 'user': 'root', 'ssh_options': [], 'progress': None, 'bandwidth': None}
             rsync.assert_called_with(source_host='master01', destination=backend.tmp_dir/'master01', **args)
+
+def watch_process(output: bytes, returncode: int = 0):
+    proc = MagicMock()
+    proc.stdout = io.BytesIO(output)
+    proc.poll.return_value = returncode
+    proc.returncode = returncode
+    popen = MagicMock()
+    popen.return_value.__enter__.return_value = proc
+    return popen
+
+class TestPgsqlWatch:
+    def test_invalid_mode(self, private_key, backend):
+        with pytest.raises(SettingError):
+            PgsqlJob(name='myhosts', hosts=['master01'], datadir='/data/pgsql', waldir='/data/wal',
+                private_key=private_key, backend=backend, stream_mode='inotify')
+
+    def test_watch(self, private_key, backend):
+        job = PgsqlJob(name='myhosts', hosts=['master01'], datadir='/data/pgsql', waldir='/data/wal',
+            private_key=private_key, backend=backend, stream_mode='watch', watch_timeout=30)
+        files = []
+        def rsync_run(**kwargs):
+            options = kwargs['options']
+            files.append(Path(options[options.index('--files-from') + 1]).read_text())
+            return {'files_transferred': 2}
+        popen = watch_process(b'Receiving command\nWAL 000000010000000000000001\nWAL 000000010000000000000002\n')
+        with patch('hazelsync.job.pgsql.subprocess.Popen', popen), \
+            patch('hazelsync.job.pgsql.rsync_run', side_effect=rsync_run) as rsync:
+            slots = job.stream()
+        cmd = popen.call_args.args[0]
+        assert cmd[-2:] == ['master01', 'wal-watch /data/wal 30']
+        assert files == ['000000010000000000000001\n000000010000000000000002']
+        assert rsync.call_args.kwargs['destination'] == backend.tmp_dir / 'master01' / 'data/wal'
+        assert '--remove-source-files' in rsync.call_args.kwargs['options']
+        assert slots == [{'slot': 'master01', 'status': 'success', 'stats': {'files_transferred': 2}}]
+
+    def test_watch_fallback(self, private_key, backend):
+        job = PgsqlJob(name='myhosts', hosts=['master01'], datadir='/data/pgsql', waldir='/data/wal',
+            private_key=private_key, backend=backend, stream_mode='watch')
+        with patch('hazelsync.job.pgsql.subprocess.Popen', watch_process(b'', returncode=1)), \
+            patch('hazelsync.job.pgsql.rsync_run', return_value={}) as rsync:
+            slots = job.stream()
+        assert rsync.call_count == 1
+        assert rsync.call_args.kwargs['source'] == Path('/data/wal')
+        assert rsync.call_args.kwargs['destination'] == backend.tmp_dir / 'master01'
+        assert slots[0]['status'] == 'success'
+
+class TestPgsqlLag:
+    def test_archive_lag(self, private_key, backend):
+        job = PgsqlJob(name='myhosts', hosts=['master01'], datadir='/data/pgsql', waldir='/data/wal',
+            private_key=private_key, backend=backend)
+        waldir = backend.tmp_dir / 'master01' / 'data/wal'
+        waldir.mkdir(parents=True)
+        for name in ['000000010000000000000002', '000000010000000000000003', '000000010000000000000003.00000028.backup']:
+            (waldir / name).write_text('')
+        with patch.object(job, 'ssh', return_value=b'0/5000060\n') as ssh, \
+            patch('hazelsync.job.pgsql.rsync_run', return_value={}):
+            slots = job.stream()
+        assert ssh.call_args.args[:2] == ('master01', 'psql -At -c "SELECT pg_current_wal_lsn();"')
+        stats = slots[0]['stats']
+        # Segment 4 is complete but not archived, segment 5 is being written
+        assert stats['archive_lag_segments'] == 1
+        assert stats['archive_lag_bytes'] == 0x5000060 - 4 * 0x1000000
+        assert 0 <= stats['archive_lag_seconds'] < 60
+
+    def test_archive_lag_unknown(self, private_key, backend):
+        job = PgsqlJob(name='myhosts', hosts=['master01'], datadir='/data/pgsql', waldir='/data/wal',
+            private_key=private_key, backend=backend)
+        with patch.object(job, 'ssh') as ssh, patch('hazelsync.job.pgsql.rsync_run', return_value={}):
+            slots = job.stream()
+        ssh.assert_not_called()
+        assert 'stats' not in slots[0]
+
+def test_segment_number():
+    assert segment_number('0000000100000002000000FF', 16 * 1024 * 1024) == 2 * 256 + 255
+    assert parse_lsn('Receiving command\n2/FF000028\n') == 0x2FF000028
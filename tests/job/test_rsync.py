@@ -1,14 +1,21 @@
 '''Test for rsync module'''
 
 import os
+import subprocess
+import time
+from datetime import datetime
+
 import pytest
+from freezegun import freeze_time
 from unittest.mock import create_autospec
 from unittest.mock import call, patch
 from pathlib import Path
+from subprocess import CalledProcessError
 
-from hazelsync.job.rsync import RsyncJob
+from hazelsync.job.rsync import RsyncJob, RunStyle, CHANGED_SINCE_MARGIN
+from hazelsync.reports import Report
 from hazelsync.backend.dummy import DummyBackend
-from hazelsync.utils.rsync import DEFAULT_PATH
+from hazelsync.utils.rsync import DEFAULT_PATH, RsyncError
 
 @pytest.fixture(scope='function')
 def backend(tmp_path):
@@ -28,10 +35,10 @@ class TestRsync:
     @patch('hazelsync.job.rsync.PATH', DEFAULT_PATH)
     def test_backup(self, private_key, backend):
         job = RsyncJob(name='myhosts', hosts=['host01', 'host02', 'host03'], paths=['/var/log'], private_key=private_key, backend=backend)
-        with patch('hazelsync.job.rsync.rsync_run') as rsync:
+        with patch('hazelsync.job.rsync.rsync_run', return_value={}) as rsync:
             job.backup()
-            options = ['-a', '-R', '-A', '--numeric-ids']
-            args = {'source': Path('/var/log'), 'options': options, 'includes': None, 'excludes': None, 'private_key': private_key, 'user': 'root'}
+            options = ['-a', '-R', '-A', '--numeric-ids', '--stats']
+            args = {'source': Path('/var/log'), 'options': options, 'includes': None, 'excludes': None, 'private_key': private_key, 'user': 'root', 'ssh_options': [], 'progress': None, 'trailing_slash': True, 'bandwidth': None, 'transfers': 1}
             rsync.assert_has_calls([
                 call(source_host='host01', destination=backend.tmp_dir/'host01', **args),
                 call(source_host='host02', destination=backend.tmp_dir/'host02', **args),
@@ -59,6 +66,330 @@ class TestRsync:
             excludes=['/var/log/secure*', '/var/log/audit*'], private_key=private_key, backend=backend)
         with patch('hazelsync.job.rsync.rsync_run') as rsync:
             job.backup()
-            options = ['-a', '-R', '-A', '--numeric-ids']
-            args = {'source': Path('/var/log'), 'options': options, 'includes': None, 'excludes': ['/var/log/secure*', '/var/log/audit*'], 'private_key': private_key, 'user': 'root'}
+            options = ['-a', '-R', '-A', '--numeric-ids', '--stats']
+            args = {'source': Path('/var/log'), 'options': options, 'includes': None, 'excludes': ['/var/log/secure*', '/var/log/audit*'], 'private_key': private_key, 'user': 'root', 'ssh_options': [], 'progress': None, 'trailing_slash': True, 'bandwidth': None, 'transfers': 1}
             rsync.assert_called_with(source_host='host01', destination=backend.tmp_dir/'host01', **args)
+
+    def test_backup_async(self, private_key, backend):
+        hosts = ['host01', 'host02', 'host03', 'host04']
+        job = RsyncJob(name='myhosts', hosts=hosts, paths=['/var/log'], private_key=private_key, backend=backend,
+            run_style='async', max_parallel=2)
+        def fake_rsync(source_host, **kwargs):
+            if source_host == 'host02':
+                raise Exception('host02 unreachable')
+            return {}
+        with patch('hazelsync.job.rsync.rsync_run', side_effect=fake_rsync) as rsync:
+            slots = job.backup()
+            assert rsync.call_count == 4
+        assert [slot['slot'] for slot in slots] == [backend.tmp_dir/host for host in hosts]
+        assert [slot['status'] for slot in slots] == ['success', 'failure', 'success', 'success']
+
+    def test_max_parallel_invalid(self, private_key, backend):
+        with pytest.raises(AttributeError):
+            RsyncJob(name='myhosts', hosts=['host01'], paths=['/var/log'], private_key=private_key, backend=backend,
+                run_style='async', max_parallel=0)
+
+    def test_single_transfer(self, private_key, backend):
+        job = RsyncJob(name='myhosts', hosts=['host01'], paths=['/var/log', '/etc'], private_key=private_key, backend=backend,
+            single_transfer=True)
+        with patch('hazelsync.job.rsync.rsync_run') as rsync:
+            slots = job.backup()
+            options = ['-a', '-R', '-A', '--numeric-ids', '--stats']
+            args = {'source': [Path('/var/log'), Path('/etc')], 'options': options, 'includes': None, 'excludes': None, 'private_key': private_key, 'user': 'root', 'ssh_options': [], 'progress': None, 'trailing_slash': True, 'bandwidth': None, 'transfers': 1}
+            rsync.assert_called_once_with(source_host='host01', destination=backend.tmp_dir/'host01', **args)
+        assert slots[0]['status'] == 'success'
+        assert [status['status'] for status in job.status] == ['success', 'success']
+
+    def test_single_transfer_partial(self, private_key, backend):
+        job = RsyncJob(name='myhosts', hosts=['host01'], paths=['/var/log', '/etc'], private_key=private_key, backend=backend,
+            single_transfer=True)
+        stderr = b'rsync: [sender] send_files failed to open "/etc/shadow": Permission denied (13)\n'
+        err = RsyncError(CalledProcessError(23, ['rsync'], stderr=stderr))
+        with patch('hazelsync.job.rsync.rsync_run', side_effect=err):
+            slots = job.backup()
+        assert slots[0]['status'] == 'failure'
+        assert {status['path']: status['status'] for status in job.status} == {
+            Path('/var/log'): 'success',
+            Path('/etc'): 'failure',
+        }
+
+    @patch('hazelsync.job.rsync.PATH', DEFAULT_PATH)
+    def test_multiplex(self, private_key, backend):
+        job = RsyncJob(name='myhosts', hosts=['host01'], paths=['/var/log'],
+            pre_scripts=['/usr/local/bin/my_custom_script arg1'], private_key=private_key, backend=backend,
+            multiplex=True)
+        with patch('hazelsync.job.rsync.rsync_run') as rsync, patch('subprocess.run') as subprocess:
+            job.backup()
+            master_cmd, script_cmd, exit_cmd = [mycall.args[0] for mycall in subprocess.call_args_list]
+            assert '-M' in master_cmd
+            control_path = master_cmd[master_cmd.index('-M') + 4]
+            assert control_path.startswith('ControlPath=')
+            assert script_cmd == ['ssh', '-l', 'root', '-i', str(private_key), '-o', control_path, 'host01', '/usr/local/bin/my_custom_script arg1']
+            assert rsync.call_args.kwargs['ssh_options'] == ['-o', control_path]
+            assert exit_cmd[exit_cmd.index('-O') + 1] == 'exit'
+        assert job.masters == {}
+
+    def test_connections(self, private_key, backend):
+        job = RsyncJob(name='myhosts', hosts=['host01', 'host02'], paths=['/var/log'],
+            private_key=private_key, backend=backend, multiplex=True)
+        with patch('hazelsync.job.rsync.rsync_run', return_value={}), patch('subprocess.run') as subprocess:
+            with job.connections(persist=1200):
+                job.backup()
+                job.backup()
+                assert sorted(job.masters) == ['host01', 'host02']
+            cmds = [mycall.args[0] for mycall in subprocess.call_args_list]
+        # One master per host for both backups, then closed
+        assert ['-M' in cmd for cmd in cmds] == [True, True, False, False]
+        assert 'ControlPersist=1200' in cmds[0]
+        assert job.masters == {}
+
+    def test_backup_stats(self, private_key, backend):
+        job = RsyncJob(name='myhosts', hosts=['host01'], paths=['/var/log', '/etc'], private_key=private_key, backend=backend)
+        stats = [
+            {'files': 10, 'files_transferred': 2, 'total_size': 1000, 'literal_bytes': 100, 'matched_bytes': 0,
+                'bytes_sent': 50, 'bytes_received': 150, 'speedup': 5.0},
+            {'files': 30, 'files_transferred': 0, 'total_size': 3000, 'literal_bytes': 0, 'matched_bytes': 0,
+                'bytes_sent': 20, 'bytes_received': 30, 'speedup': 60.0},
+        ]
+        with patch('hazelsync.job.rsync.rsync_run', side_effect=stats):
+            slots = job.backup()
+        assert slots[0]['stats'] == {'files': 40, 'files_transferred': 2, 'total_size': 4000, 'literal_bytes': 100,
+            'matched_bytes': 0, 'bytes_sent': 70, 'bytes_received': 180, 'speedup': 16.0}
+
+    def test_shards(self, private_key, backend):
+        job = RsyncJob(name='myhosts', hosts=['host01'], paths=['/var/log', '/data'], private_key=private_key, backend=backend,
+            shards={'/data': 2})
+        past = backend.tmp_dir / 'host01' / 'data'
+        (past / 'big').mkdir(parents=True)
+        (past / 'big' / 'file').write_bytes(b'x' * 3000)
+        (past / 'medium').mkdir()
+        (past / 'medium' / 'file').write_bytes(b'x' * 2000)
+        entries = [
+            {'name': 'big', 'size': 4096, 'dir': True},
+            {'name': 'medium', 'size': 4096, 'dir': True},
+            {'name': 'small', 'size': 1500, 'dir': False},
+        ]
+        def fake_rsync(source, **kwargs):
+            if source == [Path('/data/medium'), Path('/data/small')]:
+                raise RsyncError(CalledProcessError(23, ['rsync'], stderr=b'file has vanished: "/data/small"'))
+            return {}
+        with patch('hazelsync.job.rsync.rsync_list', return_value=entries), \
+        patch('hazelsync.job.rsync.rsync_run', side_effect=fake_rsync) as rsync:
+            slots = job.backup()
+            sources = sorted([mycall.kwargs['source'] for mycall in rsync.call_args_list], key=str)
+            assert sources == [Path('/var/log'), [Path('/data/big')], [Path('/data/medium'), Path('/data/small')]]
+            for mycall in rsync.call_args_list:
+                assert mycall.kwargs['trailing_slash'] == (mycall.kwargs['source'] == Path('/var/log'))
+        assert slots[0]['status'] == 'failure'
+        assert {status['path']: status['status'] for status in job.status} == {
+            Path('/var/log'): 'success',
+            Path('/data'): 'failure',
+        }
+        assert set(slots[0]['shards']['/data']) == {'big', 'medium', 'small'}
+        assert slots[0]['shards']['/data']['small'] == 1500
+
+    def test_shards_previous_weights(self, private_key, backend, tmp_path):
+        job = RsyncJob(name='myhosts', hosts=['host01'], paths=['/data'], private_key=private_key, backend=backend,
+            shards={'/data': 2})
+        report = Report(cluster='myhosts', job_name='rsync', job_type='backup', start_time=datetime(2021, 1, 1),
+            end_time=datetime(2021, 1, 1), status='success', slots=[{'slot': str(job.slots['host01']),
+            'status': 'success', 'shards': {'/data': {'big': 100, 'medium': 5000, 'small': 4000}}}])
+        Report.directory = tmp_path / 'reports'
+        report.write()
+        entries = [
+            {'name': 'big', 'size': 4096, 'dir': True},
+            {'name': 'medium', 'size': 4096, 'dir': True},
+            {'name': 'small', 'size': 1500, 'dir': False},
+            {'name': 'new', 'size': 200, 'dir': False},
+        ]
+        with patch('hazelsync.job.rsync.rsync_list', return_value=entries), \
+        patch('hazelsync.job.rsync.disk_usage') as disk_usage, \
+        patch('hazelsync.job.rsync.rsync_run', return_value={'total_size': 6000}) as rsync:
+            slots = job.backup()
+        disk_usage.assert_not_called()
+        sources = sorted(sorted(map(str, mycall.kwargs['source'])) for mycall in rsync.call_args_list)
+        assert sources == [['/data/big', '/data/new', '/data/small'], ['/data/medium']]
+        # The sizes are updated from the total size of each shard
+        assert slots[0]['shards']['/data'] == {'big': 139, 'medium': 6000, 'new': 279, 'small': 5581}
+
+    def test_parallel_transfers(self, private_key, backend):
+        job = RsyncJob(name='myhosts', hosts=['host01', 'host02', 'host03'], paths=['/var/log', '/data'],
+            private_key=private_key, backend=backend, run_style='async', max_parallel=2, shards={'/data': 3})
+        assert job.parallel_transfers() == 6
+        assert job.parallel_transfers(restore=True) == 2
+        job.run_style = RunStyle.SEQ
+        assert job.parallel_transfers() == 3
+
+    def test_shards_invalid_path(self, private_key, backend):
+        with pytest.raises(AttributeError):
+            RsyncJob(name='myhosts', hosts=['host01'], paths=['/var/log'], private_key=private_key, backend=backend,
+                shards={'/data': 2})
+
+    def test_restore(self, private_key, backend, tmp_path):
+        job = RsyncJob(name='myhosts', hosts=['host01', 'host02.example.com', 'host03'],
+            paths=['/var/log', '/etc/hosts', '/opt'], private_key=private_key, backend=backend, max_parallel=2)
+        snapshots = {}
+        for host in ['host01', 'host02']:
+            snapshots[host] = tmp_path / 'snapshots' / host
+            (snapshots[host] / 'var' / 'log').mkdir(parents=True)
+            (snapshots[host] / 'etc').mkdir()
+            (snapshots[host] / 'etc' / 'hosts').write_text('')
+        stats = {'bytes_sent': 1000, 'total_size': 5000}
+        with patch('hazelsync.job.rsync.rsync_run', return_value=stats) as rsync:
+            slots = job.restore(snapshots)
+        assert [slot['status'] for slot in slots] == ['success', 'success']
+        assert slots[1]['stats']['bytes_sent'] == 2000
+        assert 'transfer_rate' in slots[1]['stats']
+        # host03 is not restored, and /opt is missing from the snapshots
+        calls = sorted((mycall.kwargs['dest_host'], mycall.kwargs['destination']) for mycall in rsync.call_args_list)
+        assert calls == [
+            ('host01', Path('/etc')), ('host01', Path('/var/log')),
+            ('host02.example.com', Path('/etc')), ('host02.example.com', Path('/var/log')),
+        ]
+        # The hosts are restored in parallel, so the calls can be in any order
+        kwargs = next(mycall.kwargs for mycall in rsync.call_args_list
+            if mycall.kwargs['dest_host'] == 'host01' and mycall.kwargs['destination'] == Path('/var/log'))
+        assert kwargs['options'] == ['-a', '-A', '--numeric-ids', '--stats']
+        assert kwargs['source'] == snapshots['host01'] / 'var' / 'log'
+
+    def test_restore_failure(self, private_key, backend, tmp_path):
+        job = RsyncJob(name='myhosts', hosts=['host01', 'host02'], paths=['/var/log'],
+            private_key=private_key, backend=backend)
+        snapshots = {host: tmp_path / host for host in ['host01', 'host02']}
+        for snapshot in snapshots.values():
+            (snapshot / 'var' / 'log').mkdir(parents=True)
+        err = RsyncError(CalledProcessError(12, ['rsync'], stderr=b'connection unexpectedly closed'))
+        with patch('hazelsync.job.rsync.rsync_run', side_effect=[err, {}]):
+            slots = job.restore(snapshots)
+        assert sorted(slot['status'] for slot in slots) == ['failure', 'success']
+
+def write_report(directory, slot, start_time, status='success', mode=None):
+    slot_status = {'slot': str(slot), 'status': status}
+    if mode:
+        slot_status['mode'] = mode
+    report = Report(cluster='myhosts', job_name='rsync', job_type='backup', start_time=start_time,
+        end_time=start_time, status=status, slots=[slot_status])
+    Report.directory = directory
+    report.write()
+
+class TestRsyncChanged:
+    @freeze_time('2021-01-10T12:00:00')
+    def test_changed_only(self, private_key, backend, tmp_path):
+        job = RsyncJob(name='myhosts', hosts=['host01'], paths=['/var/log'], private_key=private_key, backend=backend,
+            changed_only=True, full_every='7d')
+        write_report(tmp_path / 'reports', job.slots['host01'], datetime(2021, 1, 5), mode='full')
+        write_report(tmp_path / 'reports', job.slots['host01'], datetime(2021, 1, 9), mode='changed')
+        write_report(tmp_path / 'reports', job.slots['host01'], datetime(2021, 1, 10), status='failure', mode='changed')
+        files = {}
+        def fake_rsync(options, **kwargs):
+            files[options[-4]] = Path(options[-3]).read_bytes()
+            return {}
+        with patch('subprocess.run') as ssh, patch('hazelsync.job.rsync.rsync_run', side_effect=fake_rsync) as rsync:
+            ssh.return_value.stdout = b'/var/log/messages\0/var/log/app/app.log\0'
+            slots = job.backup()
+            timestamp = int(datetime(2021, 1, 9).timestamp()) - 300
+            assert ssh.call_args.args[0][-1] == f"find /var/log -newerct @{timestamp} -print0"
+            assert rsync.call_args.kwargs['source'] == Path('/var/log')
+            assert rsync.call_args.kwargs['destination'] == backend.tmp_dir / 'host01' / 'var' / 'log'
+            assert rsync.call_args.kwargs['options'][-2:] == ['--from0', '-r']
+        assert files == {'--files-from': b'messages\0app/app.log'}
+        assert slots[0]['mode'] == 'changed'
+        assert slots[0]['status'] == 'success'
+
+    @freeze_time('2021-01-10T12:00:00')
+    def test_full_every(self, private_key, backend, tmp_path):
+        job = RsyncJob(name='myhosts', hosts=['host01'], paths=['/var/log'], private_key=private_key, backend=backend,
+            changed_only=True, full_every='7d')
+        write_report(tmp_path / 'reports', job.slots['host01'], datetime(2021, 1, 1), mode='full')
+        write_report(tmp_path / 'reports', job.slots['host01'], datetime(2021, 1, 9), mode='changed')
+        with patch('hazelsync.job.rsync.rsync_run', return_value={}) as rsync:
+            slots = job.backup()
+            # The full passes remove the files removed since the last one
+            assert rsync.call_args.kwargs['options'] == ['-a', '-R', '-A', '--numeric-ids', '--stats', '--delete']
+        assert slots[0]['mode'] == 'full'
+
+    def test_renamed_directory(self, private_key, backend, tmp_path):
+        job = RsyncJob(name='myhosts', hosts=['host01'], paths=[str(tmp_path / 'data')], private_key=private_key,
+            backend=backend, changed_only=True)
+        (tmp_path / 'data' / 'old' / 'sub').mkdir(parents=True)
+        (tmp_path / 'data' / 'old' / 'sub' / 'file').write_text('data')
+        (tmp_path / 'data' / 'file').write_text('data')
+        # The renamed directory is the only entry with a ctime after the last backup, not its content
+        last = int(time.time()) + 1
+        time.sleep(last + 0.1 - time.time())
+        (tmp_path / 'data' / 'old').rename(tmp_path / 'data' / 'new')
+        (tmp_path / 'data' / 'empty').mkdir()
+        def local_find(host, command):
+            return subprocess.run(command, shell=True, stdout=subprocess.PIPE, check=True).stdout
+        with patch.object(job, 'ssh', side_effect=local_find):
+            changed = job.changed_files('host01', tmp_path / 'data', datetime.fromtimestamp(last + CHANGED_SINCE_MARGIN))
+        assert sorted(changed) == [b'empty', b'new']
+
+    def test_first_backup(self, private_key, backend, tmp_path):
+        Report.directory = tmp_path / 'reports'
+        job = RsyncJob(name='myhosts', hosts=['host01'], paths=['/var/log'], private_key=private_key, backend=backend,
+            changed_only=True)
+        with patch('hazelsync.job.rsync.rsync_run', return_value={}):
+            slots = job.backup()
+        assert slots[0]['mode'] == 'full'
+
+class TestRsyncRetry:
+    def test_retry(self, private_key, backend):
+        job = RsyncJob(name='myhosts', hosts=['host01', 'host02'], paths=['/var/log'], private_key=private_key, backend=backend,
+            retries=3, retry_delay=5)
+        assert '--partial-dir=.rsync-partial' in job.rsync_options
+        network_error = RsyncError(CalledProcessError(12, ['rsync'], stderr=b'connection unexpectedly closed'))
+        with patch('hazelsync.job.rsync.rsync_run', side_effect=[network_error, network_error, {}, {}]) as rsync, \
+        patch('time.sleep') as sleep:
+            slots = job.backup()
+            assert rsync.call_count == 4
+            assert sleep.call_args_list == [call(5), call(10)]
+        assert [(slot['status'], slot['attempts']) for slot in slots] == [('success', 3), ('success', 1)]
+
+    def test_retry_exhausted(self, private_key, backend):
+        job = RsyncJob(name='myhosts', hosts=['host01'], paths=['/var/log'], private_key=private_key, backend=backend,
+            retries=1)
+        network_error = RsyncError(CalledProcessError(255, ['rsync'], stderr=b'Connection reset by peer'))
+        with patch('hazelsync.job.rsync.rsync_run', side_effect=network_error) as rsync, patch('time.sleep'):
+            slots = job.backup()
+            assert rsync.call_count == 2
+        assert (slots[0]['status'], slots[0]['attempts']) == ('failure', 2)
+
+    def test_no_retry_permanent(self, private_key, backend):
+        job = RsyncJob(name='myhosts', hosts=['host01'], paths=['/var/log'], private_key=private_key, backend=backend,
+            retries=3)
+        partial_error = RsyncError(CalledProcessError(23, ['rsync'], stderr=b'rsync: link_stat "/var/log/x" failed'))
+        with patch('hazelsync.job.rsync.rsync_run', side_effect=partial_error) as rsync, patch('time.sleep') as sleep:
+            slots = job.backup()
+            assert rsync.call_count == 1
+            sleep.assert_not_called()
+        assert (slots[0]['status'], slots[0]['attempts']) == ('failure', 1)
+
+class TestRsyncCompression:
+    def test_fixed(self, private_key, backend):
+        job = RsyncJob(name='myhosts', hosts=['host01'], paths=['/var/log'], private_key=private_key, backend=backend,
+            compression='zstd')
+        stats = {'literal_bytes': 3000, 'bytes_received': 1000}
+        with patch('hazelsync.job.rsync.rsync_run', return_value=stats) as rsync:
+            slots = job.backup()
+            assert rsync.call_args.kwargs['options'][-3:] == ['--compress', '--compress-choice=zstd', '--compress-level=3']
+        assert slots[0]['compression'] == {'codec': 'zstd', 'ratio': 3.0}
+
+    def test_auto(self, private_key, backend, tmp_path):
+        job = RsyncJob(name='myhosts', hosts=['host01'], paths=['/var/log'], private_key=private_key, backend=backend,
+            compression='auto')
+        Report.directory = tmp_path / 'reports'
+        slow = {'bytes_received': 1024**2, 'seconds': 10, 'cpu_seconds': 1}
+        report = Report(cluster='myhosts', job_name='rsync', job_type='backup', start_time=datetime(2021, 1, 9),
+            end_time=datetime(2021, 1, 9), status='success',
+            slots=[{'slot': str(job.slots['host01']), 'status': 'success', 'stats': slow, 'compression': {'codec': 'lz4'}}])
+        report.write()
+        with patch('hazelsync.job.rsync.rsync_run', return_value={}) as rsync:
+            slots = job.backup()
+            assert '--compress-choice=zstd' in rsync.call_args.kwargs['options']
+        assert slots[0]['compression'] == {'codec': 'zstd'}
+
+    def test_invalid(self, private_key, backend):
+        with pytest.raises(AttributeError):
+            RsyncJob(name='myhosts', hosts=['host01'], paths=['/var/log'], private_key=private_key, backend=backend,
+                compression='gzip')
@@ -1,9 +1,12 @@
 '''Test rsync SSH helper'''
 
+import io
+from pathlib import Path
+
 import pytest
 
 from hazelsync.ssh import Unauthorized
-from hazelsync.ssh.pgsql import PgsqlSsh
+from hazelsync.ssh.pgsql import PgsqlSsh, watch_wal
 
 def test_authorize_allow():
     cmd_line = 'rsync --server --sender -logDtpArRe.iLsfxC --numeric-ids . /opt/data'
@@ -36,3 +39,29 @@ def test_authorize_postscript_allow():
     cmd_line = '''psql -c "SELECT pg_stop_backup();"'''
     helper = PgsqlSsh(dict(allowed_paths='/opt/data'))
     helper.authorize(cmd_line)
+
+def test_authorize_lag_allow():
+    helper = PgsqlSsh(dict(allowed_paths='/opt/data'))
+    helper.authorize('''psql -At -c "SELECT pg_current_wal_lsn();"''')
+
+def test_authorize_watch_allow():
+    helper = PgsqlSsh(dict(allowed_paths='/opt/data'))
+    assert helper.authorize_watch('wal-watch /opt/data/wal 60') == (Path('/opt/data/wal'), 60)
+
+@pytest.mark.parametrize('cmd_line', [
+    'wal-watch /opt/other 60',
+    'wal-watch /opt/data/wal;reboot 60',
+    'wal-watch /opt/data/wal 60 120',
+    'wal-watch /opt/data/wal forever',
+])
+def test_authorize_watch_reject(cmd_line):
+    helper = PgsqlSsh(dict(allowed_paths='/opt/data'))
+    with pytest.raises(Unauthorized):
+        helper.authorize(cmd_line)
+
+def test_watch_wal(tmp_path):
+    (tmp_path / '000000010000000000000001').write_text('segment')
+    (tmp_path / '.000000010000000000000002.tmp').write_text('partial')
+    output = io.StringIO()
+    watch_wal(tmp_path, 0.05, output, interval=0.01)
+    assert output.getvalue() == 'WAL 000000010000000000000001\n'
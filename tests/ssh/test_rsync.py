@@ -20,3 +20,42 @@ def test_authorize_string_path():
     cmd_line = 'rsync --server --sender -logDtpArRe.iLsfxC --numeric-ids . /opt/data'
     helper = RsyncSsh(dict(allowed_paths='/opt/data'))
     helper.authorize(cmd_line)
+
+def test_authorize_multiple_paths_allow():
+    cmd_line = 'rsync --server --sender -logDtpArRe.iLsfxC --numeric-ids . /opt/data/ /var/log/'
+    helper = RsyncSsh(dict(allowed_paths=['/opt/data', '/var/log']))
+    helper.authorize(cmd_line)
+
+def test_authorize_multiple_paths_reject():
+    cmd_line = 'rsync --server --sender -logDtpArRe.iLsfxC --numeric-ids . /etc/ /opt/data/'
+    helper = RsyncSsh(dict(allowed_paths=['/opt/data']))
+    with pytest.raises(Unauthorized):
+        helper.authorize(cmd_line)
+
+def test_authorize_find_allow():
+    cmd_line = "find '/opt/data/my dir' -newerct @1600000000 -not -type d -print0"
+    helper = RsyncSsh(dict(allowed_paths=['/opt/data']))
+    helper.authorize(cmd_line)
+
+def test_authorize_find_directories_allow():
+    cmd_line = "find /opt/data -newerct @1600000000 -print0"
+    helper = RsyncSsh(dict(allowed_paths=['/opt/data']))
+    helper.authorize(cmd_line)
+
+def test_authorize_find_reject_path():
+    cmd_line = 'find /etc -newerct @1600000000 -not -type d -print0'
+    helper = RsyncSsh(dict(allowed_paths=['/opt/data']))
+    with pytest.raises(Unauthorized):
+        helper.authorize(cmd_line)
+
+def test_authorize_find_reject_arguments():
+    cmd_line = 'find /opt/data -newerct @1600000000 -delete'
+    helper = RsyncSsh(dict(allowed_paths=['/opt/data']))
+    with pytest.raises(Unauthorized):
+        helper.authorize(cmd_line)
+
+def test_authorize_find_reject_expansion():
+    cmd_line = 'find "/opt/data/$(reboot)" -newerct @1600000000 -not -type d -print0'
+    helper = RsyncSsh(dict(allowed_paths=['/opt/data']))
+    with pytest.raises(Unauthorized):
+        helper.authorize(cmd_line)
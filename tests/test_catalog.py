@@ -0,0 +1,107 @@
+'''Test the catalog of the files of the snapshots'''
+
+import os
+import shutil
+import sqlite3
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+
+from hazelsync.backend.localfs import LocalfsBackend
+from hazelsync.catalog import Catalog, reverse_glob
+
+class FakeBackend(LocalfsBackend):
+    '''Localfs backend with snapshot times that do not depend on the clock'''
+    def take(self, slot, day):
+        path = self.snapshotdir / f"{slot.name}-2021-01-{day:02d}T00:00:00"
+        shutil.copytree(str(slot), str(path), symlinks=True)
+        return path
+
+@pytest.fixture(scope='function')
+def backend(tmp_path):
+    with patch.object(Catalog, 'directory', tmp_path / 'catalogs'):
+        yield FakeBackend('cluster01', basedir=str(tmp_path))
+
+class TestCatalog:
+    def test_find(self, backend):
+        catalog = Catalog('cluster01')
+        slot = backend.ensure_slot('host01')
+        (slot / 'etc').mkdir()
+        (slot / 'etc' / 'hosts').write_text('v1')
+        (slot / 'etc' / 'motd').write_text('hello')
+        backend.take(slot, 1)
+        assert catalog.update(backend) == 1
+        (slot / 'etc' / 'hosts').write_text('v2')
+        os.utime(str(slot / 'etc' / 'hosts'), (0, 0))
+        backend.take(slot, 2)
+        (slot / 'etc' / 'motd').unlink()
+        backend.take(slot, 3)
+        assert catalog.update(backend) == 2
+        versions = catalog.find('etc/*')
+        assert [(version.path, len(version.snapshots)) for version in versions] == [
+            ('etc/hosts', 1), ('etc/hosts', 2), ('etc/motd', 2),
+        ]
+        assert versions[1].mtime == 0
+        assert versions[0].sha256 != versions[1].sha256
+        assert versions[2].snapshots[-1].time == datetime(2021, 1, 2)
+        # Only the changes are stored
+        db = catalog.connect()
+        assert db.execute('SELECT COUNT(*) FROM files').fetchone()[0] == 3
+        assert catalog.find('etc/*', slot='host02') == []
+
+    def test_find_suffix(self, backend):
+        catalog = Catalog('cluster01')
+        slot = backend.ensure_slot('host01')
+        (slot / 'etc' / 'app').mkdir(parents=True)
+        (slot / 'etc' / 'hosts').write_text('')
+        (slot / 'etc' / 'app' / 'app.conf').write_text('')
+        (slot / 'etc' / 'app' / 'app.conf.orig').write_text('')
+        backend.take(slot, 1)
+        catalog.update(backend)
+        assert [version.path for version in catalog.find('*.conf')] == ['etc/app/app.conf']
+        assert [version.path for version in catalog.find('*/hosts', slot='host01')] == ['etc/hosts']
+        assert [version.path for version in catalog.find('*[.]co?f*')] == ['etc/app/app.conf', 'etc/app/app.conf.orig']
+
+    def test_reverse_glob(self):
+        assert reverse_glob('*.conf') == 'fnoc.*'
+        assert reverse_glob('*/h[a-z]st?') == '?ts[a-z]h/*'
+        assert reverse_glob('*[]x]y') == 'y[]x]*'
+        assert reverse_glob('*[^]x]y') == 'y[^]x]*'
+
+    def test_upgrade(self, backend, tmp_path):
+        catalog = Catalog('cluster01')
+        catalog.path.parent.mkdir(parents=True)
+        db = sqlite3.connect(str(catalog.path))
+        db.executescript('''
+            CREATE TABLE snapshots (id INTEGER PRIMARY KEY AUTOINCREMENT, slot TEXT, path TEXT UNIQUE, time TEXT);
+            CREATE TABLE files (slot TEXT, path TEXT, size INTEGER, mtime REAL, sha256 TEXT, first INTEGER, until INTEGER);
+            INSERT INTO snapshots VALUES (1, 'host01', '/snapshots/host01', '2021-01-01T00:00:00');
+            INSERT INTO files VALUES ('host01', 'etc/hosts', 0, 0, 'abc', 1, NULL);
+        ''')
+        db.close()
+        # The reversed paths are added to an existing catalog
+        (version,) = catalog.find('*/hosts')
+        assert version.sha256 == 'abc'
+
+    def test_destroy(self, backend):
+        catalog = Catalog('cluster01')
+        slot = backend.ensure_slot('host01')
+        (slot / 'data').write_text('v1')
+        backend.take(slot, 1)
+        (slot / 'data').unlink()
+        last = backend.take(slot, 2)
+        catalog.update(backend)
+        (version,) = catalog.find('data')
+        assert [snapshot.time.day for snapshot in version.snapshots] == [1]
+        backend.destroy_snapshots([last])
+        catalog.update(backend)
+        # The file removed in the destroyed snapshot is back in the last snapshot
+        (version,) = catalog.find('data')
+        assert [snapshot.time.day for snapshot in version.snapshots] == [1]
+        backend.take(slot, 3)
+        catalog.update(backend)
+        (version,) = catalog.find('data')
+        assert [snapshot.time.day for snapshot in version.snapshots] == [1]
+        db = catalog.connect()
+        assert db.execute('SELECT until FROM files').fetchall() == [(3,)]
@@ -1,7 +1,14 @@
 '''Unit test for the cluster'''
 
+import threading
+from unittest.mock import patch
+
+import pytest
+from filelock import FileLock, Timeout
+
 from hazelsync.cluster import Cluster
-from hazelsync.settings import ClusterSettings
+from hazelsync.reports import Report
+from hazelsync.settings import ClusterSettings, SettingError
 
 class TestCluster:
     clusters = {
@@ -19,3 +26,202 @@ class TestCluster:
         ClusterSettings.directory = clusterdir
         settings = ClusterSettings('mycluster01', global_path)
         Cluster(settings)
+
+    def test_report_progress(self, global_path, clusterdir):
+        ClusterSettings.directory = clusterdir
+        settings = ClusterSettings('mycluster01', global_path)
+        cluster = Cluster(settings)
+        cluster.action = 'backup'
+        assert cluster.job.on_progress == cluster.report_progress
+        with patch.object(cluster.engine, 'set') as engine_set:
+            cluster.job.progress('host01')({'bytes': 1024, 'percent': 50, 'rate': 512.0})
+            cluster.job.progress('host01')({'bytes': 2048, 'percent': 100, 'rate': 512.0})
+            assert engine_set.call_count == 2
+            metric, value, tags = engine_set.call_args_list[0].args
+            assert metric.name == 'transfer_bytes'
+            assert value == 1024
+            assert tags == {'action': 'backup', 'cluster': 'mycluster01', 'job': 'rsync', 'slot': 'host01'}
+
+    def test_export_slots(self, global_path, clusterdir):
+        ClusterSettings.directory = clusterdir
+        settings = ClusterSettings('mycluster01', global_path)
+        cluster = Cluster(settings)
+        slots = [
+            {'slot': 'host01', 'status': 'success', 'stats': {'files': 10, 'speedup': 2.5}},
+            {'slot': 'host02', 'status': 'failure'},
+        ]
+        with patch.object(cluster.engine, 'set') as engine_set:
+            cluster.export_slots(slots, 'backup')
+            exported = {(mycall.args[0].name, mycall.args[2]['slot']): mycall.args[1] for mycall in engine_set.call_args_list}
+        assert exported == {
+            ('slot_status', 'host01'): 0,
+            ('slot_files', 'host01'): 10,
+            ('slot_speedup', 'host01'): 2.5,
+            ('slot_status', 'host02'): 1,
+        }
+
+    def test_follow(self, global_path, clusterdir):
+        ClusterSettings.directory = clusterdir
+        settings = ClusterSettings('mycluster01', global_path)
+        cluster = Cluster(settings)
+        statuses = ['success', 'failure', 'failure', 'failure', 'success']
+        with patch.object(cluster, 'stream', side_effect=statuses) as stream, \
+            patch.object(cluster.job, 'connections') as connections, \
+            patch('hazelsync.cluster.time.sleep', side_effect=[None] * 4 + [KeyboardInterrupt]) as sleep:
+            try:
+                cluster.follow(interval=10, max_interval=30)
+            except KeyboardInterrupt:
+                pass
+        assert stream.call_count == 5
+        connections.assert_called_once_with(60)
+        assert [mycall.args[0] for mycall in sleep.call_args_list] == [10, 20, 30, 30, 10]
+
+class TestClusterPipeline:
+    clusters = {
+        'mycluster01': {
+            'job': 'rsync',
+            'options': {
+                'hosts': ['host01', 'host02', 'host03'],
+                'paths': ['/var/log'],
+            },
+            'backend': 'dummy',
+            'pipeline_snapshots': True,
+        },
+    }
+
+    def test_backup_pipelined(self, global_path, clusterdir, reportdir):
+        ClusterSettings.directory = clusterdir
+        Report.directory = reportdir
+        cluster = Cluster(ClusterSettings('mycluster01', global_path))
+        snapshotted = threading.Event()
+        def backup_rsync_host(host):
+            if host == 'host02':
+                raise Exception('Connection refused')
+            if host == 'host03':
+                # The first slot is snapshotted while the backup goes on
+                assert snapshotted.wait(5)
+        with patch.object(cluster.job, 'backup_rsync_host', side_effect=backup_rsync_host), \
+            patch.object(cluster.backend, 'snapshot_many', side_effect=lambda slots: snapshotted.set()) as snapshot, \
+            patch.object(Cluster, 'config_logging'), \
+            patch.object(cluster.metrics['runtime'], 'record') as record:
+            cluster.backup()
+        assert [slot.name for mycall in snapshot.call_args_list for slot in mycall.args[0]] == ['host01', 'host03']
+        assert record.call_args.kwargs == {'action': 'snapshot'}
+        assert cluster.job.on_slot_done is None
+        report = Report.last_report('mycluster01')
+        assert report.status == 'partial'
+
+class TestClusterPrune:
+    clusters = {
+        'mycluster01': {
+            'job': 'rsync',
+            'options': {'hosts': ['host01'], 'paths': ['/var/log']},
+            'backend': 'localfs',
+            'retention': {'keep_last': 2},
+        },
+    }
+
+    def test_prune(self, global_path, clusterdir, tmp_path):
+        ClusterSettings.directory = clusterdir
+        settings = ClusterSettings('mycluster01', global_path)
+        settings.backend_options = {'basedir': str(tmp_path / 'backup')}
+        cluster = Cluster(settings)
+        for day in range(1, 5):
+            (cluster.backend.snapshotdir / f"host01-2021-01-0{day}T00:00:00").mkdir()
+        with patch.object(Cluster, 'config_logging'):
+            expired = cluster.prune(dry_run=True)
+            assert len(expired) == 2
+            assert len(list(cluster.backend.snapshotdir.iterdir())) == 4
+            cluster.prune()
+        assert sorted(path.name for path in cluster.backend.snapshotdir.iterdir()) == [
+            'host01-2021-01-03T00:00:00', 'host01-2021-01-04T00:00:00',
+        ]
+
+    def test_prune_locked(self, global_path, clusterdir, tmp_path):
+        ClusterSettings.directory = clusterdir
+        settings = ClusterSettings('mycluster01', global_path)
+        settings.backend_options = {'basedir': str(tmp_path / 'backup')}
+        cluster = Cluster(settings)
+        for day in range(1, 5):
+            (cluster.backend.snapshotdir / f"host01-2021-01-0{day}T00:00:00").mkdir()
+        def destroy_snapshots(snapshots):
+            # The slot is locked while its snapshots are destroyed
+            with pytest.raises(Timeout):
+                with FileLock(str(cluster.backend.slotdir / 'host01' / '.hazesync.lock'), timeout=0):
+                    pass
+            assert len(snapshots) == 2
+        with patch.object(Cluster, 'config_logging'), \
+            patch.object(cluster.backend, 'destroy_snapshots', side_effect=destroy_snapshots) as destroy:
+            cluster.prune()
+        destroy.assert_called_once()
+
+    def test_prune_invalid(self, global_path, clusterdir, tmp_path):
+        ClusterSettings.directory = clusterdir
+        settings = ClusterSettings('mycluster01', global_path)
+        settings.backend_options = {'basedir': str(tmp_path / 'backup')}
+        settings.retention = {'keep_every': 2}
+        cluster = Cluster(settings)
+        with pytest.raises(SettingError):
+            cluster.prune()
+
+class TestClusterRestore:
+    clusters = {
+        'mycluster01': {
+            'job': 'rsync',
+            'options': {'hosts': ['host01', 'host02'], 'paths': ['/var/log']},
+            'backend': 'localfs',
+        },
+    }
+
+    def test_restore(self, global_path, clusterdir, reportdir, tmp_path):
+        ClusterSettings.directory = clusterdir
+        Report.directory = reportdir
+        settings = ClusterSettings('mycluster01', global_path)
+        settings.backend_options = {'basedir': str(tmp_path / 'backup')}
+        cluster = Cluster(settings)
+        for host in ['host01', 'host02']:
+            for day in range(1, 4):
+                (cluster.backend.snapshotdir / f"{host}-2021-01-0{day}T00:00:00").mkdir()
+        with patch.object(cluster.job, 'restore_rsync_host') as restore_rsync_host, \
+            patch.object(Cluster, 'config_logging'):
+            slots = cluster.restore('2021-01-02T12:00:00', ['host02'])
+        restore_rsync_host.assert_called_once_with('host02', cluster.backend.snapshotdir / 'host02-2021-01-02T00:00:00')
+        assert [slot['status'] for slot in slots] == ['success']
+        report = Report.last_report('mycluster01')
+        assert report.job_type == 'restore'
+        assert report.status == 'success'
+
+    def test_restore_missing(self, global_path, clusterdir, tmp_path):
+        ClusterSettings.directory = clusterdir
+        settings = ClusterSettings('mycluster01', global_path)
+        settings.backend_options = {'basedir': str(tmp_path / 'backup')}
+        cluster = Cluster(settings)
+        (cluster.backend.snapshotdir / 'host01-2021-01-02T00:00:00').mkdir()
+        with patch.object(Cluster, 'config_logging'):
+            with pytest.raises(Exception, match='host02'):
+                cluster.restore('latest', ['host01', 'host02'])
+            with pytest.raises(Exception, match='No snapshot'):
+                cluster.restore('2021-01-01T00:00:00')
+
+    def test_restore_dedup(self, global_path, clusterdir, reportdir, tmp_path):
+        ClusterSettings.directory = clusterdir
+        Report.directory = reportdir
+        settings = ClusterSettings('mycluster01', global_path)
+        settings.backend_type = 'dedup'
+        settings.backend_options = {'basedir': str(tmp_path / 'backup'), 'workers': 1}
+        cluster = Cluster(settings)
+        slot = cluster.backend.ensure_slot('host01')
+        (slot / 'var' / 'log').mkdir(parents=True)
+        (slot / 'var' / 'log' / 'syslog').write_text('log')
+        cluster.backend.snapshot(slot)
+        def restore_rsync_host(host, snapshot):
+            assert (snapshot / 'var' / 'log' / 'syslog').read_text() == 'log'
+            restored.append(snapshot)
+        restored = []
+        with patch.object(cluster.job, 'restore_rsync_host', side_effect=restore_rsync_host), \
+            patch.object(Cluster, 'config_logging'):
+            slots = cluster.restore('latest', ['host01'])
+        assert [slot['status'] for slot in slots] == ['success']
+        # The snapshot was extracted to a staging directory, removed after the restore
+        assert restored[0].parent == cluster.backend.stagingdir
+        assert not restored[0].exists()
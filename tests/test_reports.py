@@ -84,3 +84,19 @@ class TestReport:
         report = dummy_report()
         text = report.to_nagios(1)
         assert text == "[OK] mycluster: slots 0/0 succeeded"
+
+    def test_serialize_stats(self):
+        report = dummy_report()
+        report.slots = [{'slot': Path('/backup/host01'), 'status': 'success', 'stats': {'files': 10, 'speedup': 2.5}}]
+        report = Report.deserialize(report.serialize())
+        assert report.slots == [{'slot': '/backup/host01', 'status': 'success', 'stats': {'files': 10, 'speedup': 2.5}}]
+
+    def test_history(self, tmp_path):
+        Report.directory = tmp_path
+        cluster_path = tmp_path / 'mycluster'
+        cluster_path.mkdir()
+        (cluster_path / '2020-11-22T01:00:00.yaml').write_text(DUMMY_REPORT1)
+        (cluster_path / '2020-11-23T01:00:00.yaml').write_text(DUMMY_REPORT1.replace('2020-11-22', '2020-11-23'))
+        (cluster_path / '2020-11-24T01:00:00.yaml').write_text('invalid')
+        reports = list(Report.history('mycluster'))
+        assert [report.start_time.day for report in reports] == [23, 22]
@@ -0,0 +1,36 @@
+'''Unit tests for the retention policies'''
+
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from hazelsync.backend import Snapshot
+from hazelsync.retention import Retention
+
+NOW = datetime(2021, 3, 15, 12)
+
+def snapshots(slot, times):
+    return [Snapshot(slot=slot, path=Path(f"/backup/{slot}@{time.isoformat()}"), time=time) for time in times]
+
+class TestRetention:
+    def test_keep_last(self):
+        times = [NOW - timedelta(days=days) for days in range(5)]
+        expired = Retention(keep_last=2).expired(snapshots('host01', times), NOW)
+        assert [snapshot.time for snapshot in expired] == sorted(times[2:])
+
+    def test_periods(self):
+        # Every 6 hours for 60 days
+        times = [NOW - timedelta(hours=6 * i) for i in range(4 * 60)]
+        retention = Retention(keep_last=1, hourly='1d', daily='1w', monthly='1y')
+        expired = retention.expired(snapshots('host01', times), NOW)
+        kept = sorted(set(times) - {snapshot.time for snapshot in expired})
+        # One per day for a week (including today), plus one per month
+        assert len(kept) == 4 + 7 + 2
+        assert kept[0] == datetime(2021, 1, 31, 18)
+        assert kept[-1] == NOW
+
+    def test_per_slot(self):
+        times = [NOW - timedelta(days=days) for days in range(3)]
+        all_snapshots = snapshots('host01', times) + snapshots('host02', times[:1])
+        expired = Retention(keep_last=1).expired(all_snapshots, NOW)
+        assert {snapshot.slot for snapshot in expired} == {'host01'}
+        assert len(expired) == 2
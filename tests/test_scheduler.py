@@ -0,0 +1,80 @@
+'''Unit tests for the scheduler'''
+
+from concurrent.futures import Future
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+from pytest_data.functions import use_data
+
+from hazelsync.reports import Report
+from hazelsync.scheduler import Scheduler
+from hazelsync.settings import ClusterSettings, SettingError
+
+def report(cluster, start_time):
+    return {
+        'cluster': cluster,
+        'job_type': 'backup',
+        'job_name': 'rsync',
+        'start_time': start_time,
+        'end_time': start_time,
+        'status': 'success',
+        'slots': [],
+    }
+
+class TestScheduler:
+    globals = {
+        'default_backend': 'zfs',
+        'scheduler': {'max_parallel': 2, 'backend_limits': {'zfs': 1}},
+    }
+    clusters = {
+        'daily': {'job': 'rsync', 'options': {}},
+        'hourly': {'job': 'rsync', 'options': {}, 'schedule': {'every': '1h'}},
+        'important': {'job': 'rsync', 'options': {}, 'schedule': {'every': '1h', 'priority': 10}},
+        'local': {'job': 'rsync', 'options': {}, 'backend': 'localfs', 'schedule': {'every': '1h'}},
+    }
+    reports = {
+        'daily': {'2020-12-24T01:00:00': report('daily', '2020-12-24T01:00:00')},
+        'hourly': {'2020-12-24T10:00:00': report('hourly', '2020-12-24T10:00:00')},
+        'important': {'2020-12-24T11:30:00': report('important', '2020-12-24T11:30:00')},
+    }
+
+    @pytest.fixture(autouse=True)
+    def directories(self, clusterdir, reportdir):
+        ClusterSettings.directory = clusterdir
+        Report.directory = reportdir
+
+    def test_due(self, global_path):
+        scheduler = Scheduler(global_path)
+        due = scheduler.due(datetime(2020, 12, 24, 12))
+        # local never ran, important ran 30 minutes ago, daily ran less than a day ago
+        assert [settings.name for settings in due] == ['local', 'hourly']
+        due = scheduler.due(datetime(2020, 12, 25, 12))
+        assert [settings.name for settings in due] == ['important', 'local', 'daily', 'hourly']
+
+    def test_dispatch(self, global_path):
+        scheduler = Scheduler(global_path)
+        queue = scheduler.due(datetime(2020, 12, 25, 12))
+        running = {}
+        with patch('hazelsync.scheduler.ThreadPoolExecutor') as executor:
+            executor.submit.side_effect = lambda *args: Future()
+            left = scheduler.dispatch(queue, running, executor)
+        # Only one zfs backup at a time
+        assert sorted(settings.name for settings in running.values()) == ['important', 'local']
+        assert [settings.name for settings in left] == ['daily', 'hourly']
+        assert 'important' in scheduler.last_start
+
+    def test_run(self, global_path):
+        scheduler = Scheduler(global_path)
+        with patch.object(Scheduler, 'backup') as backup:
+            scheduler.run()
+        assert sorted(mycall.args[0].name for mycall in backup.call_args_list) == ['daily', 'hourly', 'important', 'local']
+        # The clusters that just started are not due anymore, even without report
+        with patch.object(Scheduler, 'backup') as backup:
+            scheduler.run()
+        backup.assert_not_called()
+
+    @use_data(globals={'scheduler': {'backend_limits': {'zfs': 0}}})
+    def test_invalid_limit(self, global_path):
+        with pytest.raises(SettingError):
+            Scheduler(global_path)
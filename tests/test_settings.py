@@ -1,8 +1,10 @@
 '''Test settings'''
 
+from datetime import timedelta
+
 import pytest
 import yaml
-from pytest_data.functions import get_data
+from pytest_data.functions import get_data, use_data
 
 from hazelsync.settings import GlobalSettings, ClusterSettings
 
@@ -28,6 +30,15 @@ class TestGlobalSettings:
         g = GlobalSettings(global_path)
         assert g.backend('zfs') == {'basedir': '/backup'}
 
+    def test_no_bandwidth(self, global_path):
+        g = GlobalSettings(global_path)
+        assert g.bandwidth is None
+
+    @use_data(globals={'bandwidth_limit': 10240})
+    def test_bandwidth(self, global_path):
+        g = GlobalSettings(global_path)
+        assert g.bandwidth.limit == 10240
+
 class TestClusterSettings:
     globals = {
         'default_backend': 'zfs',
@@ -65,3 +76,9 @@ class TestClusterSettings:
 
     def test_backend(self):
         pass
+
+    def test_schedule(self, global_path, clusterdir):
+        ClusterSettings.directory = clusterdir
+        c = ClusterSettings('mycluster1', global_path)
+        assert c.every == timedelta(days=1)
+        assert c.priority == 0
@@ -1,2 +1,297 @@
 '''Test for utils functions'''
 
+import io
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from subprocess import CalledProcessError, CompletedProcess
+from unittest.mock import patch
+
+from hazelsync.utils.bandwidth import BandwidthBudget
+from hazelsync.utils.chunking import chunk_stream
+from hazelsync.utils.functions import disk_usage
+from hazelsync.utils.rsync import rsync_run, rsync_list, execute, failed_paths, parse_progress, split_shards, merge_stats, RsyncError
+from hazelsync.utils.rsync import choose_compression, compression_options
+from hazelsync.utils.ssh import SshMaster
+
+def rsync_error(returncode, stderr):
+    return RsyncError(CalledProcessError(returncode, ['rsync'], stderr=stderr.encode()))
+
+class TestFailedPaths:
+    paths = [Path('/var/log'), Path('/etc'), Path('/opt/app')]
+
+    def test_partial(self):
+        err = rsync_error(23, 'rsync: [sender] link_stat "/opt/app" failed: No such file or directory (2)\n'
+            'rsync error: some files/attrs were not transferred (see previous errors) (code 23)\n')
+        assert failed_paths(err, self.paths) == {Path('/opt/app')}
+
+    def test_vanished(self):
+        err = rsync_error(24, 'file has vanished: "/var/log/messages.1"\n')
+        assert failed_paths(err, self.paths) == {Path('/var/log')}
+
+    def test_unknown_path(self):
+        err = rsync_error(23, 'rsync: [receiver] mkstemp "/backup/host01/etc/.x" failed: No space left on device (28)\n')
+        assert failed_paths(err, self.paths) == set(self.paths)
+
+    def test_fatal(self):
+        err = rsync_error(255, 'ssh: connect to host host01 port 22: Connection refused\n')
+        assert failed_paths(err, self.paths) == set(self.paths)
+
+class TestRsyncRun:
+    def test_multiple_sources(self):
+        with patch('hazelsync.utils.rsync.execute') as execute:
+            rsync_run(source=[Path('/var/log'), Path('/etc')], destination=Path('/backup/host01'),
+                source_host='host01', options=['-a', '-R'])
+            execute.assert_called_once_with(['rsync', '-a', '-R', 'root@host01:/var/log/', 'root@host01:/etc/', '/backup/host01/'], None)
+
+    def test_options_not_modified(self):
+        options = ['-a']
+        with patch('hazelsync.utils.rsync.execute'):
+            rsync_run(source=Path('/var/log'), destination=Path('/backup/host01'), options=options, excludes=['*.gz'])
+        assert options == ['-a']
+
+class TestSshMaster:
+    def test_open_close(self):
+        with patch('subprocess.run') as run:
+            with SshMaster('host01', private_key=Path('/etc/hazelsync.key')) as master:
+                control_dir = master.control_dir
+                assert control_dir.is_dir()
+                assert master.options() == ['-o', f"ControlPath={control_dir}/%C"]
+            assert master.options() == []
+            assert not control_dir.exists()
+            assert run.call_args_list[0].args[0] == ['ssh', '-l', 'root', '-i', '/etc/hazelsync.key', '-M', '-N', '-f',
+                '-o', f"ControlPath={control_dir}/%C", '-o', 'ControlPersist=60', 'host01']
+            assert run.call_args_list[1].args[0] == ['ssh', '-l', 'root', '-i', '/etc/hazelsync.key', '-O', 'exit',
+                '-o', f"ControlPath={control_dir}/%C", 'host01']
+
+    def test_open_failure(self):
+        with patch('subprocess.run', side_effect=CalledProcessError(255, ['ssh'], stderr=b'Connection refused')) as run:
+            with SshMaster('host01') as master:
+                assert master.options() == []
+            assert run.call_count == 1
+
+RSYNC_OUTPUT = (
+    '      1,048,576  10%    1.00MB/s    0:00:01 (xfr#1, to-chk=9/10)\r'
+    '     10,485,760 100%    2.50MB/s    0:00:04 (xfr#10, to-chk=0/10)\n'
+    '\n'
+    'Number of files: 11 (reg: 10, dir: 1)\n'
+    'Number of regular files transferred: 10\n'
+    'Total file size: 10,485,760 bytes\n'
+    'Literal data: 10,000,000 bytes\n'
+    'Matched data: 485,760 bytes\n'
+    'Total bytes sent: 250\n'
+    'Total bytes received: 10,001,234\n'
+    '\n'
+    'sent 250 bytes  received 10,001,234 bytes  2,000,296.80 bytes/sec\n'
+    'total size is 10,485,760  speedup is 1.05\n'
+)
+
+class TestExecute:
+    def test_parse_progress(self):
+        assert parse_progress('      1,048,576  10%    1.00MB/s    0:00:01 (xfr#1, to-chk=9/10)') == {
+            'bytes': 1048576, 'percent': 10, 'rate': 1048576.0,
+        }
+        assert parse_progress('Number of files: 11 (reg: 10, dir: 1)') is None
+
+    def test_execute_streaming(self, tmp_path):
+        output = tmp_path / 'output.txt'
+        output.write_text(RSYNC_OUTPUT)
+        progress = []
+        stats = execute(['cat', str(output)], progress.append)
+        assert [p['bytes'] for p in progress] == [1048576, 10485760]
+        assert progress[1]['rate'] == 2.5 * 1024**2
+        assert stats.pop('seconds') >= 0
+        assert stats.pop('cpu_seconds') >= 0
+        assert stats == {
+            'files': 11,
+            'files_transferred': 10,
+            'total_size': 10485760,
+            'literal_bytes': 10000000,
+            'matched_bytes': 485760,
+            'bytes_sent': 250,
+            'bytes_received': 10001234,
+            'speedup': 1.05,
+        }
+
+    def test_execute_error(self):
+        with pytest.raises(RsyncError) as err:
+            execute(['sh', '-c', 'echo "rsync: link_stat \\"/data\\" failed" >&2; exit 23'])
+        assert err.value.returncode == 23
+        assert err.value.stderr == 'rsync: link_stat "/data" failed'
+
+class TestShards:
+    def test_split_shards(self):
+        weights = {'a': 100, 'b': 60, 'c': 50, 'd': 10}
+        assert split_shards(weights, 2) == [['a', 'd'], ['b', 'c']]
+
+    def test_split_shards_few_items(self):
+        assert split_shards({'a': 1}, 4) == [['a']]
+
+    def test_rsync_list(self):
+        output = (b'drwxr-xr-x          4,096 2021/05/01 10:00:00 .\n'
+            b'drwxr-xr-x          4,096 2021/05/01 10:00:00 my dir\n'
+            b'-rw-r--r--      1,234,567 2021/05/01 10:00:00 file.log\n')
+        with patch('subprocess.run') as run:
+            run.return_value.stdout = output
+            entries = rsync_list(Path('/data'), source_host='host01')
+            assert run.call_args.args[0] == ['rsync', '--list-only', 'root@host01:/data/']
+        assert entries == [
+            {'name': 'my dir', 'size': 4096, 'dir': True},
+            {'name': 'file.log', 'size': 1234567, 'dir': False},
+        ]
+
+    def test_disk_usage(self, tmp_path):
+        (tmp_path / 'dir').mkdir()
+        (tmp_path / 'dir' / 'file').write_bytes(b'x' * 5000)
+        (tmp_path / 'file').write_bytes(b'x' * 100)
+        sizes = disk_usage(tmp_path)
+        assert sizes['file'] == 100
+        assert sizes['dir'] >= 5000
+
+    def test_disk_usage_unreadable(self, tmp_path):
+        (tmp_path / 'file').write_bytes(b'x' * 100)
+        proc = CompletedProcess([], 1, stdout=f"100\t{tmp_path}/file\n100\t{tmp_path}\n".encode(),
+            stderr=b'du: cannot read directory')
+        with patch('hazelsync.utils.functions.subprocess.run', return_value=proc):
+            assert disk_usage(tmp_path) == {'file': 100}
+
+class TestBandwidthBudget:
+    def test_share(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(BandwidthBudget, 'directory', tmp_path)
+        budget = BandwidthBudget(1000)
+        def total():
+            return sum(budget.running().values())
+        with budget.share() as limit1:
+            assert limit1 == 1000
+        # Transfers of another process
+        (tmp_path / 'other1.json').write_text(json.dumps({'pid': os.getpid(), 'limit': 400}))
+        (tmp_path / 'other2.json').write_text(json.dumps({'pid': os.getpid(), 'limit': 300}))
+        with budget.share() as limit2:
+            assert limit2 == 300
+            assert total() <= 1000
+            (tmp_path / 'other1.json').unlink()
+            with budget.share() as limit3:
+                assert limit3 == 333
+                assert total() <= 1000
+                with budget.share() as limit4:
+                    assert limit4 == 67
+                    assert total() <= 1000
+        (tmp_path / 'other2.json').unlink()
+        assert list(tmp_path.glob('*.json')) == []
+
+    def test_share_concurrent(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(BandwidthBudget, 'directory', tmp_path)
+        budget = BandwidthBudget(1000)
+        limits = []
+        started = threading.Barrier(2)
+        def transfer():
+            with budget.share(expected=2) as limit:
+                limits.append(limit)
+                # Both transfers run at the same time
+                started.wait(timeout=5)
+                assert sum(budget.running().values()) <= 1000
+        threads = [threading.Thread(target=transfer) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert limits == [500, 500]
+
+    def test_share_wait(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(BandwidthBudget, 'directory', tmp_path)
+        monkeypatch.setattr(BandwidthBudget, 'poll_interval', 0.01)
+        budget = BandwidthBudget(1000)
+        limits = []
+        def transfer():
+            with budget.share() as limit:
+                limits.append(limit)
+        # More transfers than expected: the budget is all used
+        with budget.share(expected=2), budget.share(expected=2):
+            thread = threading.Thread(target=transfer)
+            thread.start()
+            time.sleep(0.1)
+            assert limits == []
+        thread.join()
+        assert limits == [1000]
+
+    def test_stale(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(BandwidthBudget, 'directory', tmp_path)
+        (tmp_path / 'stale.json').write_text('{"pid": 999999999, "limit": 1000}')
+        with BandwidthBudget(1000).share() as limit:
+            assert limit == 1000
+        assert not (tmp_path / 'stale.json').exists()
+
+    def test_rsync_run(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(BandwidthBudget, 'directory', tmp_path)
+        with patch('hazelsync.utils.rsync.execute') as execute:
+            rsync_run(source=Path('/var/log'), destination=Path('/backup/host01'), bandwidth=BandwidthBudget(2048))
+            execute.assert_called_once_with(['rsync', '--bwlimit', '2048', '/var/log/', '/backup/host01/'], None)
+            rsync_run(source=Path('/var/log'), destination=Path('/backup/host01'), bandwidth=BandwidthBudget(2048),
+                transfers=4)
+            execute.assert_called_with(['rsync', '--bwlimit', '512', '/var/log/', '/backup/host01/'], None)
+
+class TestCompression:
+    def test_first_run(self):
+        assert choose_compression(None) == 'lz4'
+
+    def test_slow_link(self):
+        previous = {'codec': 'lz4', 'bytes_received': 100 * 1024**2, 'seconds': 100, 'cpu_seconds': 10}
+        assert choose_compression(previous) == 'zstd'
+
+    def test_cpu_bound(self):
+        previous = {'codec': 'zstd', 'bytes_received': 3000 * 1024**2, 'seconds': 100, 'cpu_seconds': 95}
+        assert choose_compression(previous) == 'lz4'
+
+    def test_fast_link(self):
+        previous = {'codec': 'zstd', 'bytes_received': 20000 * 1024**2, 'seconds': 100, 'cpu_seconds': 50}
+        assert choose_compression(previous) == 'none'
+
+    def test_stable(self):
+        previous = {'codec': 'lz4', 'bytes_received': 3000 * 1024**2, 'seconds': 100, 'cpu_seconds': 30}
+        assert choose_compression(previous) == 'lz4'
+
+    def test_shards(self):
+        # 4 shards during 100s, each one using 60% of a CPU
+        previous = {'codec': 'zstd', 'bytes_received': 3000 * 1024**2, 'seconds': 100, 'rsync_seconds': 400,
+            'cpu_seconds': 240}
+        assert choose_compression(previous) == 'lz4'
+        previous['cpu_seconds'] = 80
+        assert choose_compression(previous) == 'zstd'
+
+    def test_merge_stats_spans(self):
+        stats = merge_stats([{'seconds': 10, 'cpu_seconds': 2}, {'seconds': 8, 'cpu_seconds': 1},
+            {'seconds': 5, 'cpu_seconds': 1}], spans=[(0, 10), (2, 10), (12, 17)])
+        assert stats == {'seconds': 15, 'rsync_seconds': 23, 'cpu_seconds': 4}
+
+    def test_options(self):
+        assert compression_options('none') == []
+        assert compression_options('lz4') == ['--compress', '--compress-choice=lz4']
+        assert compression_options('zstd') == ['--compress', '--compress-choice=zstd', '--compress-level=3']
+
+class TestChunking:
+    def test_sizes(self):
+        data = os.urandom(200000)
+        chunks = list(chunk_stream(io.BytesIO(data), 1024, 4096, 16384))
+        assert b''.join(chunks) == data
+        assert all(1024 <= len(chunk) <= 16384 for chunk in chunks[:-1])
+
+    def test_shift(self):
+        data = os.urandom(200000)
+        chunks = list(chunk_stream(io.BytesIO(data), 1024, 4096, 16384))
+        shifted = list(chunk_stream(io.BytesIO(b'inserted' + data), 1024, 4096, 16384))
+        # Only the chunks around the insertion change
+        assert len(set(chunks) - set(shifted)) <= 2
+
+    def test_vectorized(self):
+        pytest.importorskip('numpy')
+        data = os.urandom(3 * 1024 * 1024)
+        with patch('hazelsync.utils.chunking.READ_SIZE', 1024 * 1024):
+            chunks = list(chunk_stream(io.BytesIO(data), 1024, 4096, 16384))
+            with patch('hazelsync.utils.chunking.numpy', None):
+                expected = list(chunk_stream(io.BytesIO(data), 1024, 4096, 16384))
+        # The same boundaries as the byte by byte scan
+        assert [len(chunk) for chunk in chunks] == [len(chunk) for chunk in expected]
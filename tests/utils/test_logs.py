@@ -0,0 +1,51 @@
+'''Tests for the routing of the log lines to the clusters'''
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from hazelsync.utils.logs import ClusterFilter, cluster_context, current_cluster, inherit_cluster
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+class TestClusterFilter:
+    def test_concurrent_clusters(self):
+        log = logging.getLogger('hazelsync')
+        handlers = {}
+        for cluster in ['cluster1', 'cluster2']:
+            handlers[cluster] = ListHandler()
+            handlers[cluster].addFilter(ClusterFilter(cluster))
+            log.addHandler(handlers[cluster])
+        barrier = threading.Barrier(2)
+        def run(cluster):
+            with cluster_context(cluster):
+                barrier.wait()
+                log.warning("main %s", cluster)
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    list(executor.map(inherit_cluster(lambda i: log.warning("worker %s %d", cluster, i)), range(2)))
+        try:
+            threads = [threading.Thread(target=run, args=(cluster,)) for cluster in handlers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            log.warning("outside")
+        finally:
+            for handler in handlers.values():
+                log.removeHandler(handler)
+        for cluster, handler in handlers.items():
+            assert sorted(handler.messages) == [f"main {cluster}", f"worker {cluster} 0", f"worker {cluster} 1"]
+
+    def test_nested_context(self):
+        assert current_cluster() is None
+        with cluster_context('cluster1'):
+            with cluster_context('cluster2'):
+                assert current_cluster() == 'cluster2'
+            assert current_cluster() == 'cluster1'
+        assert current_cluster() is None
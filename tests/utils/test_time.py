@@ -16,3 +16,13 @@ class TestDurationParser:
 
     def test_combined(self):
         assert duration_parser('1y6m3d') == timedelta(days=548)
+
+    def test_hours(self):
+        assert duration_parser('6h') == timedelta(hours=6)
+
+    def test_minutes(self):
+        assert duration_parser('1 hour 30min') == timedelta(minutes=90)
+        assert duration_parser('15 minutes') == timedelta(minutes=15)
+
+    def test_words(self):
+        assert duration_parser('2 days') == timedelta(days=2)